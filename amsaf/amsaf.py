@@ -14,12 +14,30 @@ ranking the results of parameter map instances in a caller-defined search space.
 import os
 import sys
 import glob
+import heapq
+import itertools
+import time
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                FIRST_COMPLETED, wait)
 
 import numpy as np
 
 import SimpleITK as sitk
 from sklearn.model_selection import ParameterGrid
 
+from . import profiling, scheduler
+from .cache import IMAGE_CACHE, canonical_parameter_map, seeded
+from .journal import RunJournal, vector_key
+from .search import successive_halving, tpe, proxy_screening, scale_budget
+from .store import ResultStore
+from .writer import ResultWriter
+from .scoring import OverlapScorer, Score
+from .costmodel import CostModel
+
 
 ###########################
 # Public module functions #
@@ -32,7 +50,20 @@ def amsaf_eval(unsegmented_image,
                segmentation,
                parameter_priors=None,
                verbose=False,
-               memoize=False):
+               memoize=False,
+               n_workers=1,
+               executor=None,
+               ordered=False,
+               cache=None,
+               run_dir=None,
+               search='grid',
+               search_options=None,
+               scorer=None,
+               surface_distances=False,
+               database=None,
+               profile=None,
+               prune=None,
+               cost_model=None):
     """Main AMSAF functionality
 
     Generate and score new segmentations and corresponding Elastix parameter
@@ -53,7 +84,103 @@ def amsaf_eval(unsegmented_image,
                              consideration.
     :param verbose: Optional boolean flag to toggle verbose stdout printing from
                     Elastix.
-    :param memoize: Optional boolean flag to toggle memoized optimization. Warning: experimental
+    :param memoize: Optional boolean flag to share registrations between
+                    candidates. Each rigid map and each (rigid, affine) prefix
+                    is registered once and passed on to the next stage as an
+                    initial transform, which yields the same results as the
+                    default path with far fewer Elastix calls. When run in
+                    parallel, each rigid subtree is evaluated by one worker.
+    :param n_workers: Optional number of worker processes used to evaluate
+                      parameter map vectors in parallel. Elastix threads are
+                      split evenly between workers. Defaults to 1 (serial).
+                      If 'auto', the core budget of amsaf.scheduler is split
+                      into workers and threads per worker by
+                      amsaf.scheduler.plan.
+    :param executor: Optional concurrent.futures.Executor to submit
+                     evaluations to instead of creating a process pool. Set
+                     n_workers to its number of workers, which bounds the
+                     evaluations in flight and splits the Elastix threads.
+    :param ordered: If True, parallel results are yielded in submission order
+                    rather than in completion order.
+    :param cache: Optional RegistrationCache. Registrations and
+                  transformations already in the cache are not recomputed.
+    :param run_dir: Optional directory for a run journal. Each finished
+                    candidate is recorded there as it completes, and
+                    candidates already recorded by an earlier run with the
+                    same inputs are read back instead of being re-evaluated.
+    :param search: Search strategy. 'grid' (default) evaluates every
+                   combination of parameter_priors. 'halving' runs
+                   successive halving: every combination is scored with a
+                   reduced MaximumNumberOfIterations/NumberOfSpatialSamples
+                   budget and only the best are re-run with larger budgets,
+                   up to their full budget. Only full-budget results are
+                   yielded. 'tpe' runs a model-based search that evaluates
+                   a fixed budget of combinations, proposing each batch from
+                   the scores seen so far. 'proxy' screens every
+                   combination on copies of the inputs downsampled to an
+                   isotropic spacing, with NumberOfSpatialSamples cut down
+                   in proportion, and evaluates only the best at full
+                   resolution, then prints the Spearman rank correlation
+                   between the two tiers. memoize applies to 'grid' and to
+                   the screening of 'proxy'.
+    :param search_options: Optional dict of keyword arguments for the search
+                           strategy, e.g. {'eta': 3, 'n_rungs': 3} for
+                           amsaf.search.successive_halving or
+                           {'budget': 50, 'seed': 0} for amsaf.search.tpe.
+                           TPE batches default to n_workers candidates.
+                           'proxy' takes 'spacing', the proxy spacing in
+                           physical units (default twice the coarsest
+                           spacing of unsegmented_image), 'n_promote', the
+                           number of candidates evaluated at full resolution
+                           (default 10), and 'report', a callable receiving
+                           the summary of amsaf.search.proxy_screening
+                           instead of it being printed.
+    :param scorer: Optional callable mapping a candidate segmentation to its
+                   score, built once per run. Defaults to an
+                   amsaf.scoring.OverlapScorer of ground_truth, whose scores
+                   are the overall Dice coefficient and carry per-label
+                   Dice, Jaccard and volume similarity in their labels
+                   attribute.
+    :param surface_distances: Optional. If True, the default scorer also
+                              computes the 95th percentile Hausdorff distance
+                              and the average symmetric surface distance of
+                              each candidate, reusing a distance map of the
+                              ground truth surface computed once per run.
+                              They are found in each score's measures
+                              attribute.
+    :param database: Optional ResultsDatabase. Every evaluated candidate is
+                     recorded in it along with its runtime and, with run_dir,
+                     the path of its segmentation. Combinations already
+                     recorded for the same inputs are not evaluated again;
+                     they are yielded from their recorded segmentation if it
+                     still exists and left out otherwise. Searches other
+                     than 'grid' still rank them by their recorded score.
+    :param profile: Optional. If True, time and memory spent in each stage
+                    (registration, resampling, parameter map construction,
+                    scoring and I/O) is aggregated over the run and a
+                    per-stage profile is printed once the results are
+                    exhausted. An amsaf.profiling.StageProfile is filled in
+                    instead of printed. For other instrumentation, add hooks
+                    with amsaf.profiling.add_hook.
+    :param prune: Optional dict to prune the 'grid' search, which is then
+                  evaluated as a prefix tree like with memoize. After the
+                  rigid stage, and after the affine stage below each rigid
+                  map, the segmentation is mapped with the partial transform
+                  and scored. Subtrees whose partial score is below
+                  'threshold', or below the 'quantile' (between 0 and 1) of
+                  the partial scores of their siblings, are not evaluated.
+                  The number of Elastix registrations saved is printed once
+                  the results are exhausted, or passed as a dict to
+                  'report'.
+    :param cost_model: Optional amsaf.costmodel.CostModel predicting the
+                       runtime of each candidate, or True to fit one to the
+                       runtimes recorded in database and run_dir. If it is
+                       fitted, the estimated time of a 'grid' search is
+                       printed before it starts, and parallel evaluations
+                       hand out the candidates (with memoize, the rigid
+                       subtrees) predicted to take longest first, so that
+                       no long candidate is left running alone at the end.
+                       With ordered, results then come in that order.
     :type unsegmented_image: SimpleITK.Image
     :type ground_truth: SimpleITK.Image
     :type segmented_image: SimpleITK.Image
@@ -61,82 +188,340 @@ def amsaf_eval(unsegmented_image,
     :type parameter_priors: dict
     :type verbose: bool
     :type memoize: bool
+    :type n_workers: int or str
+    :type executor: concurrent.futures.Executor
+    :type ordered: bool
+    :type cache: amsaf.cache.RegistrationCache
+    :type run_dir: str
+    :type search: str
+    :type search_options: dict
+    :type scorer: callable
+    :type surface_distances: bool
+    :type database: amsaf.database.ResultsDatabase
+    :type profile: bool or amsaf.profiling.StageProfile
+    :type prune: dict
+    :type cost_model: amsaf.costmodel.CostModel or bool
     :returns: A lazy stream of result
               (parameter map vector, result segmentation, segmentation score) lists.
     :rtype: generator
     """
-    def eval_pm(parameter_map):
-        seg = segment(
-            unsegmented_image,
-            segmented_image,
-            segmentation,
-            parameter_map,
-            verbose=verbose)
-        if ground_truth is not None:
-            score = _sim_score(seg, ground_truth)
-        else:
-            score = 0
-        return [parameter_map, seg, score]
-
-    def param_combinations(option_dict, transform_type):
-        return (_to_elastix(pm, transform_type)
-                for pm in ParameterGrid(option_dict))
-
     if not parameter_priors:
         parameter_priors = _get_default_vector()
-
-    if memoize:
-        for rpm in param_combinations(parameter_priors[0], 'rigid'):
-            rigid_image, rigid_pm = register_indv(unsegmented_image, segmented_image, 'rigid', rpm, verbose=verbose)
-            for apm in param_combinations(parameter_priors[1], 'affine'):
-                affine_image, affine_pm = register_indv(rigid_image, segmented_image, 'affine', apm, auto_init=False, verbose=verbose)
-                for bpm in param_combinations(parameter_priors[2], 'bspline'):
-                    bspline_image, bspline_pm = register_indv(affine_image, segmented_image,'bspline', bpm, verbose=verbose)
-                    transform_parameter_maps = [rigid_pm, affine_pm, bspline_pm]
-                    transformed_seg = transform(segmentation, [_nn_assoc_indv(pm[0]) for pm in transform_parameter_maps], verbose=verbose)
-                    if ground_truth is not None:
-                        score = _sim_score(transformed_seg, ground_truth)
-                    else:
-                        score = 0
-                    yield [ transform_parameter_maps , transformed_seg, score]
-
+    prune_report = None
+    if prune:
+        prune = dict(prune)
+        prune_report = prune.pop('report', _print_prune_report)
+        if set(prune) - set(['threshold', 'quantile']):
+            raise ValueError("kwarg prune takes 'threshold', 'quantile' and "
+                             "'report'")
+    if search in ('grid', 'proxy'):
+        # A memoized grid is split between workers by rigid map.
+        n_tasks = len(ParameterGrid(parameter_priors[0]))
+        if not memoize and not (prune and search == 'grid'):
+            n_tasks *= len(ParameterGrid(parameter_priors[1])) * \
+                len(ParameterGrid(parameter_priors[2]))
     else:
-        for rpm in param_combinations(parameter_priors[0], 'rigid'):
-            for apm in param_combinations(parameter_priors[1], 'affine'):
-                for bpm in param_combinations(parameter_priors[2], 'bspline'):
-                    yield eval_pm([rpm, apm, bpm])
-
-
-
-
-
-
-def write_top_k(k, amsaf_results, path):
+        n_tasks = None
+    n_workers = _resolve_workers(n_workers, n_tasks)
+    journal = None
+    if run_dir is not None:
+        journal = RunJournal(run_dir, (unsegmented_image, ground_truth,
+                                       segmented_image, segmentation))
+    inputs = None
+    if database is not None:
+        inputs = database.inputs((unsegmented_image, ground_truth,
+                                  segmented_image, segmentation))
+
+    default_scorer = scorer is None
+    if scorer is None and ground_truth is not None:
+        scorer = OverlapScorer(ground_truth,
+                               surface_distances=surface_distances)
+    if prune and scorer is None:
+        raise ValueError("kwarg prune needs a ground_truth or a scorer")
+    voxels = unsegmented_image.GetNumberOfPixels()
+    if cost_model is True:
+        cost_model = CostModel()
+        if database is not None:
+            cost_model.add_database(database)
+        if journal is not None:
+            cost_model.add_journal(journal)
+        cost_model.fit()
+
+    def predicted_runtime(pms):
+        return cost_model.predict(pms, voxels)
+
+    cost = None
+    if cost_model is not None and cost_model.fitted:
+        cost = predicted_runtime
+    images = (unsegmented_image, scorer, segmented_image, segmentation)
+
+    def proxy_search():
+        options = dict(search_options or {})
+        spacing = options.pop('spacing', None) or \
+            2 * max(unsegmented_image.GetSpacing())
+        if not default_scorer or ground_truth is None:
+            raise ValueError(
+                "search 'proxy' needs a ground_truth and the default scorer")
+        proxy_images = (
+            downsample(unsegmented_image, spacing),
+            OverlapScorer(downsample(ground_truth, spacing, label=True),
+                          surface_distances=surface_distances),
+            downsample(segmented_image, spacing),
+            downsample(segmentation, spacing, label=True))
+        # Registration cost is driven by the number of samples rather than
+        # of voxels, so samples are cut down with the voxel count.
+        fraction = proxy_images[0].GetNumberOfPixels() / \
+            float(unsegmented_image.GetNumberOfPixels())
+        keys = ['NumberOfSpatialSamples']
+
+        def evaluate_proxy(vectors):
+            # Candidates whose samples scale to the same proxy candidate are
+            # all given its result.
+            groups = {}
+            proxies = []
+            for pms in vectors:
+                proxy = [_to_parameter_map(scale_budget(pm, fraction, keys))
+                         for pm in pms]
+                key = vector_key(proxy)
+                if key not in groups:
+                    groups[key] = []
+                    proxies.append(proxy)
+                groups[key].append(pms)
+            if memoize:
+                proxy_priors = _scaled_priors(parameter_priors, fraction,
+                                              keys)
+                skip = frozenset(
+                    vector_key(pms) for pms in _param_vectors(proxy_priors)
+                    if vector_key(pms) not in groups)
+                results = _eval_stage_tree(
+                    proxy_images, proxy_priors, skip=skip, verbose=verbose,
+                    n_workers=n_workers, executor=executor, cache=cache)
+            else:
+                results = _eval_vectors(
+                    proxy_images, proxies, verbose=verbose,
+                    n_workers=n_workers, executor=executor, cache=cache)
+            for pms, seg, score in results:
+                for original in groups[vector_key(pms)]:
+                    yield [original, seg, score]
+
+        options.setdefault('report', _print_proxy_report)
+        return proxy_screening(list(_param_vectors(parameter_priors)),
+                               evaluate_proxy, evaluate, **options)
+
+    def checkpointed(vectors, run):
+        return _recorded(database, inputs, journal, vectors,
+                         lambda skip: _journaled(
+                             journal,
+                             (pms for pms in vectors
+                              if vector_key(pms) not in skip),
+                             lambda journal_skip: run(skip | journal_skip)))
+
+    def evaluate(vectors):
+        vectors = list(vectors)
+        return checkpointed(vectors, lambda skip: _eval_vectors(
+            images, (pms for pms in vectors if vector_key(pms) not in skip),
+            verbose=verbose, n_workers=n_workers, executor=executor,
+            ordered=ordered, cache=cache, cost=cost))
+
+    def run_search():
+        if search == 'grid':
+            if cost is not None:
+                done = set()
+                if journal is not None:
+                    done |= journal.completed()
+                if database is not None:
+                    done |= database.completed(inputs)
+                remaining = [pms for pms in _param_vectors(parameter_priors)
+                             if vector_key(pms) not in done]
+                _print_eta(cost_model.eta(remaining, voxels, n_workers),
+                           len(remaining), n_workers)
+            if memoize or prune:
+                return checkpointed(
+                    list(_param_vectors(parameter_priors)),
+                    lambda skip: _eval_stage_tree(
+                        images, parameter_priors, skip=skip,
+                        verbose=verbose, n_workers=n_workers,
+                        executor=executor, ordered=ordered, cache=cache,
+                        prune=prune, report=prune_report, cost=cost))
+            else:
+                return evaluate(_param_vectors(parameter_priors))
+        elif search == 'halving':
+            return successive_halving(list(_param_vectors(parameter_priors)),
+                                      evaluate, **(search_options or {}))
+        elif search == 'tpe':
+            options = {'batch_size': max(1, n_workers)}
+            options.update(search_options or {})
+            return tpe(parameter_priors, evaluate, _prior_vector, **options)
+        elif search == 'proxy':
+            return proxy_search()
+        else:
+            raise ValueError("kwarg search must be either 'grid', 'halving', "
+                             "'tpe' or 'proxy'")
+
+    def results():
+        for result in run_search():
+            if result[1] is not None:
+                yield result
+
+    if not profile:
+        for result in results():
+            yield result
+        return
+    stage_profile = profile if isinstance(profile, profiling.StageProfile) \
+        else profiling.StageProfile()
+    with profiling.hooked(stage_profile):
+        for result in results():
+            yield result
+    if profile is True:
+        stage_profile.report()
+
+
+def write_top_k(k, amsaf_results, path, spill=False, io_threads=0,
+                single_file=False):
     """Write top k results to filepath
 
     Results are written as subdirectories "result-i" for 0 < i <= k.
     Each subdirectory contains the result's corresponding parameter maps,
-    segmentation, and score.
+    segmentation, and score. Results are consumed as a stream, so memory use
+    is bounded by k rather than by the number of results.
 
-    :param k: Number of results to write. If k == 0, returns all results
+    :param k: Number of results to write. If k == 0, writes all results
     :param amsaf_results: Results in the format of amsaf_eval return value
     :param path: Filepath to write results at
+    :param spill: Optional. If True, segmentations of the current top k are
+                  kept on disk under path instead of in memory.
+    :param io_threads: Optional number of background threads writing results
+                       through a ResultWriter, so that with k == 0 the search
+                       is not blocked on the disk. Defaults to 0 (write in
+                       the calling thread).
+    :param single_file: Optional. If True, path is a single ResultStore file
+                        instead of a directory. The top k are stored best
+                        first; with k == 0 every result is stored as it
+                        arrives and can be ranked with ResultStore.ranked.
+                        io_threads is ignored.
+    Results of an earlier run at path are replaced.
+
     :type k: int
     :type amsaf_result: [[SimpleITK.ParameterMap, SimpleITK.Image, float]]
     :type path: str
+    :type spill: bool
+    :type io_threads: int
+    :type single_file: bool
     :rtype: None
     """
+    if single_file:
+        path = os.path.abspath(os.path.expanduser(path))
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        spill_dir = os.path.join(parent, '.top-k') if spill and k else None
+        # Every result is streamed into the store, whereas the top k are only
+        # known at the end and replace an earlier store all at once.
+        store_path = path if k == 0 else os.path.join(
+            parent, '.top-k-{}'.format(os.path.basename(path)))
+        if os.path.isfile(store_path):
+            os.remove(store_path)
+        try:
+            with ResultStore(store_path) as store:
+                results = amsaf_results if k == 0 else top_k(
+                    k, amsaf_results, spill_dir=spill_dir)
+                for result in results:
+                    store.add(result)
+            if store_path != path:
+                os.rename(store_path, path)
+        finally:
+            if spill_dir:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+            if store_path != path and os.path.isfile(store_path):
+                os.remove(store_path)
+        return
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    writer = ResultWriter(io_threads) if io_threads else None
+    try:
+        if k == 0:
+            # Every result is kept, so write each one as it arrives and rank
+            # the directories once all scores are known.
+            scores = []
+            for i, result in enumerate(amsaf_results):
+                write_result(result,
+                             os.path.join(path, '.unranked-{}'.format(i)),
+                             writer=writer)
+                scores.append((result[-1], -i))
+            if writer is not None:
+                writer.flush()
+            for rank, (_, i) in enumerate(sorted(scores, reverse=True)):
+                result_path = os.path.join(path, 'result-{}'.format(rank))
+                if os.path.isdir(result_path):
+                    shutil.rmtree(result_path)
+                os.rename(os.path.join(path, '.unranked-{}'.format(-i)),
+                          result_path)
+            _remove_results(path, len(scores))
+            return
+
+        spill_dir = os.path.join(path, '.top-k') if spill else None
+        try:
+            n = 0
+            for n, result in enumerate(top_k(k, amsaf_results,
+                                             spill_dir=spill_dir), 1):
+                result_path = os.path.join(path, 'result-{}'.format(n - 1))
+                if os.path.isdir(result_path):
+                    shutil.rmtree(result_path)
+                write_result(result, result_path, writer=writer)
+            if writer is not None:
+                writer.flush()
+            _remove_results(path, n)
+        finally:
+            if spill_dir:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_stream(amsaf_results, path, io_threads=2, max_pending=8):
+    """Write every result as it streams past
+
+    Each result is queued for writing to a subdirectory "candidate-i" of path,
+    in arrival order, and yielded on unchanged, so the stream can be consumed
+    further, e.g. by top_k. Writes run on background threads; if more than
+    max_pending results are waiting to be written, the stream blocks until the
+    disk catches up. All writes have finished once the stream is exhausted.
+
+    :param amsaf_results: Results in the format of amsaf_eval return value
+    :param path: Filepath to write results at
+    :param io_threads: Number of background writer threads
+    :param max_pending: Maximum number of results waiting to be written
+    :type amsaf_results: [[SimpleITK.ParameterMap, SimpleITK.Image, float]]
+    :type path: str
+    :type io_threads: int
+    :type max_pending: int
+    :returns: The results of amsaf_results
+    :rtype: generator
+
+    >>> best = top_k(10, write_stream(amsaf_eval(*images), '~/all_results'))
+    """
     if not os.path.isdir(path):
         os.makedirs(path)
-    for i, result in enumerate(top_k(k, amsaf_results)):
-        write_result(result, os.path.join(path, 'result-{}'.format(i)))
+    with ResultWriter(io_threads, max_pending) as writer:
+        for i, result in enumerate(amsaf_results):
+            write_result(result,
+                         os.path.join(path, 'candidate-{}'.format(i)),
+                         writer=writer)
+            yield result
 
 
 def register(fixed_image,
              moving_image,
              parameter_maps=None,
              auto_init=True,
-             verbose=False):
+             verbose=False,
+             num_threads=None,
+             cache=None,
+             fixed_mask=None,
+             moving_mask=None):
     """Register images using Elastix.
 
     :param parameter_maps: Optional vector of 3 parameter maps to be used for
@@ -145,19 +530,40 @@ def register(fixed_image,
     :param auto_init: Auto-initialize images. This helps with flexibility when
                       using images with little overlap.
     :param verbose: Flag to toggle stdout printing from Elastix
+    :param num_threads: Optional number of threads Elastix may use. Defaults
+                        to the amsaf.scheduler configuration, or else the
+                        SimpleITK global default.
+    :param cache: Optional RegistrationCache to look results up in and store
+                  them to. A fixed RandomSeed is added to the parameter maps
+                  so that cached results are deterministic.
+    :param fixed_mask: Optional sitkUInt8 mask on the fixed image grid.
+                       Elastix only samples the fixed image where it is
+                       nonzero.
+    :param moving_mask: Optional sitkUInt8 mask on the moving image grid.
     :type fixed_image: SimpleITK.Image
     :type moving_image: SimpleITK.Image
     :type parameter_maps: [SimpleITK.ParameterMap]
     :type auto_init: bool
     :type verbose: bool
+    :type num_threads: int
+    :type cache: amsaf.cache.RegistrationCache
+    :type fixed_mask: SimpleITK.Image
+    :type moving_mask: SimpleITK.Image
     :returns: Tuple of (result_image, transform_parameter_maps)
     :rtype: (SimpleITK.Image, [SimpleITK.ParameterMap])
     """
     registration_filter = sitk.ElastixImageFilter()
     if not verbose:
         registration_filter.LogToConsoleOff()
+    num_threads = scheduler.filter_threads(num_threads)
+    if num_threads:
+        registration_filter.SetNumberOfThreads(num_threads)
     registration_filter.SetFixedImage(fixed_image)
     registration_filter.SetMovingImage(moving_image)
+    if fixed_mask is not None:
+        registration_filter.SetFixedMask(fixed_mask)
+    if moving_mask is not None:
+        registration_filter.SetMovingMask(moving_mask)
 
     if not parameter_maps:
         parameter_maps = [
@@ -166,14 +572,28 @@ def register(fixed_image,
         ]
     if auto_init:
         parameter_maps = _auto_init_assoc(parameter_maps)
+    if cache is not None:
+        parameter_maps = [seeded(pm) for pm in parameter_maps]
+        # Masks are only hashed when given, so unmasked keys are unchanged.
+        masks = [(name, m) for name, m in (('fixed_mask', fixed_mask),
+                                           ('moving_mask', moving_mask))
+                 if m is not None]
+        key = cache.key('register', fixed_image, moving_image, parameter_maps,
+                        *masks)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
     registration_filter.SetParameterMap(parameter_maps[0])
     for m in parameter_maps[1:]:
         registration_filter.AddParameterMap(m)
 
-    registration_filter.Execute()
+    with profiling.stage('registration', fixed_image.GetNumberOfPixels()):
+        _execute(registration_filter)
     result_image = registration_filter.GetResultImage()
     transform_parameter_maps = registration_filter.GetTransformParameterMap()
 
+    if cache is not None:
+        cache.put(key, result_image, transform_parameter_maps)
     return result_image, transform_parameter_maps
 
 def register_indv(fixed_image,
@@ -181,7 +601,11 @@ def register_indv(fixed_image,
              transform_type,
              parameter_map=None,
              auto_init=True,
-             verbose=False):
+             verbose=False,
+             num_threads=None,
+             initial_transform=None,
+             cache=None,
+             initial_key=None):
     """Register images using Elastix. Used to perform transforms individually
         Namely used for memoization to avoid redundant computation
 
@@ -191,18 +615,42 @@ def register_indv(fixed_image,
                            registration. If none is provided, a default map based on transform type is used.
     :param auto_init: Auto-initialize images. This helps with flexibility when
                       using images with little overlap.
+    :param initial_transform: Optional path to a transform parameter file
+                              that the registration starts from, e.g. the
+                              result of a previous stage.
+    :param cache: Optional RegistrationCache to look results up in and store
+                  them to. Cached transform parameter maps don't refer to
+                  initial_transform; on a hit, they are pointed at the
+                  initial_transform of the call.
+    :param initial_key: Optional string identifying the transform in
+                        initial_transform, e.g. the parameter maps it was
+                        registered with, to key the cache on instead of the
+                        file's contents.
     :param verbose: Flag to toggle stdout printing from Elastix
+    :param num_threads: Optional number of threads Elastix may use. Defaults
+                        to the amsaf.scheduler configuration, or else the
+                        SimpleITK global default.
     :type fixed_image: SimpleITK.Image
     :type moving_image: SimpleITK.Image
     :type parameter_map: SimpleITK.ParameterMap
     :type auto_init: bool
     :type verbose: bool
+    :type num_threads: int
+    :type initial_transform: str
+    :type cache: amsaf.cache.RegistrationCache
+    :type initial_key: str
     :returns: Tuple of (result_image, transform_parameter_maps)
     :rtype: (SimpleITK.Image, [SimpleITK.ParameterMap])
     """
     registration_filter = sitk.ElastixImageFilter()
     if not verbose:
         registration_filter.LogToConsoleOff()
+    num_threads = scheduler.filter_threads(num_threads)
+    if num_threads:
+        registration_filter.SetNumberOfThreads(num_threads)
+    if initial_transform:
+        registration_filter.SetInitialTransformParameterFileName(
+            initial_transform)
     registration_filter.SetFixedImage(fixed_image)
     registration_filter.SetMovingImage(moving_image)
 
@@ -211,11 +659,31 @@ def register_indv(fixed_image,
 
     if auto_init:
         parameter_map = _auto_init_assoc_indv(parameter_map)
+    if cache is not None:
+        parameter_map = seeded(parameter_map)
+        initial = None
+        if initial_transform:
+            initial = initial_key
+            if initial is None:
+                # The file's own link to its parent is a path, which may be
+                # a scratch file, so only the parameters are hashed.
+                initial = _canonical_parameter_file(initial_transform)
+        key = cache.key('register_indv', fixed_image, moving_image,
+                        parameter_map, initial)
+        cached = cache.get(key)
+        if cached is not None:
+            result_image, transform_parameter_map = cached
+            return result_image, _initial_transform_assoc(
+                transform_parameter_map, initial_transform)
     registration_filter.SetParameterMap(parameter_map)
-    registration_filter.Execute()
+    with profiling.stage('registration', fixed_image.GetNumberOfPixels()):
+        _execute(registration_filter)
     result_image = registration_filter.GetResultImage()
     transform_parameter_map = registration_filter.GetTransformParameterMap()
 
+    if cache is not None:
+        cache.put(key, result_image,
+                  _initial_transform_assoc(transform_parameter_map, None))
     return result_image, transform_parameter_map
 
 
@@ -224,9 +692,19 @@ def segment(unsegmented_image,
             segmented_image,
             segmentation,
             parameter_maps=None,
-            verbose=False):
+            verbose=False,
+            num_threads=None,
+            cache=None,
+            roi_margin=None,
+            masks=False):
     """Segment image using Elastix
 
+    With roi_margin, only the region of interest around the labels of
+    segmentation, grown by roi_margin in physical units, is registered. Both
+    images are cropped to that region with their physical coordinates intact,
+    and the resulting transform is resampled onto the full grid of
+    unsegmented_image.
+
     :param segmented_image: Image with corresponding segmentation passed as
                             the next argument
     :param segmentation: Segmentation to be mapped from segmented_image to
@@ -235,56 +713,123 @@ def segment(unsegmented_image,
                            registration. If none are provided, a default vector
                            of [rigid, affine, bspline] parameter maps is used.
     :param verbose: Flag to toggle stdout printing from Elastix
+    :param num_threads: Optional number of threads Elastix may use.
+    :param cache: Optional RegistrationCache for the registration and
+                  transformation.
+    :param roi_margin: Optional margin in physical units (e.g. mm) around the
+                       bounding box of segmentation's labels. If given, only
+                       that region of both images is registered.
+    :param masks: Optional. If True, Elastix only samples voxels where the
+                  fixed and moving images are nonzero, skipping empty
+                  background such as the outside of an ultrasound sector.
     :type unsegmented_image: SimpleITK.Image
     :type segmented_image: SimpleITK.Image
     :type segmentation: SimpleITK.Image
     :type parameter_maps: [SimpleITK.ParameterMap]
     :type verbose: bool
+    :type num_threads: int
+    :type cache: amsaf.cache.RegistrationCache
+    :type roi_margin: float
+    :type masks: bool
     :returns: Segmentation mapped from segmented_image to unsegmented_image
     :rtype: SimpleITK.Image
     """
+    fixed_image, moving_image = unsegmented_image, segmented_image
+    if roi_margin is not None:
+        box = _physical_bounding_box(segmentation, roi_margin)
+        if box is not None:
+            fixed_image = _crop_physical(unsegmented_image, box)
+            moving_image = _crop_physical(segmented_image, box)
+    fixed_mask = moving_mask = None
+    if masks:
+        fixed_mask = sitk.Cast(fixed_image != 0, sitk.sitkUInt8)
+        moving_mask = sitk.Cast(moving_image != 0, sitk.sitkUInt8)
+
     _, transform_parameter_maps = register(
-        unsegmented_image, segmented_image, parameter_maps, verbose=verbose)
+        fixed_image, moving_image, parameter_maps, verbose=verbose,
+        num_threads=num_threads, cache=cache, fixed_mask=fixed_mask,
+        moving_mask=moving_mask)
+    if fixed_image is not unsegmented_image:
+        transform_parameter_maps = _grid_assoc(transform_parameter_maps,
+                                               unsegmented_image)
 
     return transform(
-        segmentation, _nn_assoc(transform_parameter_maps), verbose=verbose)
+        segmentation, _nn_assoc(transform_parameter_maps), verbose=verbose,
+        cache=cache, num_threads=num_threads)
 
 
-
-def transform(image, parameter_maps, verbose=False):
+def transform(image, parameter_maps, verbose=False, cache=None,
+              num_threads=None):
     """Transform an image according to some vector of parameter maps
 
     :param image: Image to be transformed
     :param parameter_maps: Vector of 3 parameter maps used to dictate the
                            image transformation
+    :param cache: Optional RegistrationCache to look results up in and store
+                  them to.
+    :param num_threads: Optional number of threads Transformix may use.
+                        Defaults to the amsaf.scheduler configuration.
+                        Transformix only takes the process-wide SimpleITK
+                        default, so this is ignored off the main thread,
+                        e.g. in a thread pool, where other calls share it.
     :type image: SimpleITK.Image
     :type parameter_maps: [SimpleITK.ParameterMap]
+    :type cache: amsaf.cache.RegistrationCache
+    :type num_threads: int
     :returns: Transformed image
     :rtype: SimpleITK.Image
     """
+    if cache is not None:
+        key = cache.key('transform', image, parameter_maps)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached[0]
     transform_filter = sitk.TransformixImageFilter()
     if not verbose:
         transform_filter.LogToConsoleOff()
     transform_filter.SetTransformParameterMap(parameter_maps)
     transform_filter.SetMovingImage(image)
-    transform_filter.Execute()
-    image = transform_filter.GetResultImage()
-    return image
-
-
-def read_image(path, ultrasound_slice=False):
+    num_threads = scheduler.filter_threads(num_threads)
+    # Transformix has no per-filter thread count and uses ITK's global one,
+    # which only the main thread of each process may change. (There is no
+    # threading.main_thread on Python 2.)
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        num_threads = None
+    default_threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    if num_threads:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+    try:
+        with profiling.stage('resampling', image.GetNumberOfPixels()):
+            _execute(transform_filter)
+    finally:
+        if num_threads:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(default_threads)
+    result_image = transform_filter.GetResultImage()
+    if cache is not None:
+        cache.put(key, result_image)
+    return result_image
+
+
+def read_image(path, ultrasound_slice=False, raw_store=None):
     """Load image from filepath as SimpleITK.Image
 
+    Images are read through the process-wide image cache, which is disabled
+    unless given a byte budget with amsaf.cache.configure_image_cache.
+
     :param path: Path to .nii file containing image.
     :param ultrasound_slice: Optional. If True, image will be cast as sitkUInt16 for ultrasound images.
+    :param raw_store: Optional RawStore. If given, the image is converted to raw pixel data on first read and
+                      copied out of the memory-mapped raw file from then on instead of being decoded.
     :type path: str
+    :type raw_store: amsaf.rawstore.RawStore
     :returns: Image object from path
     :rtype: SimpleITK.Image
     """
-    image = sitk.ReadImage(path)
-    if ultrasound_slice:
-        image = sitk.Cast(image, sitk.sitkUInt16)
-    return image
+    pixel_type = sitk.sitkUInt16 if ultrasound_slice else None
+    with profiling.stage('read'):
+        if raw_store is not None:
+            return raw_store.read(path, pixel_type)
+        return IMAGE_CACHE.read(path, pixel_type)
 
 
 def write_image(image, path):
@@ -299,50 +844,105 @@ def write_image(image, path):
     sitk.WriteImage(image, path)
 
 
-def write_result(amsaf_result, path):
+def write_result(amsaf_result, path, writer=None):
     """Write single amsaf_eval result to path
 
     Writes parameter maps, segmentation, and score of AMSAF result as individual
-    files at path.
+    files at path. Each file is written under a temporary name and renamed into
+    place, so readers never see a partially written file.
 
     :param amsaf_results: Results in the format of amsaf_eval return value
     :param path: Filepath to write results at
+    :param writer: Optional ResultWriter. If given, the result is queued for
+                   writing in the background and this returns immediately,
+                   unless the writer's queue is full.
     :type amsaf_result: [SimpleITK.ParameterMap, SimpleITK.Image, float]
     :type path: str
+    :type writer: amsaf.writer.ResultWriter
     :rtype: None
     """
-    if not os.path.isdir(path):
-        os.makedirs(path)
-    for i, pf in enumerate(amsaf_result[0]):
-        sitk.WriteParameterFile(pf,
-                                os.path.join(
-                                    path, 'parameter-file-{}.txt'.format(i)))
-
-    sitk.WriteImage(amsaf_result[1], os.path.join(path, 'seg.nii'))
-
-    with open(os.path.join(path, 'score.txt'), 'w') as f:
-        f.write('{}\n'.format(amsaf_result[2]))
+    if writer is not None:
+        writer.submit(write_result, amsaf_result, path)
+        return
 
-
-def top_k(k, amsaf_results):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    with profiling.stage('write', amsaf_result[1].GetNumberOfPixels()):
+        for i, pf in enumerate(amsaf_result[0]):
+            _atomic_write(os.path.join(path, 'parameter-file-{}.txt'.format(i)),
+                          lambda tmp_path: sitk.WriteParameterFile(pf, tmp_path))
+
+        _atomic_write(os.path.join(path, 'seg.nii'),
+                      lambda tmp_path: sitk.WriteImage(amsaf_result[1], tmp_path))
+
+        def write_score(tmp_path):
+            with open(tmp_path, 'w') as f:
+                f.write('{}\n'.format(amsaf_result[2]))
+        _atomic_write(os.path.join(path, 'score.txt'), write_score)
+
+
+def top_k(k, amsaf_results, spill_dir=None):
     """Get top k results of amsaf_eval
 
+    Results are consumed as a stream through a bounded heap, so segmentations
+    of candidates that fall out of the top k are released immediately. Ties
+    are broken in favor of earlier results.
+
     :param k: Number of results to return. If k == 0, returns all results
     :param amsaf_results: Results in the format of amsaf_eval return value
+    :param spill_dir: Optional directory to hold the segmentations of the
+                      current top k on disk instead of in memory while the
+                      stream is consumed. They are read back on return.
+    Results of an earlier run at path are replaced.
+
     :type k: int
     :type amsaf_result: [[SimpleITK.ParameterMap, SimpleITK.Image, float]]
+    :type spill_dir: str
     :returns: Top k result groups ordered by score
     :rtype: [[SimpleITK.ParameterMap, SimpleITK.Image, float]]
     """
     if k == 0:
-        sorted(amsaf_results, key=lambda x: x[-1], reverse=True)
-    return sorted(amsaf_results, key=lambda x: x[-1], reverse=True)[:k]
+        return sorted(amsaf_results, key=lambda x: x[-1], reverse=True)
+
+    if spill_dir and not os.path.isdir(spill_dir):
+        os.makedirs(spill_dir)
+
+    heap = []
+    for i, result in enumerate(amsaf_results):
+        entry = (result[-1], -i)
+        if len(heap) >= k and entry <= heap[0][:2]:
+            continue
+        result = list(result)
+        if spill_dir:
+            seg_path = os.path.join(spill_dir, 'seg-{}.mha'.format(i))
+            sitk.WriteImage(result[1], seg_path)
+            result[1] = seg_path
+        if len(heap) < k:
+            heapq.heappush(heap, entry + (result,))
+        else:
+            _, _, dropped = heapq.heapreplace(heap, entry + (result,))
+            if spill_dir:
+                os.remove(dropped[1])
+
+    results = [result for _, _, result in sorted(heap, reverse=True)]
+    if spill_dir:
+        for result in results:
+            seg_path = result[1]
+            result[1] = sitk.ReadImage(seg_path)
+            os.remove(seg_path)
+    return results
 
 
 def seg_map(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir, filenames, parameter_maps=None,
-            strict=False):
+            strict=False, cache=None, n_workers=1, io_threads=2, output_dir=None, raw_store=None):
     """Intra-subject segmentation mappings from supplied filenames
 
+    Runs iter_seg_map and collects its results in the order of filenames.
+
     :param segmented_subject_dir: Directory with data of segmented image
     :param unsegmented_subject_dir: Directory with data of unsegmented_image
     :param segmentation_dir: Directory with data of segmented image segmentation
@@ -352,6 +952,15 @@ def seg_map(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir, fi
                            of [rigid, affine, bspline] parameter maps is used.
     :param strict: Default False. If True, a ValueError will be raised when some filename is not present in every
                    supplied directory.
+    :param cache: Optional RegistrationCache for registrations and transformations.
+    :param n_workers: Optional number of worker processes to register file pairs on. Defaults to 1 (serial).
+                      If 'auto', chosen by amsaf.scheduler.plan.
+    :param io_threads: Optional number of threads loading images ahead of
+                       registration. If 0, images are read inline when
+                       registration needs them.
+    :param output_dir: Optional directory to write each segmentation to, under its filename. If given, paths of
+                       the written segmentations are returned instead of images.
+    :param raw_store: Optional RawStore images are read through, see read_image.
 
     :rtype: [SimpleITK.Image]
 
@@ -363,24 +972,15 @@ def seg_map(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir, fi
     >>> sub1_seg = os.path.join(sub1, seg)
     >>> sub2_hand_shoulder_seg = seg_map(sub1_trials, sub2_trials, sub1_seg, ['trial18_90_fs_volume.mha'])
     """
-    result_segs = []
-    for f in filenames:
-        unsegmented_image = os.path.join(unsegmented_subject_dir, f)
-        segmented_image = os.path.join(segmented_subject_dir, f)
-        segmentation = os.path.join(segmentation_dir, f)
-
-        if not all([os.path.isfile(image) for image in [unsegmented_image, segmented_image, segmentation]]):
-            if strict:
-                raise ValueError("File {} is not in all supplied directories".format(f))
-            continue
-
-        result_segs.append(segment(unsegmented_image, segmented_image, segmentation, parameter_maps=parameter_maps))
-
-    return result_segs
+    return [seg for _, seg in iter_seg_map(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir,
+                                           filenames, parameter_maps=parameter_maps, strict=strict, cache=cache,
+                                           n_workers=n_workers, io_threads=io_threads, output_dir=output_dir,
+                                           ordered=True, raw_store=raw_store)]
 
 
 def seg_map_all(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir,
-                parameter_maps=None, image_type='volume', strict=False):
+                parameter_maps=None, image_type='volume', strict=False, cache=None, n_workers=1, io_threads=2,
+                output_dir=None, raw_store=None):
     """Intra-subject segmentation mappings
 
     Like seg_map, but selects all files of image_type in supplied directories as filename selection.
@@ -394,6 +994,15 @@ def seg_map_all(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir
     :param image_type: Either 'volume' or 'slice' corresponding to extensions '.mha' or '.nii', respectively
     :param strict: Default False. If True, a ValueError will be raised when some filename is not present in every
                    supplied directory.
+    :param cache: Optional RegistrationCache for registrations and transformations.
+    :param n_workers: Optional number of worker processes to register file pairs on. Defaults to 1 (serial).
+                      If 'auto', chosen by amsaf.scheduler.plan.
+    :param io_threads: Optional number of threads loading images ahead of
+                       registration. If 0, images are read inline when
+                       registration needs them.
+    :param output_dir: Optional directory to write each segmentation to, under its filename. If given, paths of
+                       the written segmentations are returned instead of images.
+    :param raw_store: Optional RawStore images are read through, see read_image.
 
     :rtype: [SimpleITK.Image]
 
@@ -408,14 +1017,88 @@ def seg_map_all(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir
     sub1_images = _image_set(segmented_subject_dir, image_type=image_type)
     sub2_images = _image_set(unsegmented_subject_dir, image_type=image_type)
 
-    matches = sub1_images.intersection(sub2_images)
+    matches = sorted(sub1_images.intersection(sub2_images))
     return seg_map(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir, matches,
-                   parameter_maps=parameter_maps, strict=strict)
+                   parameter_maps=parameter_maps, strict=strict, cache=cache, n_workers=n_workers,
+                   io_threads=io_threads, output_dir=output_dir, raw_store=raw_store)
+
+
+def iter_seg_map(segmented_subject_dir, unsegmented_subject_dir, segmentation_dir, filenames, parameter_maps=None,
+                 strict=False, cache=None, n_workers=1, io_threads=2, output_dir=None, executor=None, ordered=False,
+                 raw_store=None):
+    """Lazily map segmentations for supplied filenames
+
+    Images are loaded on a pool of I/O threads ahead of use while earlier file pairs are being registered, either
+    in this process or across a pool of worker processes. Only a bounded number of file pairs are loaded ahead, so
+    memory does not grow with the number of files.
+
+    :param segmented_subject_dir: Directory with data of segmented image
+    :param unsegmented_subject_dir: Directory with data of unsegmented_image
+    :param segmentation_dir: Directory with data of segmented image segmentation
+    :param filenames: Iterable of filenames to map
+    :param parameter_maps: Optional vector of 3 parameter maps to be used for
+                           registration. If none are provided, a default vector
+                           of [rigid, affine, bspline] parameter maps is used.
+    :param strict: Default False. If True, a ValueError will be raised when some filename is not present in every
+                   supplied directory.
+    :param cache: Optional RegistrationCache for registrations and transformations.
+    :param n_workers: Optional number of worker processes to register file pairs on. Defaults to 1 (serial).
+                      If 'auto', chosen by amsaf.scheduler.plan.
+    :param io_threads: Optional number of threads loading images ahead of
+                       registration. If 0, images are read inline when
+                       registration needs them.
+    :param output_dir: Optional directory to write each segmentation to, under its filename. If given, paths of
+                       the written segmentations are yielded instead of images, and workers write them directly.
+    :param raw_store: Optional RawStore images are read through, see read_image.
+    :param executor: Optional concurrent.futures.Executor to register file pairs on instead of creating a process
+                     pool. Set n_workers to its number of workers.
+    :param ordered: If True, results are yielded in the order of filenames rather than as they finish.
+
+    :returns: Stream of (filename, segmentation) pairs
+    :rtype: generator
+    """
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if parameter_maps:
+        parameter_maps = [_pm_to_dict(pm) for pm in parameter_maps]
+
+    def file_triples():
+        for f in filenames:
+            paths = (os.path.join(unsegmented_subject_dir, f),
+                     os.path.join(segmented_subject_dir, f),
+                     os.path.join(segmentation_dir, f))
+            if not all([os.path.isfile(path) for path in paths]):
+                if strict:
+                    raise ValueError("File {} is not in all supplied directories".format(f))
+                continue
+            yield f, paths
+
+    def load(triple):
+        f, paths = triple
+        output_path = os.path.join(output_dir, f) if output_dir else None
+        return f, tuple(read_image(path, raw_store=raw_store) for path in paths), parameter_maps, output_path
+
+    n_workers = _resolve_workers(n_workers, len(filenames) if hasattr(filenames, '__len__') else None)
+    depth = io_threads + 2 * max(1, n_workers)
+    tasks = _prefetch(load, file_triples(), io_threads, depth)
+    if n_workers > 1 or executor is not None:
+        results = _parallel_map(_seg_map_task, tasks, None, n_workers=n_workers, executor=executor,
+                                ordered=ordered, cache=cache)
+    else:
+        results = (_seg_map_task(task, cache=cache) for task in tasks)
+    for f, seg, events in results:
+        profiling.replay(events)
+        yield f, seg
+
 
 def split_x(img, midpoint_x, padding=False):
     """Splits image into two separate images along an x-plane
     Returns both halves of the image, returning the image with lower x values first
 
+    Halves keep the pixel type, spacing, origin and direction of img. With
+    padding, each half is zero padded back to the size of img without
+    upcasting its pixels.
+
     :param img: Image to be split
     :param midpoint_x: x value specifying plane to split image along
     :param padding: Optional boolean to specify zero padding
@@ -424,24 +1107,16 @@ def split_x(img, midpoint_x, padding=False):
     :type padding: bool
     :rtype: (SimpleITK.Image, SimpleITK.Image)
     """
-    data = sitk.GetArrayFromImage(img)
-    if padding:
-        data1 = np.zeros(data.shape)
-        data2 = np.zeros(data.shape)
-        data1[:, :, :midpoint_x] = data[:, :, :midpoint_x]
-        data2[:, :, midpoint_x:] = data[:, :, midpoint_x:]
-    else:
-        data1 = data[:midpoint_x, :, :]
-        data2 = data[midpoint_x:, :, :]
-
-    crop1 = sitk.GetImageFromArray(data1)
-    crop2 = sitk.GetImageFromArray(data2)
-    return crop1, crop2
+    return _split(img, 0, midpoint_x, padding)
 
 def split_y(img, midpoint_y, padding=False):
     """Splits image into two separate images along an y-plane
     Returns both halves of the image, returning the image with lower y values first
 
+    Halves keep the pixel type, spacing, origin and direction of img. With
+    padding, each half is zero padded back to the size of img without
+    upcasting its pixels.
+
     :param img: Image to be split
     :param midpoint_y: y value specifying plane to split image along
     :param padding: Optional boolean to specify zero padding
@@ -450,24 +1125,17 @@ def split_y(img, midpoint_y, padding=False):
     :type padding: bool
     :rtype: (SimpleITK.Image, SimpleITK.Image)
     """
-    data = sitk.GetArrayFromImage(img)
-    if padding:
-        data1 = np.zeros(data.shape)
-        data2 = np.zeros(data.shape)
-        data1[:, :midpoint_y, :] = data[:, :midpoint_y, :]
-        data2[:, midpoint_y:, :] = data[:, midpoint_y:, :]
-    else:
-        data1 = data[:, :midpoint_y, :]
-        data2 = data[:, midpoint_y:, :]
-    crop1 = sitk.GetImageFromArray(data1)
-    crop2 = sitk.GetImageFromArray(data2)
-    return crop1, crop2
+    return _split(img, 1, midpoint_y, padding)
 
 
 def split_z(img, midpoint_z, padding=False):
     """Splits image into two separate images along an z-plane
     Returns both halves of the image, returning the image with lower z values first
 
+    Halves keep the pixel type, spacing, origin and direction of img. With
+    padding, each half is zero padded back to the size of img without
+    upcasting its pixels.
+
     :param img: Image to be split
     :param midpoint_z: z value specifying plane to split image along
     :param padding: Optional boolean to specify zero padding
@@ -476,22 +1144,16 @@ def split_z(img, midpoint_z, padding=False):
     :type padding: bool
     :rtype: (SimpleITK.Image, SimpleITK.Image)
     """
-    data = sitk.GetArrayFromImage(img)
-    if padding:
-        data1 = np.zeros(data.shape)
-        data2 = np.zeros(data.shape)
-        data1[:midpoint_z, :, :] = data[:midpoint_z, :, :]
-        data2[midpoint_z:, :, :] = data[midpoint_z:, :, :]
-    else:
-        data1 = data[:midpoint_z, :, :]
-        data2 = data[midpoint_z:, :, :]
-    crop1 = sitk.GetImageFromArray(data1)
-    crop2 = sitk.GetImageFromArray(data2)
-    return crop1, crop2
+    return _split(img, 2, midpoint_z, padding)
 
 def crop(img, start, end, padding=False):
     """Crops image along a bounding box specified by start and end
 
+    Only the region inside the bounding box is copied, and the result keeps
+    the pixel type, spacing, direction and physical position of img. With
+    padding, the region is zero padded back to the size of img without
+    upcasting its pixels.
+
     :param img: Image to be cropped
     :param start: Tuple consisting of lower valued coordinates to define bounding box
     :param end: Tuple consisting of higher valued coordinates to define bounding box
@@ -502,14 +1164,47 @@ def crop(img, start, end, padding=False):
     :type padding: bool
     :rtype: SimpleITK.Image
     """
-    data = sitk.GetArrayFromImage(img)
-    if padding:
-        new_array_data = np.zeros(data.shape)
-        new_array_data[start[2]:end[2], start[1]:end[1], start[0]:end[0]] \
-            = data[start[2]:end[2], start[1]:end[1], start[0]:end[0]]
+    return _extract(img, [slice(a, b) for a, b in zip(start, end)], padding)
+
+
+def downsample(img, spacing, label=False):
+    """Resamples image onto a coarser isotropic grid
+
+    The new grid covers the same physical region as img. Axes already
+    coarser than spacing keep their spacing. Intensity images are smoothed
+    before linear resampling so that fine structures are averaged rather
+    than aliased. Label images are resampled with a label Gaussian
+    interpolator, which keeps label values intact and keeps thin labels
+    better than nearest neighbor.
+
+    :param img: Image to be downsampled
+    :param spacing: Target spacing in physical units
+    :param label: Optional boolean to specify that img is a label image
+    :type img: SimpleITK.Image
+    :type spacing: float
+    :type label: bool
+    :rtype: SimpleITK.Image
+    """
+    old_spacing = np.array(img.GetSpacing())
+    new_spacing = np.maximum(old_spacing, spacing)
+    size = np.array(img.GetSize())
+    new_size = np.maximum(1, np.round(size * old_spacing / new_spacing))
+    dim = img.GetDimension()
+    direction = np.array(img.GetDirection()).reshape(dim, dim)
+    # Corner of the first new voxel stays at the corner of the first old one.
+    origin = np.array(img.GetOrigin()) + \
+        direction.dot((new_spacing - old_spacing) / 2.0)
+
+    if label:
+        interpolator = sitk.sitkLabelGaussian
     else:
-        new_array_data = data[start[2]:end[2], start[1]:end[1], start[0]:end[0]]
-    return sitk.GetImageFromArray(new_array_data)
+        interpolator = sitk.sitkLinear
+        variance = ((new_spacing - old_spacing) / 2.0) ** 2
+        if np.any(variance > 0):
+            img = sitk.DiscreteGaussian(img, variance.tolist())
+    return sitk.Resample(img, [int(n) for n in new_size], sitk.Transform(),
+                         interpolator, origin.tolist(), new_spacing.tolist(),
+                         img.GetDirection(), 0, img.GetPixelID())
 
 
 def init_affine_transform(img, transform, center=None):
@@ -560,6 +1255,647 @@ def _image_set(dirname, image_type='volume'):
     return set(os.path.basename(image) for image in images)
 
 
+def _param_vectors(parameter_priors):
+    for rpm in ParameterGrid(parameter_priors[0]):
+        for apm in ParameterGrid(parameter_priors[1]):
+            for bpm in ParameterGrid(parameter_priors[2]):
+                yield _prior_vector([rpm, apm, bpm])
+
+
+def _scaled_priors(parameter_priors, fraction, keys):
+    # Priors whose grid holds the candidates of parameter_priors with the
+    # budget keys scaled by fraction, including keys left at their Elastix
+    # defaults. Values that scale to the same value are merged.
+    result = []
+    for prior, ttype in zip(parameter_priors, ['rigid', 'affine', 'bspline']):
+        prior = dict(prior)
+        default = sitk.GetDefaultParameterMap(ttype)
+        for k in keys:
+            if k not in prior and k in default:
+                prior[k] = [list(default[k])]
+        for k in keys:
+            if k not in prior:
+                continue
+            values = []
+            for v in prior[k]:
+                nested = isinstance(v, (list, tuple))
+                scaled = scale_budget({k: v if nested else [v]}, fraction,
+                                      [k])[k]
+                scaled = list(scaled) if nested else scaled[0]
+                if scaled not in values:
+                    values.append(scaled)
+            prior[k] = values
+        result.append(prior)
+    return result
+
+
+def _prior_vector(pms):
+    with profiling.stage('parameter_maps'):
+        return [_to_elastix(pm, ttype)
+                for pm, ttype in zip(pms, ['rigid', 'affine', 'bspline'])]
+
+
+def _pm_to_dict(pm):
+    # SWIG ParameterMaps can't be pickled, so they are sent to worker
+    # processes as plain dicts of tuples.
+    return dict((k, tuple(v)) for k, v in pm.items())
+
+
+def _to_parameter_map(d):
+    pm = sitk.ParameterMap()
+    for k, v in d.items():
+        pm[k] = tuple(v)
+    return pm
+
+
+def _threads_per_worker(n_workers):
+    return scheduler.threads_per_job(n_workers)
+
+
+def _resolve_workers(n_workers, n_tasks=None):
+    if n_workers == 'auto':
+        return scheduler.plan(n_tasks)[0]
+    return n_workers
+
+
+_WORKER_IMAGES = None
+
+
+def _init_worker(images, num_threads):
+    global _WORKER_IMAGES
+    _WORKER_IMAGES = images
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def _eval_candidate(parameter_maps, images=None, verbose=False,
+                    num_threads=None, cache=None):
+    if images is None:
+        images = _WORKER_IMAGES
+    unsegmented_image, scorer, segmented_image, segmentation = images
+    start = time.time()
+    with profiling.collect() as events:
+        seg = segment(unsegmented_image, segmented_image, segmentation,
+                      parameter_maps, verbose=verbose, num_threads=num_threads,
+                      cache=cache)
+        score = _score(seg, scorer)
+    return [parameter_maps, seg, _timed(score, start), events]
+
+
+def _journaled(journal, vectors, run):
+    # Yield the recorded results of vectors found in the journal, then the
+    # results of run(skip), recording each as it arrives.
+    if journal is None:
+        for result in run(frozenset()):
+            yield result
+        return
+    skip = journal.completed()
+    for pms in vectors:
+        key = vector_key(pms)
+        if key in skip:
+            yield journal.load(key)
+    for result in run(skip):
+        journal.record(result)
+        yield result
+
+
+def _print_proxy_report(summary):
+    spearman = summary['spearman']
+    sys.stdout.write('Proxy screening: {} candidates screened, {} promoted, '
+                     'Spearman rank correlation {}\n'.format(
+                         summary['n_screened'], summary['n_promoted'],
+                         'n/a' if spearman is None else
+                         '{:.3f}'.format(spearman)))
+
+
+def _recorded(database, inputs, journal, vectors, run):
+    # Like _journaled, for a ResultsDatabase shared between runs. Recorded
+    # results whose segmentation can't be read are yielded with None in its
+    # place, so that searches can rank them, and are left out by amsaf_eval.
+    if database is None:
+        for result in run(frozenset()):
+            yield result
+        return
+    skip = database.completed(inputs)
+    for pms in vectors:
+        key = vector_key(pms)
+        if key in skip:
+            result = database.load(inputs, key, missing_ok=True)
+            if result is not None:
+                yield result
+    for result in run(skip):
+        location = None
+        if journal is not None:
+            record = journal.records.get(vector_key(result[0]))
+            if record is not None:
+                location = os.path.join(journal.run_dir, record['seg'])
+        database.record(inputs, result, location=location)
+        yield result
+
+
+def _eval_vectors(images, vectors, verbose=False, n_workers=1, executor=None,
+                  ordered=False, cache=None, cost=None):
+    if n_workers > 1 or executor is not None:
+        if cost is not None:
+            vectors = sorted(vectors, key=cost, reverse=True)
+        vectors = ([_pm_to_dict(pm) for pm in pms] for pms in vectors)
+        results = _parallel_map(_eval_candidate, vectors, images,
+                                n_workers=n_workers, executor=executor,
+                                ordered=ordered, verbose=verbose, cache=cache)
+        for pms, seg, score, events in results:
+            pms = [_to_parameter_map(pm) for pm in pms]
+            profiling.replay(events, vector_key(pms))
+            yield [pms, seg, score]
+    else:
+        for pms in vectors:
+            pms, seg, score, events = _eval_candidate(pms, images,
+                                                      verbose=verbose,
+                                                      cache=cache)
+            profiling.replay(events, vector_key(pms))
+            yield [pms, seg, score]
+
+
+def _eval_stage_tree(images, parameter_priors, skip=frozenset(),
+                     verbose=False, n_workers=1, executor=None, ordered=False,
+                     cache=None, prune=None, report=None, cost=None):
+    stats = dict.fromkeys(_PRUNE_STATS, 0)
+    if n_workers > 1 or executor is not None:
+        rigid_grid = list(ParameterGrid(parameter_priors[0]))
+        if cost is not None:
+            rigid_grid.sort(key=lambda rpm: -sum(
+                cost(pms) for pms in
+                _param_vectors(_subtree_priors(rpm, parameter_priors))))
+
+        def rigid_key(rpm):
+            return vector_key([_to_elastix(rpm, 'rigid')])
+
+        rigid_tpms = dict.fromkeys(rigid_key(rpm) for rpm in rigid_grid)
+        if prune:
+            # Rigid maps are pruned against each other, so all rigid stages
+            # are registered and scored before any subtree is handed out.
+            tasks = ((_subtree_priors(rpm, parameter_priors), skip)
+                     for rpm in rigid_grid)
+            results = _parallel_map(_eval_rigid_stage, tasks, images,
+                                    n_workers=n_workers, executor=executor,
+                                    verbose=verbose, cache=cache)
+            rigid = []
+            for key, rigid_tpm, score, subtree_cost, events in results:
+                profiling.replay(events)
+                stats['registrations'] += rigid_tpm is not None
+                stats['partial_scores'] += rigid_tpm is not None
+                if rigid_tpm is not None:
+                    rigid.append((key, rigid_tpm, score, subtree_cost))
+            kept = _unpruned([score for _, _, score, _ in rigid], prune)
+            rigid_tpms = {}
+            for (key, rigid_tpm, _, subtree_cost), keep in zip(rigid, kept):
+                if keep:
+                    rigid_tpms[key] = rigid_tpm
+                else:
+                    stats['rigid_pruned'] += 1
+                    stats['registrations_saved'] += subtree_cost
+        tasks = ((_subtree_priors(rpm, parameter_priors), skip, prune,
+                  rigid_tpms[rigid_key(rpm)])
+                 for rpm in rigid_grid if rigid_key(rpm) in rigid_tpms)
+        results = _parallel_map(_eval_subtree, tasks, images,
+                                n_workers=n_workers, executor=executor,
+                                ordered=ordered, verbose=verbose, cache=cache)
+        for subtree, events, subtree_stats in results:
+            profiling.replay(events)
+            for k in _PRUNE_STATS:
+                stats[k] += subtree_stats[k]
+            for pms, seg, score in subtree:
+                yield [[_to_parameter_map(pm) for pm in pms], seg, score]
+    else:
+        for result in _stage_tree(images, parameter_priors, skip=skip,
+                                  verbose=verbose, cache=cache, prune=prune,
+                                  stats=stats):
+            yield result
+    if prune and report is not None:
+        report(stats)
+
+
+def _seg_map_task(task, images=None, verbose=False, num_threads=None,
+                  cache=None):
+    f, (unsegmented_image, segmented_image, segmentation), parameter_maps, \
+        output_path = task
+    with profiling.collect() as events:
+        seg = segment(unsegmented_image, segmented_image, segmentation,
+                      parameter_maps, verbose=verbose, num_threads=num_threads,
+                      cache=cache)
+        if output_path:
+            with profiling.stage('write', seg.GetNumberOfPixels()):
+                write_image(seg, output_path)
+            seg = output_path
+    return f, seg, events
+
+
+def _prefetch(fn, iterable, n_threads, depth):
+    # Lazily yield fn(x) for x in iterable, computing up to depth results
+    # ahead on a thread pool. Without threads, each is computed when asked
+    # for.
+    if n_threads < 1:
+        for x in iterable:
+            yield fn(x)
+        return
+    pool = ThreadPoolExecutor(n_threads)
+    pending = deque()
+    try:
+        for x in iterable:
+            pending.append(pool.submit(fn, x))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for f in pending:
+            f.cancel()
+        pool.shutdown()
+
+
+def _score(seg, scorer):
+    if scorer is None:
+        return 0
+    with profiling.stage('scoring', seg.GetNumberOfPixels()):
+        return scorer(seg)
+
+
+def _timed(score, start):
+    if not isinstance(score, Score):
+        score = Score(score)
+    score.runtime = time.time() - start
+    return score
+
+
+def _subtree_priors(rpm, parameter_priors):
+    rigid_prior = dict((k, [v]) for k, v in rpm.items())
+    return [rigid_prior, parameter_priors[1], parameter_priors[2]]
+
+
+def _eval_subtree(task, images=None, verbose=False, num_threads=None,
+                  cache=None):
+    if images is None:
+        images = _WORKER_IMAGES
+    parameter_priors, skip, prune, rigid_tpm = task
+    rigid_tpms = None
+    if rigid_tpm is not None:
+        rigid_tpms = [_to_parameter_map(rigid_tpm)]
+    stats = dict.fromkeys(_PRUNE_STATS, 0)
+    with profiling.collect() as events:
+        subtree = [[[_pm_to_dict(pm) for pm in pms], seg, score]
+                   for pms, seg, score in _stage_tree(images, parameter_priors,
+                                                      skip=skip, verbose=verbose,
+                                                      num_threads=num_threads,
+                                                      cache=cache, prune=prune,
+                                                      rigid_tpms=rigid_tpms,
+                                                      stats=stats)]
+    return subtree, events, stats
+
+
+def _eval_rigid_stage(task, images=None, verbose=False, num_threads=None,
+                      cache=None):
+    # Registers and scores the rigid stage of a one-rigid-map subtree. The
+    # transform is None if every candidate of the subtree is skipped.
+    if images is None:
+        images = _WORKER_IMAGES
+    parameter_priors, skip = task
+    unsegmented_image, scorer, segmented_image, segmentation = images
+    rpm = _to_elastix(next(iter(ParameterGrid(parameter_priors[0]))), 'rigid')
+    cost = _subtree_cost(rpm, parameter_priors, skip)
+    rigid_tpm, score = None, None
+    with profiling.collect() as events:
+        if cost:
+            _, tpms = register_indv(unsegmented_image, segmented_image,
+                                    'rigid', rpm, verbose=verbose,
+                                    num_threads=num_threads, cache=cache)
+            rigid_tpm = tpms[0]
+            score = _partial_score(images, [rigid_tpm], verbose=verbose,
+                                   num_threads=num_threads, cache=cache)
+            rigid_tpm = _pm_to_dict(rigid_tpm)
+    return vector_key([rpm]), rigid_tpm, score, cost - 1, events
+
+
+_PRUNE_STATS = ('registrations', 'registrations_saved', 'partial_scores',
+                'rigid_pruned', 'affine_pruned')
+
+
+def _subtree_cost(rpm, parameter_priors, skip):
+    # Number of registrations needed for the unskipped candidates below a
+    # rigid map: the rigid map itself, and each affine map with its bsplines.
+    cost = 0
+    for apm in ParameterGrid(parameter_priors[1]):
+        apm = _to_elastix(apm, 'affine')
+        n = sum(1 for bpm in ParameterGrid(parameter_priors[2])
+                if vector_key([rpm, apm, _to_elastix(bpm, 'bspline')])
+                not in skip)
+        if n:
+            cost += 1 + n
+    return cost + 1 if cost else 0
+
+
+def _partial_score(images, tpms, verbose=False, num_threads=None, cache=None):
+    # Score of the segmentation mapped by the transforms of a stage prefix.
+    _, scorer, _, segmentation = images
+    seg = transform(segmentation, _nn_assoc(_no_initial_transform_assoc(tpms)),
+                    verbose=verbose, cache=cache, num_threads=num_threads)
+    return float(_score(seg, scorer))
+
+
+def _unpruned(scores, prune):
+    # Whether each of a set of sibling prefixes survives pruning: its partial
+    # score must reach the threshold and the quantile of its siblings' scores.
+    cut = prune.get('threshold')
+    quantile = prune.get('quantile')
+    if quantile is not None and scores:
+        q = float(np.percentile(scores, 100 * quantile))
+        cut = q if cut is None else max(cut, q)
+    return [cut is None or score >= cut for score in scores]
+
+
+def _print_eta(seconds, n_candidates, n_workers):
+    sys.stdout.write('Estimated time for {} candidates on {} worker(s): '
+                     '{:.0f}s\n'.format(n_candidates, max(1, n_workers),
+                                        seconds))
+
+
+def _print_prune_report(stats):
+    total = stats['registrations'] + stats['registrations_saved']
+    sys.stdout.write(
+        'Pruning: {} rigid maps and {} affine prefixes pruned, {} of {} '
+        'Elastix registrations saved for {} partial scores\n'.format(
+            stats['rigid_pruned'], stats['affine_pruned'],
+            stats['registrations_saved'], total, stats['partial_scores']))
+
+
+def _stage_tree(images, parameter_priors, skip=frozenset(), verbose=False,
+                num_threads=None, cache=None, prune=None, rigid_tpms=None,
+                stats=None):
+    """Evaluate the rigid x affine x bspline product as a prefix tree.
+
+    Every rigid map and every (rigid, affine) prefix is registered once. Each
+    stage starts from the transform of its parent, which is written to a
+    scratch directory for Elastix to read, so a full candidate costs a single
+    bspline registration instead of three. Candidates whose keys are in skip
+    are left out, along with any prefix that only leads to skipped
+    candidates.
+
+    With prune, the sibling rigid maps, and the sibling affine maps below each
+    rigid map, are all registered and scored with the segmentation mapped by
+    their prefix before going deeper, and prefixes scoring below the cut of
+    _unpruned are dropped along with their subtrees. rigid_tpms are the
+    transforms of the rigid maps if these were registered and pruned
+    already. Counts of registrations run and saved are added to stats.
+    """
+    unsegmented_image, scorer, segmented_image, segmentation = images
+    if stats is None:
+        stats = dict.fromkeys(_PRUNE_STATS, 0)
+    workdir = tempfile.mkdtemp(prefix='amsaf-')
+
+    def stage_path(i):
+        return os.path.join(workdir, 'stage-{}.txt'.format(i))
+
+    def run_stage(pm, ttype, chain, prefix):
+        initial_transform = None
+        if chain:
+            initial_transform = stage_path(len(chain) - 1)
+        _, tpm = register_indv(unsegmented_image, segmented_image, ttype, pm,
+                               verbose=verbose, num_threads=num_threads,
+                               initial_transform=initial_transform,
+                               cache=cache,
+                               initial_key=vector_key(prefix) if prefix
+                               else None)
+        stats['registrations'] += 1
+        return tpm[0]
+
+    def save_stage(tpm, chain):
+        # The stage starts from the stage file of its parent in this run's
+        # scratch directory, wherever the map itself came from.
+        tpm = _initial_transform_assoc(
+            [tpm], stage_path(len(chain) - 1) if chain else None)[0]
+        sitk.WriteParameterFile(tpm, stage_path(len(chain)))
+
+    def run_siblings(pms, ttype, chain, prefix, cost):
+        # (pm, tpm) pairs of sibling prefixes, registered lazily unless they
+        # are pruned against each other.
+        prefixes = ((pm, run_stage(pm, ttype, chain, prefix)) for pm in pms)
+        if not prune:
+            return prefixes
+        prefixes = list(prefixes)
+        scores = [_partial_score(images, chain + [tpm], verbose=verbose,
+                                 num_threads=num_threads, cache=cache)
+                  for _, tpm in prefixes]
+        stats['partial_scores'] += len(prefixes)
+        kept = []
+        for prefix, keep in zip(prefixes, _unpruned(scores, prune)):
+            if keep:
+                kept.append(prefix)
+            else:
+                stats[ttype + '_pruned'] += 1
+                stats['registrations_saved'] += cost(prefix[0])
+        return kept
+
+    rigid_pms = [_to_elastix(pm, 'rigid')
+                 for pm in ParameterGrid(parameter_priors[0])]
+    affine_pms = [_to_elastix(pm, 'affine')
+                  for pm in ParameterGrid(parameter_priors[1])]
+    bspline_pms = [_to_elastix(pm, 'bspline')
+                   for pm in ParameterGrid(parameter_priors[2])]
+
+    def pending(rpm, apm):
+        return [bpm for bpm in bspline_pms
+                if vector_key([rpm, apm, bpm]) not in skip]
+
+    def rigid_cost(rpm):
+        return sum(1 + len(pending(rpm, apm)) for apm in affine_pms
+                   if pending(rpm, apm))
+
+    rigid_pms = [rpm for rpm in rigid_pms if rigid_cost(rpm)]
+
+    # Each candidate is charged for the time since the previous one, so
+    # shared rigid and affine stages count towards the first candidate that
+    # needs them.
+    start = time.time()
+    try:
+        if rigid_tpms is not None:
+            rigid = zip(rigid_pms, rigid_tpms)
+        else:
+            rigid = run_siblings(rigid_pms, 'rigid', [], [], rigid_cost)
+        for rpm, rigid_tpm in rigid:
+            save_stage(rigid_tpm, [])
+            affine = run_siblings(
+                [apm for apm in affine_pms if pending(rpm, apm)], 'affine',
+                [rigid_tpm], [rpm], lambda apm: len(pending(rpm, apm)))
+            for apm, affine_tpm in affine:
+                save_stage(affine_tpm, [rigid_tpm])
+                for bpm in pending(rpm, apm):
+                    bspline_tpm = run_stage(bpm, 'bspline',
+                                            [rigid_tpm, affine_tpm],
+                                            [rpm, apm])
+                    tpms = _no_initial_transform_assoc(
+                        [rigid_tpm, affine_tpm, bspline_tpm])
+                    seg = transform(segmentation, _nn_assoc(tpms),
+                                    verbose=verbose, cache=cache,
+                                    num_threads=num_threads)
+                    yield [[rpm, apm, bpm], seg,
+                           _timed(_score(seg, scorer), start)]
+                    start = time.time()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _parallel_map(fn, iterable, images, n_workers=1, executor=None,
+                  ordered=False, verbose=False, cache=None):
+    """Lazily evaluate fn(x, images) for x in iterable on a process pool.
+
+    If no executor is supplied, one is created whose workers receive images
+    once at startup; a caller-supplied executor receives images with every
+    task and is assumed to have n_workers workers. At most two tasks per
+    worker are in flight, so results don't pile up faster than they are
+    consumed.
+    """
+    own_executor = executor is None
+    num_threads = _threads_per_worker(n_workers)
+    if own_executor:
+        executor = ProcessPoolExecutor(n_workers, initializer=_init_worker,
+                                       initargs=(images, num_threads))
+        task_images = None
+    else:
+        task_images = images
+
+    window = 2 * max(1, n_workers)
+    it = iter(iterable)
+    pending = deque()
+
+    def fill():
+        for x in it:
+            pending.append(executor.submit(fn, x, task_images, verbose,
+                                           num_threads, cache))
+            if len(pending) >= window:
+                break
+
+    try:
+        fill()
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    pending.remove(f)
+            for f in done:
+                yield f.result()
+            fill()
+    finally:
+        for f in pending:
+            f.cancel()
+        if own_executor:
+            executor.shutdown()
+
+
+def _execute(image_filter):
+    # Elastix and Transformix write their transform parameter files and
+    # result images to the output directory, which defaults to the working
+    # directory and would be shared by concurrent calls.
+    output_dir = tempfile.mkdtemp(prefix='amsaf-')
+    try:
+        image_filter.SetOutputDirectory(output_dir)
+        image_filter.Execute()
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def _remove_results(path, n):
+    # Removes the result-i directories of an earlier run for i >= n.
+    for result_path in glob.glob(os.path.join(path, 'result-*')):
+        i = os.path.basename(result_path)[len('result-'):]
+        if i.isdigit() and int(i) >= n:
+            shutil.rmtree(result_path)
+
+
+def _atomic_write(path, write):
+    # The temporary name keeps the extension, which ITK uses to pick a format.
+    dirname, basename = os.path.split(path)
+    tmp_path = os.path.join(dirname, '.tmp-{}-{}'.format(os.getpid(), basename))
+    try:
+        write(tmp_path)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _split(img, axis, midpoint, padding):
+    lower = [slice(None)] * img.GetDimension()
+    upper = [slice(None)] * img.GetDimension()
+    lower[axis] = slice(None, midpoint)
+    upper[axis] = slice(midpoint, None)
+    return _extract(img, lower, padding), _extract(img, upper, padding)
+
+
+def _extract(img, region, padding):
+    # SimpleITK slicing copies only the region and shifts the origin so the
+    # region stays in place physically. Padding it back out with zeros
+    # restores the original grid.
+    region = [slice(*r.indices(n)[:2]) for r, n in zip(region, img.GetSize())]
+    result = img[tuple(region)]
+    if padding:
+        lower = [r.start for r in region]
+        upper = [n - r.stop for r, n in zip(region, img.GetSize())]
+        result = sitk.ConstantPad(result, lower, upper, 0)
+    return result
+
+
+def _physical_bounding_box(segmentation, margin):
+    # Lower and upper physical corners of the labels' bounding box, grown by
+    # margin. None if there are no labels.
+    data = sitk.GetArrayViewFromImage(segmentation)
+    nonzero = np.nonzero(data)
+    if not len(nonzero[0]):
+        return None
+    # Array axes are (z, y, x), the reverse of SimpleITK's order.
+    lower = [int(idx.min()) for idx in nonzero][::-1]
+    upper = [int(idx.max()) for idx in nonzero][::-1]
+    corners = np.array([
+        segmentation.TransformIndexToPhysicalPoint(
+            tuple(u if bit else l for l, u, bit in zip(lower, upper, bits)))
+        for bits in itertools.product([0, 1], repeat=len(lower))])
+    return corners.min(axis=0) - margin, corners.max(axis=0) + margin
+
+
+def _crop_physical(img, box):
+    # Smallest region of img covering a physical box, keeping its place in
+    # physical space.
+    lower, upper = box
+    corners = [img.TransformPhysicalPointToContinuousIndex(
+        tuple(u if bit else l for l, u, bit in zip(lower, upper, bits)))
+        for bits in itertools.product([0, 1], repeat=len(lower))]
+    corners = np.array(corners)
+    start = np.maximum(np.floor(corners.min(axis=0)).astype(int), 0)
+    stop = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + 1,
+                      img.GetSize())
+    if np.any(stop <= start):
+        return img
+    return _extract(img, [slice(int(a), int(b)) for a, b in zip(start, stop)],
+                    False)
+
+
+def _grid_assoc(pms, image):
+    # Transformix resamples onto the grid named in the transform parameter
+    # maps, so pointing them at image puts the result on image's grid.
+    grid = {
+        'Size': [str(n) for n in image.GetSize()],
+        'Index': ['0'] * image.GetDimension(),
+        'Spacing': [repr(float(x)) for x in image.GetSpacing()],
+        'Origin': [repr(float(x)) for x in image.GetOrigin()],
+        'Direction': [repr(float(x)) for x in image.GetDirection()],
+    }
+    result = []
+    for pm in pms:
+        pm = dict((k, list(v)) for k, v in pm.items())
+        pm.update(grid)
+        result.append(pm)
+    return result
+
+
 def _to_elastix(pm, ttype):
     elastix_pm = sitk.GetDefaultParameterMap(ttype)
     if sys.version_info[0] >=3:
@@ -574,17 +1910,6 @@ def _to_elastix(pm, ttype):
     return elastix_pm
 
 
-def _sim_score(candidate, ground_truth):
-    candidate = sitk.Cast(candidate, ground_truth.GetPixelID())
-    candidate.CopyInformation(ground_truth)
-
-    overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
-    overlap_filter.Execute(ground_truth, candidate)
-    return overlap_filter.GetDiceCoefficient()
-
-
-
-
 def _nn_assoc(pms):
     return _pm_vec_assoc('ResampleInterpolator',
                          'FinalNearestNeighborInterpolator', pms)
@@ -600,6 +1925,34 @@ def _auto_init_assoc_indv(pm):
     return _pm_assoc('AutomaticTransformInitialization', 'true', pm)
 
 
+def _initial_transform_assoc(pms, path):
+    # Copies of transform parameter maps starting from the transform in the
+    # file at path, or from none.
+    result = []
+    for pm in pms:
+        pm = _to_parameter_map(_pm_to_dict(pm))
+        for k in ['InitialTransformParameterFileName',
+                  'InitialTransformParametersFileName']:
+            if k in pm:
+                pm[k] = (path or 'NoInitialTransform',)
+        result.append(pm)
+    return result
+
+
+def _canonical_parameter_file(path):
+    pm = sitk.ReadParameterFile(path)
+    return canonical_parameter_map(_initial_transform_assoc([pm], None)[0])
+
+
+def _no_initial_transform_assoc(pms):
+    # Transformix chains a vector of maps itself, so links to transform files
+    # on disk are dropped. Older Elastix spells the key with "Parameters".
+    for k in ['InitialTransformParameterFileName',
+              'InitialTransformParametersFileName']:
+        pms = _pm_vec_assoc(k, 'NoInitialTransform', pms)
+    return pms
+
+
 def _pm_assoc(k, v, pm):
     result = {}
     if sys.version_info[0] >=3:
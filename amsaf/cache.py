@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: cache
+   :synopsis: Caches for Elastix results and decoded images
+
+Registrations and transformations are keyed by a hash of their input images
+and canonicalized parameter maps, so repeated runs over the same volumes only
+pay for combinations that haven't been computed before. Entries are stored as
+plain Elastix parameter files and .mha images and evicted least recently used
+first once the cache grows past its size cap.
+
+Decoded images are kept in a process-wide in-memory LRU cache used by
+read_image, keyed by file path, modification time, size and pixel type. It
+is disabled until given a byte budget with configure_image_cache.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import SimpleITK as sitk
+
+
+# Elastix seeds its samplers with this value when RandomSeed is unset, so
+# pinning it keeps cached and uncached results identical.
+DEFAULT_RANDOM_SEED = '121212'
+
+_IMAGE_FILENAME = 'result.mha'
+_PARAMETER_FILENAME = 'transform-parameter-file-{}.txt'
+# Number of stores between measurements of a capped RegistrationCache.
+_RESIZE_PUTS = 64
+
+
+class RegistrationCache(object):
+    """Persistent cache of register, register_indv and transform results
+
+    :param path: Directory the cache lives in. Created if missing.
+    :param max_bytes: Optional size cap in bytes. When exceeded, least
+                      recently used entries are evicted. The size is
+                      tracked as entries are stored and measured again every
+                      64 stores, so entries stored by other processes in
+                      between may take the cache over the cap for a while.
+    :type path: str
+    :type max_bytes: int
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_bytes = max_bytes
+        self._size = None
+        self._puts = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def key(self, *parts):
+        """Hash images, parameter maps and plain values into a cache key
+
+        :rtype: str
+        """
+        h = hashlib.sha1()
+        for part in parts:
+            h.update(_digest(part).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Look up a cached (result_image, transform_parameter_maps) pair
+
+        Either element may be None if it wasn't stored.
+
+        :returns: The cached pair, or None on a miss
+        :rtype: (SimpleITK.Image, [SimpleITK.ParameterMap])
+        """
+        entry = self._entry_path(key)
+        if not os.path.isdir(entry):
+            return None
+        try:
+            image = None
+            image_path = os.path.join(entry, _IMAGE_FILENAME)
+            if os.path.isfile(image_path):
+                image = sitk.ReadImage(image_path)
+            parameter_maps = []
+            i = 0
+            while os.path.isfile(os.path.join(entry,
+                                              _PARAMETER_FILENAME.format(i))):
+                parameter_maps.append(sitk.ReadParameterFile(
+                    os.path.join(entry, _PARAMETER_FILENAME.format(i))))
+                i += 1
+        except (OSError, IOError, RuntimeError):
+            # Evicted by another process while we were reading.
+            return None
+        _touch(entry)
+        return image, tuple(parameter_maps) if parameter_maps else None
+
+    def put(self, key, image=None, parameter_maps=None):
+        """Store a result under key
+
+        Entries are written to a scratch directory and renamed into place, so
+        concurrent workers never observe a partial entry.
+
+        :type key: str
+        :type image: SimpleITK.Image
+        :type parameter_maps: [SimpleITK.ParameterMap]
+        :rtype: None
+        """
+        entry = self._entry_path(key)
+        if os.path.isdir(entry):
+            _touch(entry)
+            return
+        parent = os.path.dirname(entry)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass
+        scratch = tempfile.mkdtemp(prefix='.tmp-', dir=self.path)
+        try:
+            if image is not None:
+                sitk.WriteImage(image, os.path.join(scratch, _IMAGE_FILENAME))
+            for i, pm in enumerate(parameter_maps or []):
+                sitk.WriteParameterFile(
+                    pm, os.path.join(scratch, _PARAMETER_FILENAME.format(i)))
+            os.rename(scratch, entry)
+        except OSError:
+            # Another worker stored the same entry first.
+            shutil.rmtree(scratch, ignore_errors=True)
+            return
+        if self.max_bytes is None:
+            return
+        self._puts += 1
+        if self._size is None or self._puts % _RESIZE_PUTS == 0:
+            self.evict(self.max_bytes)
+            return
+        self._size += _dir_size(entry)
+        if self._size > self.max_bytes:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        """Evict least recently used entries until the cache fits in max_bytes
+
+        :type max_bytes: int
+        :rtype: None
+        """
+        entries = []
+        total = 0
+        for entry in self._entries():
+            size = _dir_size(entry)
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+        for _, size, entry in sorted(entries):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        """Remove every entry from the cache
+
+        :rtype: None
+        """
+        for entry in self._entries():
+            shutil.rmtree(entry, ignore_errors=True)
+        self._size = 0
+
+    def size(self):
+        """Total size of cached entries in bytes
+
+        :rtype: int
+        """
+        return sum(_dir_size(entry) for entry in self._entries())
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _entries(self):
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                yield os.path.join(prefix_path, key)
+
+    def __repr__(self):
+        return 'RegistrationCache({!r}, max_bytes={!r})'.format(
+            self.path, self.max_bytes)
+
+
+class ImageCache(object):
+    """Thread-safe in-memory LRU cache of decoded images
+
+    :param max_bytes: Budget for the pixel data of cached images. Least
+                      recently used images are evicted past it; 0 disables
+                      the cache.
+    :type max_bytes: int
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path, pixel_type=None):
+        """Read an image through the cache
+
+        :param path: Path to the image file
+        :param pixel_type: Optional SimpleITK pixel type to cast the image to
+        :type path: str
+        :type pixel_type: int
+        :returns: A copy-on-write copy of the cached image
+        :rtype: SimpleITK.Image
+        """
+        if not self.max_bytes:
+            return _read(path, pixel_type)
+
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (path, st.st_mtime, st.st_size, pixel_type)
+        with self._lock:
+            image = self._entries.pop(key, None)
+            if image is not None:
+                self._entries[key] = image
+                self.hits += 1
+                return sitk.Image(image)
+            self.misses += 1
+
+        image = _read(path, pixel_type)
+        nbytes = _nbytes(image)
+        with self._lock:
+            if key not in self._entries and nbytes <= self.max_bytes:
+                self._entries[key] = image
+                self.nbytes += nbytes
+                self._evict(self.max_bytes)
+        return sitk.Image(image)
+
+    def clear(self):
+        """Drop every cached image
+
+        :rtype: None
+        """
+        with self._lock:
+            self._evict(0)
+
+    def stats(self):
+        """Hit, miss and eviction counts and current size of the cache
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._entries),
+                    'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def _evict(self, max_bytes):
+        while self._entries and self.nbytes > max_bytes:
+            _, image = self._entries.popitem(last=False)
+            self.nbytes -= _nbytes(image)
+            self.evictions += 1
+
+
+IMAGE_CACHE = ImageCache()
+
+
+def configure_image_cache(max_bytes):
+    """Set the byte budget of the process-wide image cache used by read_image
+
+    :param max_bytes: Budget in bytes. 0 disables the cache and drops its
+                      contents.
+    :type max_bytes: int
+    :rtype: None
+    """
+    IMAGE_CACHE.max_bytes = max_bytes
+    with IMAGE_CACHE._lock:
+        IMAGE_CACHE._evict(max_bytes)
+
+
+def image_fingerprint(image):
+    """Hash an image's pixel data and physical metadata
+
+    :type image: SimpleITK.Image
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    h.update(repr((image.GetPixelIDValue(),
+                   image.GetNumberOfComponentsPerPixel(),
+                   image.GetSize(),
+                   image.GetSpacing(),
+                   image.GetOrigin(),
+                   image.GetDirection())).encode('utf-8'))
+    h.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).data)
+    return h.hexdigest()
+
+
+def canonical_parameter_map(pm):
+    """Sorted tuple representation of a parameter map, independent of key
+    order and of whether values are lists, tuples or ParameterMap vectors
+
+    :type pm: SimpleITK.ParameterMap
+    :rtype: tuple
+    """
+    return tuple(sorted((k, tuple(str(x) for x in v)) for k, v in pm.items()))
+
+
+def seeded(pm, seed=DEFAULT_RANDOM_SEED):
+    """Copy of a parameter map with RandomSeed set if it is missing
+
+    :type pm: SimpleITK.ParameterMap
+    :rtype: dict
+    """
+    result = dict((k, tuple(v)) for k, v in pm.items())
+    result.setdefault('RandomSeed', (seed,))
+    return result
+
+
+def _digest(part):
+    if isinstance(part, sitk.Image):
+        return image_fingerprint(part)
+    if hasattr(part, 'items'):
+        return repr(canonical_parameter_map(part))
+    if isinstance(part, (list, tuple)):
+        return repr([_digest(p) for p in part])
+    return repr(part)
+
+
+def _read(path, pixel_type):
+    image = sitk.ReadImage(path)
+    if pixel_type is not None:
+        image = sitk.Cast(image, pixel_type)
+    return image
+
+
+def _nbytes(image):
+    return sitk.GetArrayViewFromImage(image).nbytes
+
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
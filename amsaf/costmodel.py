@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: costmodel
+   :synopsis: Runtime model of parameter map vectors
+
+A CostModel predicts how long a candidate parameter map vector takes to
+register and score from the settings that drive Elastix's work: the
+iterations and spatial samples of each stage, the number of resolutions, the
+bspline control point grid and the number of voxels of the fixed image. It is
+a linear model in a few such work terms, fitted by nonnegative least squares
+to runtimes recorded in a ResultsDatabase or a RunJournal. amsaf_eval uses it
+to estimate how long a sweep will take before it starts, and to hand out the
+longest candidates first when evaluating in parallel so that no long
+candidate is left running on its own at the end of the sweep.
+"""
+
+import heapq
+
+import numpy as np
+from scipy import optimize
+
+
+FEATURES = ('overhead', 'optimization', 'pyramid', 'bspline')
+
+
+class CostModel(object):
+    """Linear runtime model of parameter map vectors
+
+    >>> model = CostModel().add_database(db).fit()
+    >>> model.eta(vectors, unsegmented_image.GetNumberOfPixels(), n_workers=4)
+    """
+
+    def __init__(self):
+        self.samples = []
+        self.coefficients = None
+
+    def add(self, parameter_maps, voxels, runtime):
+        """Add a recorded runtime
+
+        :param parameter_maps: The candidate's parameter map vector
+        :param voxels: Number of voxels of the fixed image it was run on
+        :param runtime: Seconds the candidate took
+        :type parameter_maps: [SimpleITK.ParameterMap]
+        :type voxels: int
+        :type runtime: float
+        :rtype: amsaf.costmodel.CostModel
+        """
+        if runtime is not None and voxels:
+            self.samples.append((features(parameter_maps, voxels),
+                                 float(runtime)))
+        return self
+
+    def add_database(self, database, inputs=None):
+        """Add the runtimes recorded in a ResultsDatabase
+
+        :param database: Database to read runtimes from
+        :param inputs: Optional result of ResultsDatabase.inputs to only
+                       read the runtimes of one set of inputs
+        :type database: amsaf.database.ResultsDatabase
+        :type inputs: tuple
+        :rtype: amsaf.costmodel.CostModel
+        """
+        for parameter_maps, voxels, runtime in database.runtimes(inputs):
+            self.add(parameter_maps, voxels, runtime)
+        return self
+
+    def add_journal(self, journal):
+        """Add the runtimes recorded in a RunJournal
+
+        :type journal: amsaf.journal.RunJournal
+        :rtype: amsaf.costmodel.CostModel
+        """
+        for record in journal.records.values():
+            self.add(record['parameter_maps'], record.get('voxels'),
+                     record.get('runtime'))
+        return self
+
+    @property
+    def fitted(self):
+        return self.coefficients is not None
+
+    def fit(self):
+        """Fit the model to the added runtimes
+
+        With fewer runtimes than features, the model is left unfitted.
+
+        :rtype: amsaf.costmodel.CostModel
+        """
+        if len(self.samples) < len(FEATURES):
+            self.coefficients = None
+            return self
+        x = np.array([f for f, _ in self.samples])
+        y = np.array([t for _, t in self.samples])
+        # Scale columns to comparable magnitudes for the solver.
+        scale = np.maximum(np.abs(x).max(axis=0), 1e-12)
+        coefficients, _ = optimize.nnls(x / scale, y)
+        self.coefficients = coefficients / scale
+        return self
+
+    def predict(self, parameter_maps, voxels):
+        """Predicted runtime of a candidate in seconds
+
+        :type parameter_maps: [SimpleITK.ParameterMap]
+        :type voxels: int
+        :returns: Seconds, or None if the model isn't fitted
+        :rtype: float
+        """
+        if not self.fitted:
+            return None
+        return float(np.dot(self.coefficients,
+                            features(parameter_maps, voxels)))
+
+    def eta(self, vectors, voxels, n_workers=1):
+        """Predicted wall time of evaluating candidates in parallel
+
+        Candidates are assumed to be handed out longest first, each to the
+        worker that frees up first.
+
+        :type vectors: [[SimpleITK.ParameterMap]]
+        :type voxels: int
+        :type n_workers: int
+        :returns: Seconds, or None if the model isn't fitted
+        :rtype: float
+        """
+        if not self.fitted:
+            return None
+        costs = sorted((self.predict(pms, voxels) for pms in vectors),
+                       reverse=True)
+        workers = [0.0] * max(1, n_workers)
+        for cost in costs:
+            heapq.heapreplace(workers, workers[0] + cost)
+        return max(workers)
+
+    def __repr__(self):
+        return 'CostModel({} samples, coefficients={!r})'.format(
+            len(self.samples), self.coefficients)
+
+
+def features(parameter_maps, voxels):
+    """Work terms of a parameter map vector, in the order of FEATURES
+
+    * 'overhead': 1 per stage
+    * 'optimization': Iterations times spatial samples, summed over stages
+    * 'pyramid': Resolutions times voxels, summed over stages
+    * 'bspline': Iterations times control points of bspline stages, with
+      control points estimated from voxels at 1mm spacing
+
+    :type parameter_maps: [SimpleITK.ParameterMap]
+    :type voxels: int
+    :rtype: [float]
+    """
+    overhead = optimization = pyramid = bspline = 0.0
+    for pm in parameter_maps:
+        resolutions = _value(pm, 'NumberOfResolutions', 1)
+        iterations = _value(pm, 'MaximumNumberOfIterations', 0) * resolutions
+        overhead += 1
+        optimization += iterations * _value(pm, 'NumberOfSpatialSamples', 0)
+        pyramid += resolutions * voxels
+        if 'FinalGridSpacingInPhysicalUnits' in pm:
+            spacing = _value(pm, 'FinalGridSpacingInPhysicalUnits', 1)
+            bspline += iterations * voxels / max(spacing, 1e-6) ** 3
+    return [overhead, optimization, pyramid, bspline]
+
+
+def _value(pm, key, default):
+    # Mean of a numeric parameter's values, which may be given per
+    # resolution or per dimension.
+    values = pm[key] if key in pm else ()
+    try:
+        values = [float(v) for v in values]
+    except ValueError:
+        return default
+    return sum(values) / len(values) if values else default
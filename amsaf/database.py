@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: database
+   :synopsis: SQLite index of evaluated parameter map vectors
+
+A ResultsDatabase outlives individual runs and run directories. It records
+every evaluated candidate under the fingerprint of its input images together
+with a canonical hash of its parameter maps (and of each stage's map), its
+score, runtime and where its segmentation was written. amsaf_eval consults
+it to evaluate only combinations that aren't in it yet, so widening a prior
+only pays for the new combinations, and finished sweeps can be queried
+directly, e.g. for the best bspline settings for a subject pair.
+"""
+
+import os
+import json
+import time
+import sqlite3
+
+import SimpleITK as sitk
+
+from .cache import image_fingerprint
+from .journal import vector_key, inputs_fingerprint
+
+
+STAGES = ('rigid', 'affine', 'bspline')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    inputs TEXT NOT NULL,
+    key TEXT NOT NULL,
+    rigid_key TEXT,
+    affine_key TEXT,
+    bspline_key TEXT,
+    unsegmented_image TEXT,
+    ground_truth TEXT,
+    segmented_image TEXT,
+    segmentation TEXT,
+    score REAL NOT NULL,
+    runtime REAL,
+    location TEXT,
+    parameter_maps TEXT NOT NULL,
+    created REAL NOT NULL,
+    voxels INTEGER,
+    PRIMARY KEY (inputs, key)
+);
+CREATE INDEX IF NOT EXISTS results_by_score ON results (inputs, score);
+CREATE INDEX IF NOT EXISTS results_by_pair
+    ON results (unsegmented_image, segmented_image, score);
+'''
+
+
+class ResultsDatabase(object):
+    """Persistent index of evaluated candidates
+
+    :param path: Path to the SQLite database file. Created if missing.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self._conn = sqlite3.connect(self.path)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+        columns = [row['name'] for row in
+                   self._conn.execute('PRAGMA table_info(results)')]
+        if 'voxels' not in columns:
+            # Databases from before voxel counts were recorded.
+            with self._conn:
+                self._conn.execute(
+                    'ALTER TABLE results ADD COLUMN voxels INTEGER')
+
+    def inputs(self, images):
+        """Fingerprints identifying a set of amsaf_eval inputs
+
+        :param images: The (unsegmented_image, ground_truth, segmented_image,
+                       segmentation) inputs of a run
+        :type images: (SimpleITK.Image, SimpleITK.Image, SimpleITK.Image,
+                       SimpleITK.Image)
+        :returns: Combined fingerprint followed by one per image
+        :rtype: (str, str, str, str, str)
+        """
+        return (inputs_fingerprint(images),) + tuple(
+            image_fingerprint(image) if image is not None else None
+            for image in images)
+
+    def completed(self, inputs):
+        """Keys of candidates recorded for a set of inputs
+
+        :param inputs: Result of ResultsDatabase.inputs
+        :type inputs: tuple
+        :rtype: frozenset
+        """
+        rows = self._conn.execute('SELECT key FROM results WHERE inputs = ?',
+                                  (inputs[0],))
+        return frozenset(row['key'] for row in rows)
+
+    def record(self, inputs, amsaf_result, location=None):
+        """Record an evaluated candidate
+
+        :param inputs: Result of ResultsDatabase.inputs
+        :param amsaf_result: Result in the format of amsaf_eval return value
+        :param location: Optional path the candidate's segmentation was
+                         written to
+        :type inputs: tuple
+        :type amsaf_result: [[SimpleITK.ParameterMap], SimpleITK.Image, float]
+        :type location: str
+        :rtype: None
+        """
+        parameter_maps, seg, score = amsaf_result[:3]
+        stage_keys = [vector_key([pm]) for pm in parameter_maps]
+        stage_keys += [None] * (len(STAGES) - len(stage_keys))
+        voxels = seg.GetNumberOfPixels() if isinstance(seg, sitk.Image) \
+            else None
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO results (inputs, key, rigid_key, '
+                'affine_key, bspline_key, unsegmented_image, ground_truth, '
+                'segmented_image, segmentation, score, runtime, location, '
+                'parameter_maps, created, voxels) VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (inputs[0], vector_key(parameter_maps)) +
+                tuple(stage_keys[:len(STAGES)]) + tuple(inputs[1:]) +
+                (float(score), getattr(score, 'runtime', None),
+                 location and os.path.abspath(location),
+                 json.dumps([dict((k, list(v)) for k, v in pm.items())
+                             for pm in parameter_maps], sort_keys=True),
+                 time.time(), voxels))
+
+    def load(self, inputs, key, missing_ok=False):
+        """Rebuild a recorded result if its segmentation is still available
+
+        :param inputs: Result of ResultsDatabase.inputs
+        :param key: Candidate key, see amsaf.journal.vector_key
+        :param missing_ok: Optional. If True, a recorded result whose
+                           segmentation isn't available is rebuilt with None
+                           in its place.
+        :type inputs: tuple
+        :type key: str
+        :type missing_ok: bool
+        :returns: Result in the format of amsaf_eval return value, or None
+        :rtype: [[SimpleITK.ParameterMap], SimpleITK.Image, float]
+        """
+        row = self._conn.execute(
+            'SELECT * FROM results WHERE inputs = ? AND key = ?',
+            (inputs[0], key)).fetchone()
+        if row is None:
+            return None
+        seg = None
+        if row['location'] and os.path.isfile(row['location']):
+            seg = sitk.ReadImage(row['location'])
+        elif not missing_ok:
+            return None
+        return [_parameter_maps(row['parameter_maps']), seg, row['score']]
+
+    def runtimes(self, inputs=None):
+        """Recorded runtimes, e.g. to fit an amsaf.costmodel.CostModel
+
+        :param inputs: Optional result of ResultsDatabase.inputs to restrict
+                       the query to
+        :type inputs: tuple
+        :returns: (parameter maps as dicts, voxels of the segmentation,
+                  runtime) of every candidate with a known runtime and voxel
+                  count
+        :rtype: [([dict], int, float)]
+        """
+        query = ('SELECT parameter_maps, voxels, runtime FROM results '
+                 'WHERE runtime IS NOT NULL AND voxels IS NOT NULL')
+        args = []
+        if inputs is not None:
+            query += ' AND inputs = ?'
+            args.append(inputs[0])
+        return [(json.loads(row['parameter_maps']), row['voxels'],
+                 row['runtime']) for row in self._conn.execute(query, args)]
+
+    def best(self, n=20, inputs=None, stage=None, unsegmented_image=None,
+             segmented_image=None):
+        """Best recorded candidates, or best settings of one stage
+
+        >>> inputs = db.inputs(images)
+        >>> db.best(20, stage='bspline', unsegmented_image=inputs[1],
+        ...         segmented_image=inputs[3])
+
+        :param n: Number of rows to return
+        :param inputs: Optional result of ResultsDatabase.inputs to restrict
+                       the query to
+        :param stage: Optional 'rigid', 'affine' or 'bspline'. If given,
+                      candidates are grouped by that stage's parameter map
+                      and each map is ranked by its best score.
+        :param unsegmented_image: Optional fingerprint of the target image to
+                                  restrict the query to
+        :param segmented_image: Optional fingerprint of the source image to
+                                restrict the query to
+        :type n: int
+        :type inputs: tuple
+        :type stage: str
+        :type unsegmented_image: str
+        :type segmented_image: str
+        :returns: Rows as dicts with keys 'key', 'score', 'runtime',
+                  'location' and 'parameter_maps'. With stage, 'key' is the
+                  stage map's key and 'parameter_maps' holds only that map.
+        :rtype: [dict]
+        """
+        if stage is not None and stage not in STAGES:
+            raise ValueError("kwarg stage must be one of {}".format(
+                ', '.join(STAGES)))
+        where, args = [], []
+        for column, value in (('inputs', inputs and inputs[0]),
+                              ('unsegmented_image', unsegmented_image),
+                              ('segmented_image', segmented_image)):
+            if value is not None:
+                where.append('{} = ?'.format(column))
+                args.append(value)
+        clause = ' WHERE ' + ' AND '.join(where) if where else ''
+
+        if stage is None:
+            query = ('SELECT key, score, runtime, location, parameter_maps '
+                     'FROM results{} ORDER BY score DESC, created LIMIT ?'
+                     .format(clause))
+        else:
+            # SQLite takes the bare columns from the row holding the MAX.
+            query = ('SELECT {0}_key AS key, MAX(score) AS score, runtime, '
+                     'location, parameter_maps FROM results{1} '
+                     'GROUP BY {0}_key ORDER BY score DESC LIMIT ?'
+                     .format(stage, clause))
+        rows = []
+        for row in self._conn.execute(query, args + [n]):
+            row = dict(row)
+            parameter_maps = json.loads(row['parameter_maps'])
+            if stage is not None:
+                parameter_maps = parameter_maps[STAGES.index(stage):][:1]
+            row['parameter_maps'] = parameter_maps
+            rows.append(row)
+        return rows
+
+    def close(self):
+        """Close the database connection
+
+        :rtype: None
+        """
+        self._conn.close()
+
+    def __repr__(self):
+        return 'ResultsDatabase({!r})'.format(self.path)
+
+
+def _parameter_maps(text):
+    parameter_maps = []
+    for d in json.loads(text):
+        pm = sitk.ParameterMap()
+        for k, v in d.items():
+            pm[str(k)] = tuple(str(x) for x in v)
+        parameter_maps.append(pm)
+    return parameter_maps
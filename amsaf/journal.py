@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: journal
+   :synopsis: Checkpoint journal for resumable amsaf_eval runs
+
+Every finished candidate's parameter maps, score and segmentation path are
+appended to a journal in the run directory as soon as it completes. A run
+restarted with the same inputs and run directory reads the journal back and
+only evaluates the candidates that are missing.
+"""
+
+import os
+import json
+import hashlib
+
+import SimpleITK as sitk
+
+from .cache import image_fingerprint, canonical_parameter_map
+from .scoring import Score
+
+
+JOURNAL_FILENAME = 'journal.jsonl'
+
+
+class RunJournal(object):
+    """Append-only record of finished amsaf_eval candidates
+
+    :param run_dir: Directory holding the journal and its segmentations.
+                    Created if missing.
+    :param images: The (unsegmented_image, ground_truth, segmented_image,
+                   segmentation) inputs of the run. A journal can only be
+                   resumed with the inputs it was created for.
+    :type run_dir: str
+    :type images: (SimpleITK.Image, SimpleITK.Image, SimpleITK.Image,
+                   SimpleITK.Image)
+    """
+
+    def __init__(self, run_dir, images):
+        self.run_dir = os.path.abspath(os.path.expanduser(run_dir))
+        self.seg_dir = os.path.join(self.run_dir, 'segs')
+        self.path = os.path.join(self.run_dir, JOURNAL_FILENAME)
+        self.fingerprint = inputs_fingerprint(images)
+        if not os.path.isdir(self.seg_dir):
+            os.makedirs(self.seg_dir)
+
+        self.records = {}
+        if os.path.isfile(self.path):
+            self._load()
+        else:
+            self._append({'inputs': self.fingerprint})
+
+    def completed(self):
+        """Keys of candidates already recorded in the journal
+
+        :rtype: frozenset
+        """
+        return frozenset(self.records)
+
+    def record(self, amsaf_result):
+        """Append a finished amsaf_eval result to the journal
+
+        The segmentation is written first so that a journal entry always
+        points at a complete file.
+
+        :type amsaf_result: [SimpleITK.ParameterMap, SimpleITK.Image, float]
+        :rtype: None
+        """
+        parameter_maps, seg, score = amsaf_result[:3]
+        key = vector_key(parameter_maps)
+        seg_path = os.path.join(self.seg_dir, '{}.mha'.format(key))
+        tmp_path = os.path.join(self.seg_dir, '.{}.mha'.format(key))
+        sitk.WriteImage(seg, tmp_path, True)
+        os.rename(tmp_path, seg_path)
+
+        record = {
+            'key': key,
+            'parameter_maps': [dict((k, list(v)) for k, v in pm.items())
+                               for pm in parameter_maps],
+            'score': float(score),
+            'seg': os.path.relpath(seg_path, self.run_dir),
+        }
+        if getattr(score, 'labels', None):
+            record['labels'] = dict((str(k), v)
+                                    for k, v in score.labels.items())
+        if getattr(score, 'measures', None):
+            record['measures'] = score.measures
+        if getattr(score, 'runtime', None) is not None:
+            record['runtime'] = score.runtime
+            record['voxels'] = seg.GetNumberOfPixels()
+        self._append(record)
+        self.records[key] = record
+
+    def load(self, key):
+        """Rebuild a recorded amsaf_eval result
+
+        :type key: str
+        :returns: Result in the format of amsaf_eval return value
+        :rtype: [[SimpleITK.ParameterMap], SimpleITK.Image, float]
+        """
+        record = self.records[key]
+        parameter_maps = []
+        for d in record['parameter_maps']:
+            pm = sitk.ParameterMap()
+            for k, v in d.items():
+                pm[str(k)] = tuple(str(x) for x in v)
+            parameter_maps.append(pm)
+        seg = sitk.ReadImage(os.path.join(self.run_dir, record['seg']))
+        score = record['score']
+        if 'labels' in record or 'measures' in record or 'runtime' in record:
+            score = Score(score,
+                          dict((int(k), v)
+                               for k, v in record.get('labels', {}).items()),
+                          record.get('measures'), record.get('runtime'))
+        return [parameter_maps, seg, score]
+
+    def _load(self):
+        with open(self.path) as f:
+            lines = f.readlines()
+        try:
+            header = json.loads(lines[0]) if lines[0].endswith('\n') else None
+        except (IndexError, ValueError):
+            header = None
+        if not isinstance(header, dict):
+            # The run was killed while writing the header, before any
+            # candidate finished, so the journal starts over.
+            os.remove(self.path)
+            self._append({'inputs': self.fingerprint})
+            return
+        if header.get('inputs') != self.fingerprint:
+            raise ValueError("Run directory {} was created for different "
+                             "input images".format(self.run_dir))
+        if not lines[-1].endswith('\n'):
+            # Terminate a partial line so the next record starts cleanly.
+            self._write('\n')
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Partial line from a run that was killed mid-write.
+                continue
+            self.records[record['key']] = record
+
+    def _append(self, record):
+        self._write(json.dumps(record, sort_keys=True) + '\n')
+
+    def _write(self, text):
+        with open(self.path, 'a') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def vector_key(parameter_maps):
+    """Stable hash of a vector of parameter maps
+
+    :type parameter_maps: [SimpleITK.ParameterMap]
+    :rtype: str
+    """
+    canonical = [canonical_parameter_map(pm) for pm in parameter_maps]
+    return hashlib.sha1(repr(canonical).encode('utf-8')).hexdigest()
+
+
+def inputs_fingerprint(images):
+    """Combined fingerprint of the inputs of an amsaf_eval run
+
+    :type images: [SimpleITK.Image]
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for image in images:
+        h.update((image_fingerprint(image) if image is not None
+                  else 'None').encode('utf-8'))
+    return h.hexdigest()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: profiling
+   :synopsis: Per-stage timing and memory instrumentation
+
+Stages of a run, Elastix registration, Transformix resampling, parameter
+map construction, scoring and image I/O, are wrapped in the stage context
+manager. Each finished stage emits an event dict to every registered hook:
+
+* 'stage': Stage name, e.g. 'registration' or 'resampling'
+* 'wall': Wall clock seconds
+* 'cpu': CPU seconds of the process, including Elastix's threads
+* 'peak_rss': Peak resident set size of the process in bytes so far
+* 'voxels': Number of voxels processed, if known
+* 'candidate': Key of the parameter map vector being evaluated, if any
+* 'pid': Process the stage ran in
+
+Events of stages run in worker processes are sent back with their results
+and emitted in the parent process, so hooks see every stage of a parallel
+run. StageProfile is a hook that aggregates events into a per-stage
+profile.
+"""
+
+import os
+import sys
+import time
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+_HOOKS = []
+_LOCAL = threading.local()
+
+
+def add_hook(hook):
+    """Call hook(event) for every finished stage
+
+    :type hook: callable
+    :rtype: None
+    """
+    _HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    """Stop calling a hook added with add_hook
+
+    :type hook: callable
+    :rtype: None
+    """
+    if hook in _HOOKS:
+        _HOOKS.remove(hook)
+
+
+@contextlib.contextmanager
+def hooked(hook):
+    """Context manager calling hook(event) for stages finished within it
+
+    :type hook: callable
+    """
+    add_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+
+
+@contextlib.contextmanager
+def stage(name, voxels=None):
+    """Time a block of code as a stage and emit its event
+
+    :param name: Stage name
+    :param voxels: Optional number of voxels the stage processes
+    :type name: str
+    :type voxels: int
+    """
+    start_wall, start_cpu = time.time(), _cpu_time()
+    try:
+        yield
+    finally:
+        emit({'stage': name, 'wall': time.time() - start_wall,
+              'cpu': _cpu_time() - start_cpu, 'peak_rss': peak_rss(),
+              'voxels': voxels, 'candidate': None, 'pid': os.getpid()})
+
+
+def emit(event):
+    """Pass an event to the innermost collect block, or else to the hooks
+
+    :type event: dict
+    :rtype: None
+    """
+    collectors = getattr(_LOCAL, 'collectors', None)
+    if collectors:
+        collectors[-1].append(event)
+        return
+    for hook in list(_HOOKS):
+        hook(event)
+
+
+@contextlib.contextmanager
+def collect():
+    """Collect the events of stages finished within the block instead of
+    emitting them, e.g. to send them from a worker process to its parent
+
+    :returns: List the events are appended to
+    """
+    if not hasattr(_LOCAL, 'collectors'):
+        _LOCAL.collectors = []
+    events = []
+    _LOCAL.collectors.append(events)
+    try:
+        yield events
+    finally:
+        _LOCAL.collectors.pop()
+
+
+def replay(events, candidate=None):
+    """Emit collected events, tagged with the candidate they belong to
+
+    :type events: [dict]
+    :type candidate: str
+    :rtype: None
+    """
+    for event in events:
+        if candidate is not None:
+            event = dict(event, candidate=candidate)
+        emit(event)
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None if unknown
+
+    :rtype: int
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageProfile(object):
+    """Hook aggregating stage events into a per-stage profile
+
+    >>> profile = StageProfile()
+    >>> with hooked(profile):
+    ...     results = list(amsaf_eval(*images))
+    >>> profile.report()
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.candidates = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            totals = self.stages.setdefault(event['stage'], {
+                'count': 0, 'wall': 0.0, 'cpu': 0.0, 'voxels': 0,
+                'peak_rss': 0})
+            totals['count'] += 1
+            totals['wall'] += event['wall']
+            totals['cpu'] += event['cpu']
+            totals['voxels'] += event.get('voxels') or 0
+            totals['peak_rss'] = max(totals['peak_rss'],
+                                     event.get('peak_rss') or 0)
+            if event.get('candidate') is not None:
+                self.candidates.add(event['candidate'])
+
+    def report(self, file=None):
+        """Print a table of stages by total wall time
+
+        :param file: Optional file to print to. Defaults to stdout.
+        :rtype: None
+        """
+        file = file or sys.stdout
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda s: -s[1]['wall'])
+        total = sum(t['wall'] for _, t in stages) or 1.0
+        file.write('{:<14} {:>7} {:>10} {:>6} {:>10} {:>12} {:>10}\n'.format(
+            'stage', 'count', 'wall (s)', 'share', 'cpu (s)', 'Mvoxels/s',
+            'peak MB'))
+        for name, t in stages:
+            rate = t['voxels'] / t['wall'] / 1e6 if t['wall'] else 0.0
+            file.write('{:<14} {:>7} {:>10.3f} {:>5.1f}% {:>10.3f} {:>12.2f} '
+                       '{:>10.1f}\n'.format(
+                           name, t['count'], t['wall'],
+                           100 * t['wall'] / total, t['cpu'], rate,
+                           t['peak_rss'] / 2.0 ** 20))
+        if self.candidates:
+            file.write('{} candidates\n'.format(len(self.candidates)))
+
+
+def _cpu_time():
+    if hasattr(time, 'process_time'):
+        return time.process_time()
+    return time.clock()
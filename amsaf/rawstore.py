@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: rawstore
+   :synopsis: Uncompressed, memory-mapped copies of image volumes
+
+Decoding compressed .nii and .mha volumes dominates the startup of short
+jobs. A RawStore converts each volume once into a raw pixel file plus a
+small JSON sidecar with its metadata. Later reads map the raw file with
+np.memmap instead of decoding. RawStore.open returns that mapping, whose
+pages are shared by every process reading the same volume; RawStore.read
+copies the pixels out of it into a private SimpleITK image.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+import SimpleITK as sitk
+
+
+class RawStore(object):
+    """Directory of raw pixel files converted from image volumes
+
+    Entries are keyed by the source's absolute path, modification time and
+    size, so a volume is converted again after it changes.
+
+    :param path: Directory the store lives in. Created if missing.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def read(self, path, pixel_type=None):
+        """Read an image through the store, converting it on first use
+
+        The pixels are copied from the memory-mapped raw file, so the image
+        is private to the caller. Use open for an array that shares the
+        mapped pages instead.
+
+        :param path: Path to the source image file
+        :param pixel_type: Optional SimpleITK pixel type to cast the image to
+        :type path: str
+        :type pixel_type: int
+        :rtype: SimpleITK.Image
+        """
+        data, meta = self.open(path)
+        image = sitk.GetImageFromArray(data,
+                                       isVector=meta['components'] > 1)
+        image.SetOrigin(meta['origin'])
+        image.SetSpacing(meta['spacing'])
+        image.SetDirection(meta['direction'])
+        if pixel_type is not None:
+            image = sitk.Cast(image, pixel_type)
+        return image
+
+    def open(self, path):
+        """Memory-map the pixel data of an image, converting it on first use
+
+        :param path: Path to the source image file
+        :type path: str
+        :returns: Read-only array in (z, y, x[, component]) order and the
+                  image's metadata
+        :rtype: (numpy.memmap, dict)
+        """
+        raw_path, meta_path = self._entry_paths(path)
+        if not os.path.isfile(meta_path):
+            self.convert(path)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        shape = tuple(meta['shape'])
+        if not np.prod(shape):
+            return np.zeros(shape, dtype=meta['dtype']), meta
+        data = np.memmap(raw_path, dtype=meta['dtype'], mode='r', shape=shape)
+        return data, meta
+
+    def convert(self, path):
+        """Decode an image and store its raw pixel data and metadata
+
+        Both files are written under temporary names and renamed into place,
+        sidecar last, so concurrent readers never see a partial entry.
+
+        :param path: Path to the source image file
+        :type path: str
+        :rtype: None
+        """
+        raw_path, meta_path = self._entry_paths(path)
+        image = sitk.ReadImage(path)
+        data = sitk.GetArrayViewFromImage(image)
+        meta = {
+            'source': os.path.abspath(path),
+            'shape': list(data.shape),
+            'dtype': data.dtype.str,
+            'components': image.GetNumberOfComponentsPerPixel(),
+            'origin': list(image.GetOrigin()),
+            'spacing': list(image.GetSpacing()),
+            'direction': list(image.GetDirection()),
+        }
+        _atomic_write(raw_path, lambda f: np.ascontiguousarray(data).tofile(f))
+        _atomic_write(meta_path, lambda f: f.write(
+            json.dumps(meta, sort_keys=True).encode('utf-8')))
+
+    def _entry_paths(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = hashlib.sha1(repr((path, st.st_mtime, st.st_size))
+                           .encode('utf-8')).hexdigest()
+        base = os.path.join(self.path, key)
+        return base + '.raw', base + '.json'
+
+    def __repr__(self):
+        return 'RawStore({!r})'.format(self.path)
+
+
+def _atomic_write(path, write):
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-',
+                                    dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: scheduler
+   :synopsis: Thread budget for Elastix and Transformix
+
+register, register_indv and transform run with the number of threads
+configured here unless given one explicitly, so several registrations
+running side by side don't oversubscribe the CPU and a single one can be
+pinned down. plan splits the core budget between concurrent registrations:
+few jobs with many threads each if registrations scale well on this
+machine, many jobs with few threads otherwise. How well they scale is
+measured by calibrate; until it has run, plan assumes
+DEFAULT_SERIAL_FRACTION.
+"""
+
+import math
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+import SimpleITK as sitk
+
+
+# Serial fraction plan assumes for registrations that haven't been measured.
+# Elastix spends part of every iteration in single-threaded code, so some
+# serial fraction is a safer guess than linear scaling, which would always
+# favor a single job with every thread.
+DEFAULT_SERIAL_FRACTION = 0.1
+
+
+class SchedulerConfig(object):
+    """Process-wide thread budget
+
+    :ivar cores: Number of cores amsaf may use
+    :ivar threads: Threads per Elastix or Transformix call, or None to use
+                   the SimpleITK global default
+    :ivar serial_fraction: Fraction of a registration that doesn't speed up
+                           with more threads, as fitted by calibrate, or None
+                           if unknown
+    """
+
+    def __init__(self):
+        self.cores = multiprocessing.cpu_count()
+        self.threads = None
+        self.serial_fraction = None
+
+    def __repr__(self):
+        return 'SchedulerConfig(cores={!r}, threads={!r}, ' \
+               'serial_fraction={!r})'.format(self.cores, self.threads,
+                                              self.serial_fraction)
+
+
+CONFIG = SchedulerConfig()
+
+
+def configure(cores=None, threads=None, serial_fraction=None):
+    """Set the process-wide thread budget
+
+    Arguments left as None keep their current value.
+
+    :param cores: Number of cores amsaf may use
+    :param threads: Threads per Elastix or Transformix call
+    :param serial_fraction: Serial fraction of a registration, see calibrate
+    :type cores: int
+    :type threads: int
+    :type serial_fraction: float
+    :rtype: amsaf.scheduler.SchedulerConfig
+    """
+    if cores is not None:
+        if cores < 1:
+            raise ValueError("kwarg cores must be positive")
+        CONFIG.cores = cores
+    if threads is not None:
+        if threads < 1:
+            raise ValueError("kwarg threads must be positive")
+        CONFIG.threads = threads
+    if serial_fraction is not None:
+        CONFIG.serial_fraction = serial_fraction
+    return CONFIG
+
+
+def filter_threads(num_threads=None):
+    """Number of threads an Elastix or Transformix call should use
+
+    :param num_threads: Explicit number of threads, which takes precedence
+    :type num_threads: int
+    :returns: Number of threads, or None for the SimpleITK default
+    :rtype: int
+    """
+    return num_threads or CONFIG.threads
+
+
+def threads_per_job(n_jobs):
+    """Even split of the core budget between n_jobs concurrent jobs
+
+    :type n_jobs: int
+    :rtype: int
+    """
+    return max(1, CONFIG.cores // max(1, n_jobs))
+
+
+def speedup(threads, serial_fraction):
+    """Speedup of a registration on threads threads by Amdahl's law
+
+    :type threads: int
+    :type serial_fraction: float
+    :rtype: float
+    """
+    return 1.0 / (serial_fraction + (1.0 - serial_fraction) / threads)
+
+
+def plan(n_tasks=None, cores=None, serial_fraction=None, max_jobs=None):
+    """Split a core budget into concurrent jobs and threads per job
+
+    Picks the split that finishes n_tasks registrations soonest, or that has
+    the highest throughput if n_tasks is unknown. Among equally fast splits,
+    the one with fewer jobs, and so less memory, wins.
+
+    :param n_tasks: Optional number of registrations to run
+    :param cores: Core budget. Defaults to the configured one.
+    :param serial_fraction: Serial fraction of a registration. Defaults to
+                            the configured one, or to DEFAULT_SERIAL_FRACTION
+                            if calibrate hasn't been run.
+    :param max_jobs: Optional upper bound on concurrent jobs, e.g. to bound
+                     memory
+    :type n_tasks: int
+    :type cores: int
+    :type serial_fraction: float
+    :type max_jobs: int
+    :returns: (n_jobs, threads_per_job)
+    :rtype: (int, int)
+    """
+    cores = cores or CONFIG.cores
+    if serial_fraction is None:
+        serial_fraction = CONFIG.serial_fraction
+    if serial_fraction is None:
+        serial_fraction = DEFAULT_SERIAL_FRACTION
+    limit = cores
+    if max_jobs:
+        limit = min(limit, max_jobs)
+    if n_tasks:
+        limit = min(limit, n_tasks)
+
+    best, best_cost = (1, cores), None
+    for n_jobs in range(1, max(1, limit) + 1):
+        threads = max(1, cores // n_jobs)
+        rate = speedup(threads, serial_fraction)
+        if n_tasks:
+            cost = math.ceil(n_tasks / float(n_jobs)) / rate
+        else:
+            cost = 1.0 / (n_jobs * rate)
+        # Require a clear gain before adding jobs, so that ties in the cost
+        # model don't cost memory.
+        if best_cost is None or cost < best_cost * (1 - 1e-9):
+            best, best_cost = (n_jobs, threads), cost
+    return best
+
+
+def measure_scaling(thread_counts=None, size=48, iterations=64, repeat=1):
+    """Time a rigid registration of a synthetic volume at several thread
+    counts
+
+    :param thread_counts: Thread counts to time. Defaults to powers of two up
+                          to the core budget.
+    :param size: Edge length of the synthetic volume in voxels
+    :param iterations: MaximumNumberOfIterations of the registration
+    :param repeat: Number of timings per thread count, of which the fastest
+                   is kept
+    :type thread_counts: [int]
+    :type size: int
+    :type iterations: int
+    :type repeat: int
+    :returns: Seconds per registration by thread count
+    :rtype: dict
+    """
+    if thread_counts is None:
+        thread_counts = sorted(set([2 ** i for i in range(
+            int(math.log(CONFIG.cores, 2)) + 1)] + [CONFIG.cores]))
+    fixed, moving = _phantoms(size)
+    pm = sitk.GetDefaultParameterMap('rigid')
+    pm['MaximumNumberOfIterations'] = [str(iterations)]
+
+    timings = {}
+    # Elastix writes its transform parameter files to the output directory.
+    output_dir = tempfile.mkdtemp(prefix='amsaf-')
+    try:
+        for threads in thread_counts:
+            best = None
+            for _ in range(repeat):
+                registration_filter = sitk.ElastixImageFilter()
+                registration_filter.LogToConsoleOff()
+                registration_filter.SetOutputDirectory(output_dir)
+                registration_filter.SetNumberOfThreads(threads)
+                registration_filter.SetFixedImage(fixed)
+                registration_filter.SetMovingImage(moving)
+                registration_filter.SetParameterMap(pm)
+                start = time.time()
+                registration_filter.Execute()
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[threads] = best
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return timings
+
+
+def fit_serial_fraction(timings):
+    """Least squares fit of Amdahl's law to registration timings
+
+    :param timings: Seconds per registration by thread count, with at least
+                    two thread counts
+    :type timings: dict
+    :returns: Serial fraction between 0 and 1
+    :rtype: float
+    """
+    threads = np.array(sorted(timings), dtype=np.float64)
+    if len(threads) < 2:
+        raise ValueError("Need timings for at least two thread counts")
+    seconds = np.array([timings[t] for t in sorted(timings)])
+    # t(n) = a + b / n, with a the serial and b the parallel part.
+    design = np.stack([np.ones_like(threads), 1.0 / threads], axis=1)
+    (a, b), _, _, _ = np.linalg.lstsq(design, seconds, rcond=None)
+    a, b = max(a, 0.0), max(b, 0.0)
+    return float(a / (a + b)) if a + b > 0 else 1.0
+
+
+def calibrate(**kwargs):
+    """Measure how registrations scale on this machine and configure the
+    serial fraction plan uses
+
+    Keyword arguments are passed to measure_scaling.
+
+    :returns: The measured timings
+    :rtype: dict
+    """
+    timings = measure_scaling(**kwargs)
+    if len(timings) > 1:
+        configure(serial_fraction=fit_serial_fraction(timings))
+    return timings
+
+
+def _phantoms(size):
+    # A blurred ball and a shifted copy of it.
+    z, y, x = np.mgrid[:size, :size, :size].astype(np.float32)
+    center = size / 2.0
+    radius = size / 4.0
+
+    def ball(shift):
+        d = np.sqrt((x - center - shift) ** 2 + (y - center) ** 2 +
+                    (z - center) ** 2)
+        return sitk.SmoothingRecursiveGaussian(
+            sitk.GetImageFromArray((d < radius).astype(np.float32) * 100), 1.0)
+    return ball(0), ball(size / 16.0)
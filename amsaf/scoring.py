@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: scoring
+   :synopsis: Scoring of candidate segmentations against a ground truth
+
+A scorer is built once per amsaf_eval run. Everything that only depends on
+the ground truth is computed up front, so scoring a candidate is a single
+vectorized pass over a view of its pixel buffer, plus a surface extraction
+within the candidate's bounding box when surface distances are requested.
+"""
+
+import numpy as np
+from scipy import ndimage
+
+import SimpleITK as sitk
+
+
+RANKINGS = ('dice', 'hausdorff95', 'assd')
+
+
+class Score(float):
+    """Overall score of a candidate, carrying per-label measures
+
+    Behaves exactly like a float, so results can be ranked, compared and
+    written as before.
+
+    :ivar labels: Dict mapping each label to a dict of measures
+    :ivar measures: Dict of overall measures, e.g. 'dice', 'hausdorff95'
+                    and 'assd'
+    :ivar runtime: Seconds spent producing and scoring the candidate, or
+                   None if not measured
+    """
+
+    def __new__(cls, value, labels=None, measures=None, runtime=None):
+        score = float.__new__(cls, value)
+        score.labels = labels or {}
+        score.measures = measures or {}
+        score.runtime = runtime
+        return score
+
+    def __reduce__(self):
+        return (Score, (float(self), self.labels, self.measures, self.runtime))
+
+
+class OverlapScorer(object):
+    """Dice, Jaccard and volume similarity against a fixed ground truth
+
+    Calling the scorer returns the overall Dice coefficient over all labels,
+    matching SimpleITK's LabelOverlapMeasuresImageFilter, as a Score whose
+    labels attribute holds per-label 'dice', 'jaccard' and
+    'volume_similarity'.
+
+    With surface_distances, the 95th percentile Hausdorff distance and the
+    average symmetric surface distance between the candidate and ground
+    truth foregrounds are added to the Score's measures, in physical units.
+    The ground truth's surface and the distance map to it are computed once;
+    per candidate, only its own surface is extracted, within its bounding
+    box.
+
+    :param ground_truth: Label image candidates are scored against
+    :param surface_distances: Optional. If True, compute 'hausdorff95' and
+                              'assd' measures.
+    :param rank_by: Measure used as the value of the Score: 'dice' (default),
+                    'hausdorff95' or 'assd'. Distances are negated so that
+                    higher scores are always better.
+    :type ground_truth: SimpleITK.Image
+    :type surface_distances: bool
+    :type rank_by: str
+    """
+
+    def __init__(self, ground_truth, surface_distances=False, rank_by='dice'):
+        if rank_by not in RANKINGS:
+            raise ValueError("kwarg rank_by must be one of {}".format(
+                ', '.join(RANKINGS)))
+        if rank_by != 'dice' and not surface_distances:
+            raise ValueError("Ranking by {} requires surface_distances"
+                             .format(rank_by))
+        self.ground_truth = ground_truth
+        self.surface_distances = surface_distances
+        self.rank_by = rank_by
+        self._precompute()
+
+    def __call__(self, candidate):
+        """Score a candidate segmentation
+
+        :param candidate: Segmentation on the ground truth's grid
+        :type candidate: SimpleITK.Image
+        :rtype: amsaf.scoring.Score
+        """
+        if candidate.GetSize() != self.ground_truth.GetSize():
+            raise ValueError("Candidate size {} does not match ground truth "
+                             "size {}".format(candidate.GetSize(),
+                                              self.ground_truth.GetSize()))
+        data = sitk.GetArrayViewFromImage(candidate)
+        if data.dtype == self._gt.dtype:
+            mask = None
+            candidate_counts = _label_counts(data)
+            box = data[self.bbox]
+        else:
+            # Like the LabelOverlapMeasures path, labels are compared after
+            # casting to the ground truth's pixel type. Transformix returns
+            # float images, so only the labelled voxels and the ground
+            # truth's bounding box are cast rather than the whole volume.
+            mask = _nonzero(data)
+            candidate_counts = _label_counts(
+                data[mask].astype(self._gt.dtype))
+            box = data[self.bbox].astype(self._gt.dtype)
+        matches = self._gt_box[self._gt_box == box]
+        intersections = _label_counts(matches)
+
+        n = max(len(candidate_counts), len(self.counts))
+        gt_counts = _pad(self.counts, n)
+        candidate_counts = _pad(candidate_counts, n)
+        intersections = _pad(intersections, n)
+        score = _measures(gt_counts, candidate_counts, intersections)
+
+        if self.surface_distances:
+            if mask is None:
+                mask = data != 0
+            score.measures.update(self._surface_measures(mask))
+            if self.rank_by != 'dice':
+                score = Score(-score.measures[self.rank_by], score.labels,
+                              score.measures)
+        return score
+
+    def _surface_measures(self, mask):
+        box = _bounding_box(mask)
+        surface = _surface(mask[box])
+        if not surface.any() or not len(self._gt_surface_points[0]):
+            return {'hausdorff95': float('inf'), 'assd': float('inf')}
+        to_gt = self._gt_distance[box][surface]
+
+        # Distances from the ground truth surface to the candidate's are
+        # exact within the union of both bounding boxes, since every
+        # candidate surface voxel lies inside it.
+        union = tuple(slice(min(a.start, b.start), max(a.stop, b.stop))
+                      for a, b in zip(box, self.bbox))
+        features = np.zeros([u.stop - u.start for u in union], dtype=bool)
+        features[tuple(slice(b.start - u.start, b.stop - u.start)
+                       for b, u in zip(box, union))] = surface
+        distance = ndimage.distance_transform_edt(~features,
+                                                  sampling=self._sampling)
+        from_gt = distance[tuple(p - u.start for p, u in
+                                 zip(self._gt_surface_points, union))]
+
+        return {
+            'hausdorff95': float(max(np.percentile(to_gt, 95),
+                                     np.percentile(from_gt, 95))),
+            'assd': float((to_gt.sum() + from_gt.sum()) /
+                          (len(to_gt) + len(from_gt))),
+        }
+
+    def _precompute(self):
+        self._gt = sitk.GetArrayViewFromImage(self.ground_truth)
+        if not np.issubdtype(self._gt.dtype, np.integer):
+            raise ValueError("Ground truth must have an integer pixel type")
+        self.counts = _label_counts(self._gt)
+        self.labels = np.nonzero(self.counts)[0]
+        self.bbox = _bounding_box(self._gt)
+        self._gt_box = self._gt[self.bbox]
+
+        if self.surface_distances:
+            # Array axes are (z, y, x), the reverse of SimpleITK's order.
+            self._sampling = self.ground_truth.GetSpacing()[::-1]
+            gt_surface = _surface(self._gt != 0)
+            self._gt_surface_points = np.nonzero(gt_surface)
+            self._gt_distance = ndimage.distance_transform_edt(
+                ~gt_surface, sampling=self._sampling).astype(np.float32)
+
+    def __getstate__(self):
+        return {'ground_truth': self.ground_truth,
+                'surface_distances': self.surface_distances,
+                'rank_by': self.rank_by}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._precompute()
+
+
+def _label_counts(data):
+    data = np.ravel(data)
+    if not np.can_cast(data.dtype, np.intp):
+        data = data.astype(np.intp)
+    counts = np.bincount(data)
+    if len(counts):
+        counts[0] = 0
+    return counts
+
+
+def _nonzero(data):
+    # Voxels of data that are nonzero once cast to an integer type, which
+    # truncates floats towards zero.
+    if np.issubdtype(data.dtype, np.floating):
+        return (data >= 1) | (data <= -1)
+    return data != 0
+
+
+def _bounding_box(data):
+    # Smallest box containing every nonzero voxel, as a tuple of slices.
+    nonzero = data != 0
+    if not nonzero.any():
+        return tuple(slice(0, 0) for _ in data.shape)
+    box = []
+    for axis in range(data.ndim):
+        others = tuple(a for a in range(data.ndim) if a != axis)
+        hits = np.nonzero(nonzero.any(axis=others))[0]
+        box.append(slice(hits[0], hits[-1] + 1))
+    return tuple(box)
+
+
+def _surface(mask):
+    # Foreground voxels with a background face neighbor. Voxels on the array
+    # border count as surface.
+    return mask & ~ndimage.binary_erosion(mask)
+
+
+def _pad(counts, n):
+    if len(counts) >= n:
+        return counts
+    return np.concatenate([counts, np.zeros(n - len(counts), counts.dtype)])
+
+
+def _measures(gt_counts, candidate_counts, intersections):
+    gt_counts = gt_counts.astype(np.float64)
+    candidate_counts = candidate_counts.astype(np.float64)
+    intersections = intersections.astype(np.float64)
+    totals = gt_counts + candidate_counts
+
+    present = np.nonzero(totals)[0]
+    labels = {}
+    for label in present:
+        g, c = gt_counts[label], candidate_counts[label]
+        i = intersections[label]
+        labels[int(label)] = {
+            'dice': float(2 * i / (g + c)),
+            'jaccard': float(i / (g + c - i)),
+            'volume_similarity': float(2 * (g - c) / (g + c)),
+        }
+    total = totals.sum()
+    dice = float(2 * intersections.sum() / total) if total else 0.0
+    return Score(dice, labels, {'dice': dice})
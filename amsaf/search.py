@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: search
+   :synopsis: Search strategies over Elastix parameter map vectors
+
+Strategies are independent of how candidates are evaluated: each one is
+given the candidate parameter map vectors and an evaluate callable that
+lazily maps an iterable of vectors to amsaf_eval style
+[parameter_maps, segmentation, score] results.
+"""
+
+import math
+import random
+import itertools
+
+from scipy import stats
+
+from .journal import vector_key
+
+
+# Parameter map keys that control how much work a registration does.
+BUDGET_KEYS = {
+    'MaximumNumberOfIterations': 1,
+    'NumberOfSpatialSamples': 64,
+}
+
+
+def successive_halving(candidates, evaluate, eta=3, n_rungs=3):
+    """Successive halving over Elastix iteration and sampling budgets
+
+    Every candidate is first scored with a fraction of its
+    MaximumNumberOfIterations and NumberOfSpatialSamples. The best 1/eta by
+    score are promoted to a budget eta times larger, until the survivors are
+    run with their full budget.
+
+    :param candidates: Parameter map vectors to search over
+    :param evaluate: Callable mapping an iterable of parameter map vectors to
+                     a stream of amsaf_eval results
+    :param eta: Factor by which the budget grows and the number of
+                candidates shrinks between rungs
+    :param n_rungs: Number of rungs, including the final full-budget one
+    :type candidates: [[SimpleITK.ParameterMap]]
+    :type evaluate: callable
+    :type eta: int
+    :type n_rungs: int
+    :returns: Full-budget results of the candidates surviving to the last rung
+    :rtype: generator
+    """
+    survivors = list(candidates)
+    fractions = budget_fractions(eta, n_rungs)
+    for fraction in fractions[:-1]:
+        if len(survivors) <= 1:
+            break
+        scaled = [[scale_budget(pm, fraction) for pm in pms]
+                  for pms in survivors]
+        index = dict((vector_key(pms), i) for i, pms in enumerate(scaled))
+        scores = [None] * len(survivors)
+        for result in evaluate(scaled):
+            scores[index[vector_key(result[0])]] = result[-1]
+        n_keep = int(math.ceil(len(survivors) / float(eta)))
+        # Ties keep the earlier candidate, like top_k. Candidates evaluate
+        # yielded no score for rank last.
+        ranked = sorted(range(len(survivors)),
+                        key=lambda i: (scores[i] is None,
+                                       -(scores[i] or 0), i))[:n_keep]
+        survivors = [survivors[i] for i in sorted(ranked)]
+
+    for result in evaluate(survivors):
+        yield result
+
+
+def proxy_screening(candidates, evaluate_proxy, evaluate, n_promote=10,
+                    report=None):
+    """Screen candidates on a cheap proxy and evaluate only the best fully
+
+    Every candidate is scored by evaluate_proxy, e.g. on downsampled images.
+    The n_promote best by proxy score are then evaluated by evaluate. Once
+    the full results are exhausted, report is called with a summary of how
+    well the proxy ranked the promoted candidates:
+
+    * 'n_screened': Number of candidates scored on the proxy
+    * 'n_promoted': Number of candidates evaluated fully
+    * 'proxy_scores': Proxy scores of the promoted candidates
+    * 'scores': Full scores of the promoted candidates, in the same order
+    * 'spearman': Spearman rank correlation between the two, or None if
+      there are fewer than two promoted candidates or either tier scores
+      them all the same
+
+    :param candidates: Parameter map vectors to search over
+    :param evaluate_proxy: Callable mapping an iterable of parameter map
+                           vectors to a stream of amsaf_eval results on the
+                           proxy
+    :param evaluate: Callable mapping an iterable of parameter map vectors to
+                     a stream of amsaf_eval results
+    :param n_promote: Number of candidates evaluated fully
+    :param report: Optional callable receiving the summary dict
+    :type candidates: [[SimpleITK.ParameterMap]]
+    :type evaluate_proxy: callable
+    :type evaluate: callable
+    :type n_promote: int
+    :type report: callable
+    :returns: Full results of the promoted candidates
+    :rtype: generator
+    """
+    candidates = list(candidates)
+    index = dict((vector_key(pms), i) for i, pms in enumerate(candidates))
+    proxy_scores = [None] * len(candidates)
+    for result in evaluate_proxy(candidates):
+        proxy_scores[index[vector_key(result[0])]] = result[-1]
+    screened = [i for i, score in enumerate(proxy_scores) if score is not None]
+    # Ties keep the earlier candidate, like top_k.
+    promoted = sorted(sorted(screened, key=lambda i: (-proxy_scores[i], i))
+                      [:max(1, n_promote)])
+
+    scores = {}
+    for result in evaluate([candidates[i] for i in promoted]):
+        scores[index[vector_key(result[0])]] = result[-1]
+        yield result
+
+    if report is not None:
+        evaluated = [i for i in promoted if i in scores]
+        report({
+            'n_screened': len(screened),
+            'n_promoted': len(evaluated),
+            'proxy_scores': [float(proxy_scores[i]) for i in evaluated],
+            'scores': [float(scores[i]) for i in evaluated],
+            'spearman': rank_correlation([proxy_scores[i] for i in evaluated],
+                                         [scores[i] for i in evaluated]),
+        })
+
+
+def rank_correlation(x, y):
+    """Spearman rank correlation of two score sequences
+
+    :type x: [float]
+    :type y: [float]
+    :returns: Correlation between -1 and 1, or None if it is undefined
+    :rtype: float
+    """
+    x, y = [float(v) for v in x], [float(v) for v in y]
+    if len(x) < 2 or len(set(x)) < 2 or len(set(y)) < 2:
+        return None
+    return float(stats.spearmanr(x, y)[0])
+
+
+def tpe(parameter_priors, evaluate, to_vector, budget=50, batch_size=1,
+        n_startup=10, gamma=0.25, n_samples=24, seed=None):
+    """Tree-structured Parzen estimator search over parameter priors
+
+    The search space is the same as the grid of parameter_priors: every key
+    with more than one value is a dimension, whose values are treated as
+    ordered if they are all numeric strings and as unordered categories
+    otherwise. After n_startup random candidates, the evaluated ones are
+    split into the best gamma fraction and the rest, and new candidates are
+    the samples from the best candidates' distribution that are most likely
+    under it relative to the rest. Candidates are proposed batch_size at a
+    time so that each batch can be evaluated in parallel.
+
+    :param parameter_priors: Vector of 3 ParameterGrid-style dicts
+    :param evaluate: Callable mapping an iterable of parameter map vectors to
+                     a stream of amsaf_eval results
+    :param to_vector: Callable turning a vector of 3 ParameterGrid points
+                      into a parameter map vector
+    :param budget: Maximum number of candidates to evaluate
+    :param batch_size: Number of candidates proposed per round
+    :param n_startup: Number of random candidates evaluated before the
+                      model is used
+    :param gamma: Fraction of evaluated candidates considered good
+    :param n_samples: Number of samples drawn per proposal
+    :param seed: Optional seed for reproducible proposals
+    :type parameter_priors: [dict]
+    :type evaluate: callable
+    :type to_vector: callable
+    :type budget: int
+    :type batch_size: int
+    :type n_startup: int
+    :type gamma: float
+    :type n_samples: int
+    :type seed: int
+    :returns: Results of every evaluated candidate as they are evaluated
+    :rtype: generator
+    """
+    rng = random.Random(seed)
+    space = _Space(parameter_priors)
+    budget = min(budget, space.size)
+    history = []
+    seen = set()
+
+    while len(seen) < budget:
+        n = min(batch_size, budget - len(seen))
+        if len(history) < n_startup:
+            batch = [space.random_unseen(rng, seen) for _ in range(n)]
+        else:
+            batch = space.propose(rng, history, seen, n, gamma, n_samples)
+        index = dict((vector_key(to_vector(space.point(p))), p)
+                     for p in batch)
+        vectors = [to_vector(space.point(p)) for p in batch]
+        for result in evaluate(vectors):
+            history.append((index[vector_key(result[0])], result[-1]))
+            yield result
+
+
+def budget_fractions(eta, n_rungs):
+    """Budget fraction of each rung of successive halving
+
+    >>> budget_fractions(3, 3)
+    [0.1111111111111111, 0.3333333333333333, 1.0]
+
+    :type eta: int
+    :type n_rungs: int
+    :rtype: [float]
+    """
+    return [1.0 / eta ** (n_rungs - 1 - i) for i in range(n_rungs)]
+
+
+def scale_budget(pm, fraction, keys=None):
+    """Copy of a parameter map with its iteration and sampling budget scaled
+
+    :param pm: Parameter map, or ParameterGrid-style prior
+    :param fraction: Factor to scale the budget by
+    :param keys: Optional subset of BUDGET_KEYS to scale. Defaults to all.
+    :type pm: SimpleITK.ParameterMap
+    :type fraction: float
+    :type keys: [str]
+    :rtype: dict
+    """
+    result = dict((k, tuple(v)) for k, v in pm.items())
+    if fraction >= 1:
+        return result
+    for k, minimum in BUDGET_KEYS.items():
+        if k in result and (keys is None or k in keys):
+            result[k] = tuple(
+                str(max(minimum, int(round(float(v) * fraction))))
+                for v in result[k])
+    return result
+
+
+class _Space(object):
+    # The grid of a vector of ParameterGrid dicts, with points represented as
+    # tuples of value indices, one per key with more than one value.
+
+    def __init__(self, parameter_priors):
+        self.fixed = []
+        self.dims = []
+        for stage, prior in enumerate(parameter_priors):
+            fixed = {}
+            for key, values in sorted(prior.items()):
+                values = list(values)
+                if len(values) == 1:
+                    fixed[key] = values[0]
+                else:
+                    self.dims.append((stage, key, values,
+                                      _ordinal_positions(values)))
+            self.fixed.append(fixed)
+        self.size = 1
+        for _, _, values, _ in self.dims:
+            self.size *= len(values)
+
+    def point(self, p):
+        dicts = [dict(fixed) for fixed in self.fixed]
+        for (stage, key, values, _), i in zip(self.dims, p):
+            dicts[stage][key] = values[i]
+        return dicts
+
+    def random_unseen(self, rng, seen):
+        for _ in range(100):
+            p = tuple(rng.randrange(len(values))
+                      for _, _, values, _ in self.dims)
+            if p not in seen:
+                seen.add(p)
+                return p
+        # The space is nearly exhausted; pick from what is left.
+        p = rng.choice([p for p in itertools.product(
+            *[range(len(values)) for _, _, values, _ in self.dims])
+            if p not in seen])
+        seen.add(p)
+        return p
+
+    def propose(self, rng, history, seen, n, gamma, n_samples):
+        ranked = sorted(history, key=lambda h: -h[1])
+        n_good = max(1, int(math.ceil(gamma * len(ranked))))
+        good = [p for p, _ in ranked[:n_good]]
+        bad = [p for p, _ in ranked[n_good:]]
+        densities = [(_density(d, [p[i] for p in good]),
+                      _density(d, [p[i] for p in bad]))
+                     for i, d in enumerate(self.dims)]
+
+        batch = []
+        for _ in range(n):
+            best, best_score = None, None
+            for _ in range(n_samples):
+                p = tuple(_sample(rng, good_density)
+                          for good_density, _ in densities)
+                if p in seen:
+                    continue
+                score = sum(math.log(good_density[i]) -
+                            math.log(bad_density[i])
+                            for (good_density, bad_density), i
+                            in zip(densities, p))
+                if best is None or score > best_score:
+                    best, best_score = p, score
+            if best is None:
+                best = self.random_unseen(rng, seen)
+            seen.add(best)
+            batch.append(best)
+        return batch
+
+
+def _ordinal_positions(values):
+    try:
+        numbers = [float(v) for v in values]
+    except (TypeError, ValueError):
+        return None
+    order = sorted(range(len(values)), key=lambda i: numbers[i])
+    positions = [0] * len(values)
+    for rank, i in enumerate(order):
+        positions[i] = rank
+    return positions
+
+
+def _density(dim, observations):
+    # Categorical values get add-one smoothed frequencies; ordinal values
+    # spread each observation to its neighbors with a Gaussian kernel.
+    _, _, values, positions = dim
+    weights = [1.0] * len(values)
+    for j in observations:
+        for i in range(len(values)):
+            if positions is None:
+                weights[i] += 1.0 if i == j else 0.0
+            else:
+                weights[i] += math.exp(
+                    -0.5 * (positions[i] - positions[j]) ** 2)
+    total = sum(weights)
+    return [w / total for w in weights]
+
+
+def _sample(rng, density):
+    x = rng.random()
+    for i, w in enumerate(density):
+        x -= w
+        if x < 0:
+            return i
+    return len(density) - 1
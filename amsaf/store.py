@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: store
+   :synopsis: Single-file store of amsaf_eval results
+
+A ResultStore keeps any number of results in one indexed .npz file instead of
+a directory of small files per result. Segmentations are cropped to the
+bounding box of their labels and stored as deflate-compressed uint8 arrays
+(uint16 if a label doesn't fit). Each result's parameter maps, score and
+image metadata are stored next to its segmentation as a small JSON member,
+so any result can be read back without touching the others. The file can
+also be opened with numpy.load.
+
+The zip index at the end of the file is only written when the store is
+closed, so the file of a killed process can't be opened. recover rebuilds
+it from the results that were written completely.
+"""
+
+import io
+import os
+import json
+import zlib
+import struct
+import zipfile
+
+import numpy as np
+
+import SimpleITK as sitk
+
+from .scoring import Score
+
+
+class ResultStore(object):
+    """Append-only single-file store of amsaf_eval results
+
+    Results are numbered in the order they are added. Use as a context
+    manager, or call close, to finish writing the file.
+
+    :param path: Path to the store file. Created if missing, appended to
+                 otherwise.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        mode = 'a' if os.path.isfile(self.path) else 'w'
+        # zipfile would append a new archive to an unreadable file.
+        if mode == 'a' and not zipfile.is_zipfile(self.path):
+            raise IOError("{} has no zip index, e.g. because the process "
+                          "writing it was killed. Rebuild it with "
+                          "amsaf.store.recover.".format(self.path))
+        self._zip = zipfile.ZipFile(self.path, mode, zipfile.ZIP_DEFLATED,
+                                    allowZip64=True)
+        self._meta = {}
+        for name in self._zip.namelist():
+            if name.startswith('meta-') and name.endswith('.json'):
+                self._meta[int(name[5:-5])] = None
+
+    def __len__(self):
+        return len(self._meta)
+
+    def add(self, amsaf_result):
+        """Append an amsaf_eval result
+
+        :type amsaf_result: [[SimpleITK.ParameterMap], SimpleITK.Image, float]
+        :returns: Index of the stored result
+        :rtype: int
+        """
+        parameter_maps, seg, score = amsaf_result[:3]
+        i = len(self._meta)
+        data = sitk.GetArrayViewFromImage(seg)
+        box = _bounding_box(data)
+        cropped = data[tuple(slice(a, b) for a, b in box)]
+        high = cropped.max() if cropped.size else 0
+        if cropped.size and (cropped.min() < 0 or high > 65535):
+            raise ValueError("Segmentation labels must fit in uint16")
+        dtype = np.uint8 if high <= 255 else np.uint16
+
+        meta = {
+            'parameter_maps': [dict((k, list(v)) for k, v in pm.items())
+                               for pm in parameter_maps],
+            'score': float(score),
+            'shape': list(data.shape),
+            'box': box,
+            'pixel_id': seg.GetPixelID(),
+            'origin': list(seg.GetOrigin()),
+            'spacing': list(seg.GetSpacing()),
+            'direction': list(seg.GetDirection()),
+        }
+        if getattr(score, 'labels', None):
+            meta['labels'] = dict((str(k), v) for k, v in score.labels.items())
+        if getattr(score, 'measures', None):
+            meta['measures'] = score.measures
+
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, np.ascontiguousarray(cropped,
+                                                            dtype=dtype))
+        self._zip.writestr('seg-{}.npy'.format(i), buf.getvalue())
+        # The metadata member is written last and marks the result complete.
+        self._zip.writestr('meta-{}.json'.format(i),
+                           json.dumps(meta, sort_keys=True))
+        self._meta[i] = meta
+        return i
+
+    def meta(self, i):
+        """Metadata of a stored result: parameter maps, score, bounding box
+        and image geometry
+
+        :type i: int
+        :rtype: dict
+        """
+        if self._meta.get(i) is None:
+            self._meta[i] = json.loads(
+                self._zip.read('meta-{}.json'.format(i)).decode('utf-8'))
+        return self._meta[i]
+
+    def scores(self):
+        """Scores of all stored results, by index
+
+        :rtype: [float]
+        """
+        return [self.meta(i)['score'] for i in range(len(self))]
+
+    def ranked(self, k=0):
+        """Indices of the k best stored results, best first
+
+        Ties are broken in favor of earlier results, like top_k.
+
+        :param k: Number of indices to return. If k == 0, returns all
+        :type k: int
+        :rtype: [int]
+        """
+        scores = self.scores()
+        order = sorted(range(len(scores)), key=lambda i: (-scores[i], i))
+        return order[:k] if k else order
+
+    def parameter_maps(self, i):
+        """Parameter maps of a stored result
+
+        :type i: int
+        :rtype: [SimpleITK.ParameterMap]
+        """
+        parameter_maps = []
+        for d in self.meta(i)['parameter_maps']:
+            pm = sitk.ParameterMap()
+            for k, v in d.items():
+                pm[str(k)] = tuple(str(x) for x in v)
+            parameter_maps.append(pm)
+        return parameter_maps
+
+    def score(self, i):
+        """Score of a stored result, with per-label measures if recorded
+
+        :type i: int
+        :rtype: float
+        """
+        meta = self.meta(i)
+        if 'labels' not in meta and 'measures' not in meta:
+            return meta['score']
+        return Score(meta['score'],
+                     dict((int(k), v)
+                          for k, v in meta.get('labels', {}).items()),
+                     meta.get('measures'))
+
+    def segmentation(self, i):
+        """Segmentation of a stored result on its original grid and pixel type
+
+        :type i: int
+        :rtype: SimpleITK.Image
+        """
+        meta = self.meta(i)
+        cropped = np.lib.format.read_array(
+            io.BytesIO(self._zip.read('seg-{}.npy'.format(i))))
+        data = np.zeros(meta['shape'], cropped.dtype)
+        data[tuple(slice(a, b) for a, b in meta['box'])] = cropped
+        image = sitk.GetImageFromArray(data)
+        image.SetOrigin(meta['origin'])
+        image.SetSpacing(meta['spacing'])
+        image.SetDirection(meta['direction'])
+        return sitk.Cast(image, meta['pixel_id'])
+
+    def result(self, i):
+        """Rebuild a stored result
+
+        :type i: int
+        :returns: Result in the format of amsaf_eval return value
+        :rtype: [[SimpleITK.ParameterMap], SimpleITK.Image, float]
+        """
+        return [self.parameter_maps(i), self.segmentation(i), self.score(i)]
+
+    def close(self):
+        """Finish writing the store file
+
+        :rtype: None
+        """
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return 'ResultStore({!r})'.format(self.path)
+
+
+def recover(path):
+    """Rebuild a store file that wasn't closed, e.g. because the process
+    writing it was killed
+
+    The zip index is rebuilt from the results that were written completely.
+    A result that was being written is dropped.
+
+    :param path: Path to the store file
+    :type path: str
+    :returns: Number of results recovered
+    :rtype: int
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    tmp_path = path + '.recover'
+    n = 0
+    seg = None
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as recovered:
+        for name, data in _local_members(path):
+            if name == 'seg-{}.npy'.format(n):
+                seg = data
+                continue
+            if name != 'meta-{}.json'.format(n) or seg is None:
+                break
+            try:
+                json.loads(data.decode('utf-8'))
+            except ValueError:
+                break
+            recovered.writestr('seg-{}.npy'.format(n), seg)
+            recovered.writestr(name, data)
+            n += 1
+            seg = None
+    os.rename(tmp_path, path)
+    return n
+
+
+def _local_members(path):
+    # (name, data) of the members of a zip file in file order, read from
+    # their local headers rather than the index. Stops at the first member
+    # that wasn't written completely.
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(zipfile.sizeFileHeader)
+            if len(header) < zipfile.sizeFileHeader:
+                return
+            (signature, _, _, flags, method, _, _, crc, compressed_size,
+             size, name_length, extra_length) = struct.unpack(
+                zipfile.structFileHeader, header)
+            # Sizes of streamed or zip64 members aren't in the header.
+            if signature != zipfile.stringFileHeader or flags & 0x08 or \
+                    compressed_size == 0xFFFFFFFF:
+                return
+            name = f.read(name_length).decode('utf-8')
+            f.read(extra_length)
+            data = f.read(compressed_size)
+            if len(data) < compressed_size:
+                return
+            try:
+                if method == zipfile.ZIP_DEFLATED:
+                    data = zlib.decompress(data, -15)
+                elif method != zipfile.ZIP_STORED:
+                    return
+            except zlib.error:
+                return
+            if len(data) != size or zlib.crc32(data) & 0xFFFFFFFF != crc:
+                return
+            yield name, data
+
+
+def _bounding_box(data):
+    # [start, stop) per array axis of the nonzero voxels; empty if none are.
+    nonzero = np.nonzero(data)
+    if not len(nonzero[0]):
+        return [[0, 0] for _ in data.shape]
+    return [[int(idx.min()), int(idx.max()) + 1] for idx in nonzero]
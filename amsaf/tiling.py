@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: tiling
+   :synopsis: Overlapping tiles of large volumes and stitching them back
+
+tiles lazily yields overlapping patches of a volume, each a SimpleITK.Image
+whose origin places it correctly in physical space. If the volume is given
+as a path, each patch is read from disk on its own, so the whole volume
+never has to be in memory. Stitcher blends processed patches back into a
+full image, averaging intensities or voting labels where patches overlap.
+Its accumulators can be memory-mapped files, so only the stitched image
+itself has to fit in memory.
+"""
+
+import itertools
+import tempfile
+
+import numpy as np
+
+import SimpleITK as sitk
+
+
+def tile_regions(size, tile_size, overlap=0):
+    """Start indices and sizes of overlapping tiles covering an image
+
+    Tiles are tile_size voxels wide, except where the image is smaller, and
+    neighbors share overlap voxels along each axis. The last tile along an
+    axis is shifted back so that it ends on the image border.
+
+    :param size: Image size in SimpleITK (x, y, z) order
+    :param tile_size: Tile size, either one int or one per axis
+    :param overlap: Overlap between neighboring tiles, either one int or one
+                    per axis
+    :type size: (int, int, int)
+    :type tile_size: int or (int, int, int)
+    :type overlap: int or (int, int, int)
+    :returns: (start, size) pairs in (x, y, z) order
+    :rtype: [((int, int, int), (int, int, int))]
+    """
+    tile_size = _per_axis(tile_size, len(size))
+    overlap = _per_axis(overlap, len(size))
+    axes = []
+    for n, t, o in zip(size, tile_size, overlap):
+        t = min(t, n)
+        if o >= t and t < n:
+            raise ValueError("Overlap must be smaller than the tile size")
+        starts = []
+        start = 0
+        while True:
+            start = min(start, n - t)
+            starts.append(start)
+            if start + t >= n:
+                break
+            start += t - o
+        axes.append([(s, t) for s in starts])
+    return [(tuple(s for s, _ in region), tuple(t for _, t in region))
+            for region in itertools.product(*axes)]
+
+
+def tiles(img, tile_size, overlap=0):
+    """Lazily yield overlapping tiles of an image
+
+    :param img: Image to tile, or a path to it. Tiles of a path are read one
+                at a time, which avoids loading the whole volume for file
+                formats that support streamed reads (e.g. .mha, .nrrd).
+    :param tile_size: Tile size, either one int or one per axis
+    :param overlap: Overlap between neighboring tiles, either one int or one
+                    per axis
+    :type img: SimpleITK.Image or str
+    :type tile_size: int or (int, int, int)
+    :type overlap: int or (int, int, int)
+    :returns: Tiles carrying their own origin, spacing and direction
+    :rtype: generator
+    """
+    if isinstance(img, sitk.Image):
+        for start, size in tile_regions(img.GetSize(), tile_size, overlap):
+            yield img[tuple(slice(s, s + n) for s, n in zip(start, size))]
+        return
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(img)
+    reader.ReadImageInformation()
+    for start, size in tile_regions(reader.GetSize(), tile_size, overlap):
+        reader.SetExtractIndex(start)
+        reader.SetExtractSize(size)
+        yield reader.Execute()
+
+
+class Stitcher(object):
+    """Blend processed tiles back into a full image
+
+    Each tile is placed by its physical origin. Where tiles overlap,
+    intensities are averaged with weights that ramp down over the overlap,
+    which hides seams; with labels=True each voxel instead takes its label
+    from the tile whose weight there is highest, so no new labels are made
+    up.
+
+    :param reference: Image, or path to an image, whose grid the result is
+                      on. Only its metadata is used.
+    :param overlap: Overlap the tiles were made with, either one int or one
+                    per axis
+    :param labels: Optional. If True, stitch a label map instead of
+                   intensities.
+    :param pixel_type: Optional SimpleITK pixel type of the result. Defaults
+                       to sitkFloat32 for intensities and to the tiles' type
+                       for labels.
+    :param scratch_dir: Optional directory to keep the weights and blended
+                        values in as memory-mapped temporary files instead of
+                        in memory.
+    :type reference: SimpleITK.Image or str
+    :type overlap: int or (int, int, int)
+    :type labels: bool
+    :type pixel_type: int
+    :type scratch_dir: str
+    """
+
+    def __init__(self, reference, overlap=0, labels=False, pixel_type=None,
+                 scratch_dir=None):
+        if not isinstance(reference, sitk.Image):
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(reference)
+            reader.ReadImageInformation()
+            reference = reader
+        self.size = tuple(reference.GetSize())
+        self.origin = np.array(reference.GetOrigin())
+        self.spacing = tuple(reference.GetSpacing())
+        self.direction = tuple(reference.GetDirection())
+        self.overlap = _per_axis(overlap, len(self.size))
+        self.labels = labels
+        self.pixel_type = pixel_type
+        self.scratch_dir = scratch_dir
+
+        dim = len(self.size)
+        matrix = np.array(self.direction).reshape(dim, dim) * self.spacing
+        self._physical_to_index = np.linalg.inv(matrix)
+        self._weights = self._zeros(np.float32)
+        self._values = None
+        self._stitched = False
+
+    def add(self, tile):
+        """Blend a tile into the result
+
+        :param tile: Tile on the reference grid, e.g. the processed output of
+                     a tile from amsaf.tiling.tiles
+        :type tile: SimpleITK.Image
+        :rtype: None
+        """
+        if self._stitched:
+            raise ValueError("Tiles can't be added after result")
+        start = self._index(tile.GetOrigin())
+        region = tuple(slice(s, s + n) for s, n in
+                       zip(start[::-1], tile.GetSize()[::-1]))
+        data = sitk.GetArrayViewFromImage(tile)
+        weights = _ramp(data.shape, self.overlap[::-1])
+
+        if self._values is None:
+            dtype = data.dtype if self.labels else np.float32
+            self._values = self._zeros(dtype)
+
+        if self.labels:
+            better = weights > self._weights[region]
+            self._values[region][better] = data[better]
+            np.maximum(self._weights[region], weights,
+                       out=self._weights[region])
+        else:
+            self._values[region] += data * weights
+            self._weights[region] += weights
+
+    def result(self):
+        """The stitched image on the reference grid
+
+        Intensities are normalized in place and the accumulators are released,
+        so result can only be taken once.
+
+        :rtype: SimpleITK.Image
+        """
+        if self._stitched:
+            raise ValueError("Result has already been taken")
+        if self._values is None:
+            raise ValueError("No tiles have been added")
+        values, weights = self._values, self._weights
+        if not self.labels:
+            np.divide(values, weights, out=values, where=weights > 0)
+        image = sitk.GetImageFromArray(values)
+        self._values = self._weights = values = weights = None
+        self._stitched = True
+        image.SetOrigin(tuple(self.origin))
+        image.SetSpacing(self.spacing)
+        image.SetDirection(self.direction)
+        if self.pixel_type is not None:
+            image = sitk.Cast(image, self.pixel_type)
+        return image
+
+    def _zeros(self, dtype):
+        shape = self.size[::-1]
+        if self.scratch_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        # The temporary file has no name, so it goes away with the map.
+        return np.memmap(tempfile.TemporaryFile(dir=self.scratch_dir),
+                         dtype=dtype, mode='w+', shape=shape)
+
+    def _index(self, point):
+        index = self._physical_to_index.dot(np.array(point) - self.origin)
+        return tuple(int(round(i)) for i in index)
+
+
+def _per_axis(value, dim):
+    if isinstance(value, (list, tuple)):
+        return tuple(value)
+    return (value,) * dim
+
+
+def _ramp(shape, overlap):
+    # Separable weights rising linearly over the overlap at each tile edge.
+    weights = np.ones(shape, dtype=np.float32)
+    for axis, (n, o) in enumerate(zip(shape, overlap)):
+        i = np.arange(n, dtype=np.float32)
+        ramp = np.minimum(np.minimum(i + 1, n - i) / (o + 1), 1)
+        view = [1] * len(shape)
+        view[axis] = n
+        weights *= ramp.reshape(view)
+    return weights
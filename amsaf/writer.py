@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+.. module:: writer
+   :synopsis: Background writes of results with backpressure
+
+A ResultWriter runs writes on a small thread pool so that the search loop
+does not wait on the disk. At most max_pending writes are queued at a time;
+submitting more blocks until one finishes, so memory held by results waiting
+to be written stays bounded when the disk is slower than the search.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ResultWriter(object):
+    """Bounded queue of writes run on a thread pool
+
+    Errors raised by a write are re-raised by the next call to submit, flush
+    or close. Use as a context manager to flush and shut down on exit.
+
+    :param n_threads: Number of writer threads
+    :param max_pending: Maximum number of queued or running writes before
+                        submit blocks
+    :type n_threads: int
+    :type max_pending: int
+    """
+
+    def __init__(self, n_threads=2, max_pending=8):
+        if n_threads < 1 or max_pending < 1:
+            raise ValueError("n_threads and max_pending must be positive")
+        self._pool = ThreadPoolExecutor(max_workers=n_threads)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._errors = []
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs), blocking while the queue is full
+
+        :type fn: callable
+        :rtype: None
+        """
+        self._raise()
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def flush(self):
+        """Wait for every queued write to finish
+
+        :rtype: None
+        """
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                break
+            for future in pending:
+                future.exception()
+        self._raise()
+
+    def close(self):
+        """Flush and shut down the writer threads
+
+        :rtype: None
+        """
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def _raise(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pool.shutdown(wait=True)
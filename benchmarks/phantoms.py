@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic 3D phantoms with known labels and deformations."""
+
+import numpy as np
+
+import SimpleITK as sitk
+
+
+PIXEL_TYPES = {
+    'uint8': (np.uint8, sitk.sitkUInt8),
+    'int16': (np.int16, sitk.sitkInt16),
+    'uint16': (np.uint16, sitk.sitkUInt16),
+    'float32': (np.float32, sitk.sitkFloat32),
+}
+
+
+def phantom(size, pixel_type='float32', n_labels=3, seed=0):
+    """Noisy volume of nested ellipsoids and its label map
+
+    Label i is the shell between the i-th and (i + 1)-th ellipsoid, each with
+    its own mean intensity, so registration has edges to lock onto and every
+    label has a distinct surface.
+
+    :param size: Edge length in voxels, or (x, y, z) size
+    :param pixel_type: Key of PIXEL_TYPES for the intensity image
+    :param n_labels: Number of labels
+    :param seed: Seed of the noise
+    :type size: int or (int, int, int)
+    :type pixel_type: str
+    :type n_labels: int
+    :type seed: int
+    :returns: (image, segmentation) with 1mm isotropic spacing
+    :rtype: (SimpleITK.Image, SimpleITK.Image)
+    """
+    if isinstance(size, int):
+        size = (size, size, size)
+    dtype, _ = PIXEL_TYPES[pixel_type]
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, n) for n in size[::-1]],
+                          indexing='ij')
+    radius = np.sqrt((x / 0.8) ** 2 + (y / 0.6) ** 2 + (z / 0.7) ** 2)
+
+    labels = np.zeros(radius.shape, dtype=np.uint8)
+    for i in range(n_labels):
+        labels[radius < 1.0 - i / float(n_labels + 1)] = i + 1
+
+    rng = np.random.RandomState(seed)
+    intensity = labels * (200.0 / n_labels) + rng.normal(0, 5, labels.shape)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        intensity = np.clip(np.round(intensity), info.min, info.max)
+
+    image = sitk.GetImageFromArray(intensity.astype(dtype))
+    segmentation = sitk.GetImageFromArray(labels)
+    return image, segmentation
+
+
+def deformation(reference, shift=(2.0, -1.0, 1.0), amplitude=1.5):
+    """Known transform: a translation plus a smooth sinusoidal warp
+
+    :param reference: Image whose grid the displacement field is defined on
+    :param shift: Translation in physical units
+    :param amplitude: Peak displacement of the warp in physical units
+    :type reference: SimpleITK.Image
+    :type shift: (float, float, float)
+    :type amplitude: float
+    :rtype: SimpleITK.Transform
+    """
+    size = reference.GetSize()
+    z, y, x = np.meshgrid(*[np.linspace(0, 2 * np.pi, n) for n in size[::-1]],
+                          indexing='ij')
+    field = np.stack([shift[0] + amplitude * np.sin(y) * np.cos(z),
+                      shift[1] + amplitude * np.sin(z) * np.cos(x),
+                      shift[2] + amplitude * np.sin(x) * np.cos(y)], axis=-1)
+    field_image = sitk.GetImageFromArray(field.astype(np.float64),
+                                         isVector=True)
+    field_image.CopyInformation(reference)
+    return sitk.DisplacementFieldTransform(field_image)
+
+
+def case(size, pixel_type='float32', n_labels=3, seed=0):
+    """The four amsaf_eval inputs for a phantom and a deformed copy of it
+
+    :returns: (unsegmented_image, ground_truth, segmented_image, segmentation)
+    :rtype: (SimpleITK.Image, SimpleITK.Image, SimpleITK.Image, SimpleITK.Image)
+    """
+    image, segmentation = phantom(size, pixel_type, n_labels, seed)
+    transform = deformation(image)
+    deformed = sitk.Resample(image, image, transform, sitk.sitkLinear, 0.0,
+                             image.GetPixelID())
+    deformed_labels = sitk.Resample(segmentation, segmentation, transform,
+                                    sitk.sitkNearestNeighbor, 0,
+                                    segmentation.GetPixelID())
+    return deformed, deformed_labels, image, segmentation
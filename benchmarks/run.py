@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark the hot paths of amsaf on synthetic phantoms
+
+Every (stage, size, pixel type) case runs in a fresh child process, so its
+peak resident set size is its own. Results are written as JSON and can be
+compared against the results of another version::
+
+    python -m benchmarks.run --output new.json
+    python -m benchmarks.run --output new.json --compare old.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import time
+import platform
+import argparse
+import resource
+import multiprocessing
+
+import SimpleITK as sitk
+from sklearn.model_selection import ParameterGrid
+
+import amsaf
+from amsaf import amsaf as A
+from amsaf.scoring import OverlapScorer
+
+from .phantoms import PIXEL_TYPES, case
+
+
+def _quick_priors(iterations, n_candidates):
+    # The default priors with fewer iterations, trimmed to a sweep of
+    # n_candidates bspline Metric0Weight values.
+    priors = []
+    for prior in A._get_default_vector():
+        prior = dict((k, list(v[:1])) for k, v in prior.items())
+        prior['MaximumNumberOfIterations'] = [str(iterations)]
+        priors.append(prior)
+    priors[2]['Metric0Weight'] = list(
+        A._get_default_bspline()['Metric0Weight'][:n_candidates])
+    return priors
+
+
+def _setup(stage, images, args):
+    # Returns a callable timing one run of stage on the phantom images.
+    unsegmented_image, ground_truth, segmented_image, segmentation = images
+    priors = _quick_priors(args.iterations, args.sweep_candidates)
+    maps = next(A._param_vectors(priors))
+
+    if stage == 'register':
+        return lambda: A.register(unsegmented_image, segmented_image, maps)
+    if stage == 'register_flat_pyramid':
+        # Same as 'register' with every pyramid level at full resolution and
+        # unsmoothed. The difference is what Elastix spends building image
+        # pyramids in each call.
+        flat = [_flat_pyramid(pm) for pm in maps]
+        return lambda: A.register(unsegmented_image, segmented_image, flat)
+    if stage == 'register_indv':
+        return lambda: A.register_indv(unsegmented_image, segmented_image,
+                                       'rigid', maps[0])
+    if stage == 'to_elastix':
+        points = [next(iter(ParameterGrid(prior))) for prior in priors]
+        return lambda: [A._to_elastix(pm, t) for pm, t in
+                        zip(points, ['rigid', 'affine', 'bspline'])
+                        for _ in range(100)]
+    if stage == 'transform':
+        _, tpms = A.register(unsegmented_image, segmented_image, maps)
+        tpms = A._nn_assoc(tpms)
+        return lambda: A.transform(segmentation, tpms)
+    if stage == 'segment':
+        return lambda: A.segment(unsegmented_image, segmented_image,
+                                 segmentation, maps)
+    if stage == 'sim_score':
+        return lambda: _sim_score(segmentation, ground_truth)
+    if stage == 'scorer':
+        scorer = OverlapScorer(ground_truth, surface_distances=True)
+        return lambda: scorer(segmentation)
+    if stage == 'split_crop':
+        size = unsegmented_image.GetSize()
+        mid = [n // 2 for n in size]
+        return lambda: (A.split_x(unsegmented_image, mid[0], padding=True),
+                        A.split_y(unsegmented_image, mid[1]),
+                        A.split_z(unsegmented_image, mid[2]),
+                        A.crop(unsegmented_image, [n // 4 for n in size],
+                               [3 * n // 4 for n in size]))
+    if stage == 'amsaf_eval':
+        return lambda: list(A.amsaf_eval(*images, parameter_priors=priors))
+    if stage == 'amsaf_eval_memoize':
+        return lambda: list(A.amsaf_eval(*images, parameter_priors=priors,
+                                         memoize=True))
+    raise ValueError("Unknown stage {}".format(stage))
+
+
+def _sim_score(candidate, ground_truth):
+    # How amsaf scored candidates before OverlapScorer, kept as the baseline
+    # that the 'scorer' stage is compared against.
+    candidate = sitk.Cast(candidate, ground_truth.GetPixelID())
+    candidate.CopyInformation(ground_truth)
+
+    overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
+    overlap_filter.Execute(ground_truth, candidate)
+    return overlap_filter.GetDiceCoefficient()
+
+
+def _flat_pyramid(pm):
+    # The generic pyramid takes shrink factors and smoothing sigmas as
+    # separate schedules; the smoothing pyramids of the default maps derive
+    # sigma from the shrink factor.
+    pm = dict((k, list(v)) for k, v in pm.items())
+    levels = int(float(pm['NumberOfResolutions'][0]))
+    for image in ('Fixed', 'Moving'):
+        pm[image + 'ImagePyramid'] = [image + 'GenericImagePyramid']
+        pm.pop(image + 'ImagePyramidSchedule', None)
+        pm[image + 'ImagePyramidRescaleSchedule'] = ['1'] * (3 * levels)
+        pm[image + 'ImagePyramidSmoothingSchedule'] = ['0'] * (3 * levels)
+    return pm
+
+
+STAGES = ('to_elastix', 'split_crop', 'sim_score', 'scorer', 'register_indv',
+          'register', 'register_flat_pyramid', 'transform', 'segment', 'amsaf_eval',
+          'amsaf_eval_memoize')
+
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _run_case(stage, size, pixel_type, args, conn):
+    # Elastix writes its result files to the working directory.
+    workdir = tempfile.mkdtemp(prefix='amsaf-bench-')
+    os.chdir(workdir)
+    try:
+        images = case(size, pixel_type)
+        fn = _setup(stage, images, args)
+        setup_rss = _peak_rss()
+        wall, cpu = [], []
+        for _ in range(args.repeat):
+            start_wall, start_cpu = time.time(), time.process_time()
+            fn()
+            wall.append(time.time() - start_wall)
+            cpu.append(time.process_time() - start_cpu)
+        conn.send({'wall': wall, 'cpu': cpu, 'peak_rss': _peak_rss(),
+                   'setup_rss': setup_rss,
+                   'voxels': images[0].GetNumberOfPixels()})
+    except Exception as e:
+        conn.send({'error': '{}: {}'.format(type(e).__name__, e)})
+    finally:
+        conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_case(stage, size, pixel_type, args):
+    """Benchmark one stage on one phantom in a child process
+
+    :rtype: dict
+    """
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=_run_case, args=(stage, size, pixel_type, args, child))
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+
+    result.update({'stage': stage, 'size': size, 'pixel_type': pixel_type,
+                   'repeat': args.repeat})
+    if 'wall' in result:
+        best = min(result['wall'])
+        result['median_wall'] = sorted(result['wall'])[len(result['wall']) // 2]
+        result['voxels_per_second'] = result['voxels'] / best if best else None
+    return result
+
+
+def environment():
+    """Versions and machine the benchmarks ran on
+
+    :rtype: dict
+    """
+    return {
+        'amsaf': amsaf.__version__,
+        'python': platform.python_version(),
+        'simpleitk': sitk.Version_VersionString(),
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'threads': sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(),
+        'created': time.time(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print median wall time ratios against a baseline
+
+    :returns: Cases slower than threshold times their baseline
+    :rtype: [dict]
+    """
+    index = dict(((r['stage'], r['size'], r['pixel_type']), r)
+                 for r in baseline['results'] if 'median_wall' in r)
+    regressions = []
+    for r in results:
+        old = index.get((r['stage'], r['size'], r['pixel_type']))
+        if old is None or 'median_wall' not in r:
+            continue
+        ratio = r['median_wall'] / old['median_wall']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(r)
+        print('{:<20} {:>5} {:<8} {:9.4f}s -> {:9.4f}s  x{:.2f}{}'.format(
+            r['stage'], r['size'], r['pixel_type'], old['median_wall'],
+            r['median_wall'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        default=list(STAGES))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[32, 48])
+    parser.add_argument('--pixel-types', nargs='+', choices=sorted(PIXEL_TYPES),
+                        default=['float32', 'int16'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=64,
+                        help='MaximumNumberOfIterations of every stage')
+    parser.add_argument('--sweep-candidates', type=int, default=2,
+                        help='Number of candidates in amsaf_eval sweeps')
+    parser.add_argument('--output', default='benchmarks.json')
+    parser.add_argument('--compare', help='Baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    results = []
+    for stage in args.stages:
+        for size in args.sizes:
+            for pixel_type in args.pixel_types:
+                result = run_case(stage, size, pixel_type, args)
+                results.append(result)
+                if 'error' in result:
+                    print('{:<20} {:>5} {:<8} {}'.format(
+                        stage, size, pixel_type, result['error']))
+                else:
+                    print('{:<20} {:>5} {:<8} {:9.4f}s  {:8.1f} MB'.format(
+                        stage, size, pixel_type, result['median_wall'],
+                        result['peak_rss'] / 2.0 ** 20))
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f,
+                  indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,7 +17,8 @@ requirements = [
     'scikit-learn',
     'numpy',
     'SimpleITK',
-    'click'
+    'click',
+    'futures; python_version < "3"'
 ]
 
 setup_requirements = [
@@ -3,6 +3,8 @@
 
 """Tests for `amsaf` package."""
 
+import os
+
 import pytest
 
 from click.testing import CliRunner
@@ -36,3 +38,613 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert '--help  Show this message and exit.' in help_result.output
+
+
+def test_param_vectors_cover_grid():
+    priors = [{'MaximumNumberOfIterations': ['16', '32']},
+              {'NumberOfResolutions': ['1', '2', '3']},
+              {'Metric0Weight': ['0.5', '1.0']}]
+    vectors = list(amsaf._param_vectors(priors))
+    assert len(vectors) == 2 * 3 * 2
+    assert all(len(pms) == 3 for pms in vectors)
+    assert vectors[0][2]['Transform'] == ('BSplineTransform',)
+
+
+def test_top_k_streams_with_stable_ties():
+    results = ([[i], None, score] for i, score in
+               enumerate([0.2, 0.9, 0.5, 0.9, 0.1]))
+    assert [r[0] for r in amsaf.top_k(2, results)] == [[1], [3]]
+
+    results = ([[i], None, score] for i, score in enumerate([0.2, 0.9]))
+    assert [r[-1] for r in amsaf.top_k(0, results)] == [0.9, 0.2]
+
+
+def test_split_and_crop_keep_metadata():
+    import numpy as np
+    import SimpleITK as sitk
+
+    data = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+    img = sitk.GetImageFromArray(data)
+    img.SetOrigin((1.0, 2.0, 3.0))
+    img.SetSpacing((0.5, 1.0, 2.0))
+
+    lower, upper = amsaf.split_x(img, 2)
+    assert lower.GetSize() == (2, 5, 4) and upper.GetSize() == (4, 5, 4)
+    assert upper.GetOrigin() == (2.0, 2.0, 3.0)
+    assert np.all(sitk.GetArrayFromImage(upper) == data[:, :, 2:])
+
+    _, padded = amsaf.split_z(img, 1, padding=True)
+    assert padded.GetSize() == img.GetSize()
+    assert padded.GetPixelID() == img.GetPixelID()
+    assert padded.GetOrigin() == img.GetOrigin()
+    assert np.all(sitk.GetArrayFromImage(padded)[0] == 0)
+
+    cropped = amsaf.crop(img, (1, 1, 1), (3, 4, 3))
+    assert cropped.GetSpacing() == img.GetSpacing()
+    assert np.all(sitk.GetArrayFromImage(cropped) == data[1:3, 1:4, 1:3])
+
+
+def test_write_stream_and_background_top_k(tmpdir):
+    import os
+    import numpy as np
+    import SimpleITK as sitk
+
+    seg = sitk.GetImageFromArray(np.ones((2, 3, 4), dtype=np.uint8))
+    pm = {'Transform': ('EulerTransform',)}
+    results = [[[pm], seg, score] for score in [0.2, 0.9, 0.5]]
+
+    streamed = amsaf.write_stream(iter(results), str(tmpdir.join('all')),
+                                  io_threads=2, max_pending=1)
+    amsaf.write_top_k(2, streamed, str(tmpdir.join('top')), io_threads=2)
+
+    assert sorted(os.listdir(str(tmpdir.join('all')))) == [
+        'candidate-0', 'candidate-1', 'candidate-2']
+    assert sorted(os.listdir(str(tmpdir.join('all', 'candidate-1')))) == [
+        'parameter-file-0.txt', 'score.txt', 'seg.nii']
+    with open(str(tmpdir.join('top', 'result-0', 'score.txt'))) as f:
+        assert f.read() == '0.9\n'
+
+    # Writing every result again replaces the earlier ones.
+    for _ in range(2):
+        amsaf.write_top_k(0, iter(results), str(tmpdir.join('every')))
+    assert sorted(os.listdir(str(tmpdir.join('every')))) == [
+        'result-0', 'result-1', 'result-2']
+    with open(str(tmpdir.join('every', 'result-2', 'score.txt'))) as f:
+        assert f.read() == '0.2\n'
+
+    # So are those of an earlier run with a larger k.
+    amsaf.write_top_k(1, iter(results), str(tmpdir.join('every')))
+    assert os.listdir(str(tmpdir.join('every'))) == ['result-0']
+    with open(str(tmpdir.join('every', 'result-0', 'score.txt'))) as f:
+        assert f.read() == '0.9\n'
+
+
+def test_roi_crop_keeps_physical_space():
+    import numpy as np
+    import SimpleITK as sitk
+
+    labels = np.zeros((20, 20, 20), dtype=np.uint8)
+    labels[8:11, 5:7, 12:14] = 1
+    seg = sitk.GetImageFromArray(labels)
+    seg.SetOrigin((-5.0, 0.0, 5.0))
+    seg.SetSpacing((0.5, 1.0, 2.0))
+
+    box = amsaf._physical_bounding_box(seg, 1.0)
+    np.testing.assert_allclose(box[0], (-5.0 + 6.0 - 1, 5.0 - 1, 5.0 + 16 - 1))
+    np.testing.assert_allclose(box[1], (-5.0 + 6.5 + 1, 6.0 + 1, 5.0 + 20 + 1))
+
+    roi = amsaf._crop_physical(seg, box)
+    assert roi.GetSize() == (6, 4, 5)
+    assert roi.GetSpacing() == seg.GetSpacing()
+    assert roi.GetOrigin() == seg.TransformIndexToPhysicalPoint((10, 4, 7))
+    assert sitk.GetArrayViewFromImage(roi).sum() == labels.sum()
+    assert amsaf._physical_bounding_box(seg * 0, 1.0) is None
+
+    pm = {'Transform': ('EulerTransform',), 'Size': ('9', '5', '3'),
+          'Origin': ('0', '0', '0')}
+    on_grid = amsaf._grid_assoc([pm], seg)[0]
+    assert on_grid['Size'] == ['20', '20', '20']
+    assert [float(x) for x in on_grid['Origin']] == [-5.0, 0.0, 5.0]
+    assert on_grid['Transform'] == ['EulerTransform']
+
+
+def test_downsample_keeps_extent_and_labels():
+    import numpy as np
+    import SimpleITK as sitk
+
+    labels = np.zeros((8, 12, 16), dtype=np.uint8)
+    labels[2:6, 3:9, 4:12] = 1
+    labels[3:5, 6:8, 6:10] = 2
+    seg = sitk.GetImageFromArray(labels)
+    seg.SetOrigin((1.0, 2.0, 3.0))
+    seg.SetSpacing((0.5, 0.5, 1.0))
+
+    small = amsaf.downsample(seg, 1.0, label=True)
+    assert small.GetSize() == (8, 6, 8)
+    assert small.GetSpacing() == (1.0, 1.0, 1.0)
+    assert small.GetPixelID() == seg.GetPixelID()
+    # The first voxel covers the first 2x2x1 voxels of seg.
+    assert small.GetOrigin() == (1.25, 2.25, 3.0)
+    assert set(np.unique(sitk.GetArrayFromImage(small))) == {0, 1, 2}
+
+    image = sitk.Cast(seg, sitk.sitkFloat32)
+    assert amsaf.downsample(image, 1.0).GetPixelID() == sitk.sitkFloat32
+
+
+def test_prune_cut():
+    scores = [0.2, 0.8, 0.5, 0.6]
+    assert amsaf._unpruned(scores, {'threshold': 0.55}) == [
+        False, True, False, True]
+    assert amsaf._unpruned(scores, {'quantile': 0.5}) == [
+        False, True, False, True]
+    assert amsaf._unpruned(scores, {'threshold': 0.7, 'quantile': 0.25}) == [
+        False, True, False, False]
+    assert amsaf._unpruned(scores, {}) == [True] * 4
+
+
+def _spacing_priors(spacings):
+    # Default priors reduced to one candidate per bspline grid spacing.
+    priors = [dict((k, v[:1]) for k, v in pm.items())
+              for pm in amsaf._get_default_vector()]
+    priors[2]['FinalGridSpacingInPhysicalUnits'] = list(spacings)
+    return priors
+
+
+def _spacing(parameter_maps):
+    return int(float(parameter_maps[2]['FinalGridSpacingInPhysicalUnits'][0]))
+
+
+def _stub_segment(monkeypatch, delays=None, fail=()):
+    # Replaces registration by a segmentation filled with the candidate's
+    # grid spacing, after sleeping delays[spacing] seconds.
+    import time
+    import numpy as np
+    import SimpleITK as sitk
+
+    calls = []
+
+    def segment(unsegmented_image, segmented_image, segmentation,
+                parameter_maps=None, verbose=False, num_threads=None,
+                cache=None, **kwargs):
+        spacing = _spacing(parameter_maps)
+        calls.append((spacing, num_threads, kwargs))
+        time.sleep((delays or {}).get(spacing, 0))
+        if spacing in fail:
+            raise RuntimeError('Registration of {} failed'.format(spacing))
+        return sitk.GetImageFromArray(
+            np.full((4, 5, 6), spacing, dtype=np.uint8))
+
+    monkeypatch.setattr(amsaf, 'segment', segment)
+    return calls
+
+
+def _stub_images():
+    import numpy as np
+    import SimpleITK as sitk
+
+    image = sitk.GetImageFromArray(np.zeros((4, 5, 6), dtype=np.uint8))
+    return image, None, image, image
+
+
+def _max_scorer(seg):
+    import SimpleITK as sitk
+    return float(sitk.GetArrayViewFromImage(seg).max())
+
+
+def test_parallel_eval_on_executor(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from amsaf import scheduler
+
+    monkeypatch.setattr(scheduler.CONFIG, 'cores', 6)
+    calls = _stub_segment(monkeypatch, delays={4: 0.4, 8: 0.2})
+    priors = _spacing_priors(['4', '8', '16'])
+    with ThreadPoolExecutor(3) as executor:
+        done = [_spacing(r[0]) for r in amsaf.amsaf_eval(
+            *_stub_images(), parameter_priors=priors, scorer=_max_scorer,
+            n_workers=3, executor=executor)]
+        ordered = [_spacing(r[0]) for r in amsaf.amsaf_eval(
+            *_stub_images(), parameter_priors=priors, scorer=_max_scorer,
+            n_workers=3, executor=executor, ordered=True)]
+    assert done == [16, 8, 4]
+    assert ordered == [4, 8, 16]
+    # Threads are split by n_workers rather than read from the executor.
+    assert set(c[1] for c in calls) == set([2])
+
+    del calls[:]
+    with ThreadPoolExecutor(3) as executor:
+        results = list(amsaf.amsaf_eval(
+            *_stub_images(), parameter_priors=priors, scorer=_max_scorer,
+            n_workers=1, executor=executor, ordered=True))
+    assert [float(r[2]) for r in results] == [4.0, 8.0, 16.0]
+    assert set(c[1] for c in calls) == set([6])
+
+
+def test_parallel_eval_raises_worker_failure(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    _stub_segment(monkeypatch, fail=(8,))
+    with ThreadPoolExecutor(2) as executor:
+        results = amsaf.amsaf_eval(
+            *_stub_images(), parameter_priors=_spacing_priors(['4', '8']),
+            scorer=_max_scorer, n_workers=2, executor=executor, ordered=True)
+        assert _spacing(next(results)[0]) == 4
+        with pytest.raises(RuntimeError, match='Registration of 8 failed'):
+            next(results)
+
+
+def _ellipsoid_images(shift=3, n=16):
+    # Tiny phantoms, segmented and unsegmented, that are quick to register.
+    import numpy as np
+    import SimpleITK as sitk
+
+    z, y, x = np.mgrid[:n, :n, :n]
+
+    def ellipsoid(s):
+        return ((x - n // 2 - s) / 1.5) ** 2 + (y - n // 2) ** 2 + \
+            (z - n // 2) ** 2 < 12
+
+    return (sitk.GetImageFromArray(ellipsoid(0).astype(np.float32) * 100),
+            sitk.GetImageFromArray(ellipsoid(0).astype(np.uint8)),
+            sitk.GetImageFromArray(ellipsoid(shift).astype(np.float32) * 100),
+            sitk.GetImageFromArray(ellipsoid(shift).astype(np.uint8)))
+
+
+def _quick_priors():
+    priors = [dict((k, v[:1]) for k, v in pm.items())
+              for pm in amsaf._get_default_vector()]
+    for pm in priors:
+        pm['MaximumNumberOfIterations'] = ['8']
+        pm['NumberOfResolutions'] = ['1']
+        pm['NumberOfSpatialSamples'] = ['256']
+    priors[1]['NumberOfSpatialSamples'] = ['256', '512']
+    priors[2]['GridSpacingSchedule'] = ['1']
+    priors[2]['Metric1Weight'] = ['0', '0.5']
+    return priors
+
+
+def test_memoize_matches_grid(tmpdir, monkeypatch):
+    from amsaf.journal import vector_key
+
+    monkeypatch.chdir(tmpdir)
+    images = _ellipsoid_images()
+    grid = sorted((vector_key(r[0]), float(r[2])) for r in amsaf.amsaf_eval(
+        *images, parameter_priors=_quick_priors()))
+    memoized = sorted((vector_key(r[0]), float(r[2])) for r in
+                      amsaf.amsaf_eval(*images,
+                                       parameter_priors=_quick_priors(),
+                                       memoize=True))
+    assert len(grid) == 4
+    # Candidates score differently, so a mixed up pairing would show.
+    assert len(set(score for _, score in grid)) > 1
+    assert memoized == grid
+    # Elastix and Transformix write their files to scratch directories, not
+    # the working directory.
+    assert tmpdir.listdir() == []
+
+
+def _subject_dirs(tmpdir, values):
+    # Segmented, unsegmented and segmentation directories holding a constant
+    # image per filename, filled with its value in values.
+    import numpy as np
+    import SimpleITK as sitk
+
+    dirs = [str(tmpdir.mkdir(d)) for d in ('seg', 'unseg', 'labels')]
+    for f, value in values.items():
+        for d in dirs:
+            sitk.WriteImage(sitk.GetImageFromArray(
+                np.full((4, 5, 6), value, dtype=np.uint8)),
+                os.path.join(d, f))
+    return dirs
+
+
+def _stub_seg_map_segment(monkeypatch, delays=None):
+    # Replaces registration by the unsegmented image, after sleeping
+    # delays[value] seconds.
+    import time
+    import SimpleITK as sitk
+
+    calls = []
+
+    def segment(unsegmented_image, segmented_image, segmentation,
+                parameter_maps=None, verbose=False, num_threads=None,
+                cache=None):
+        value = int(sitk.GetArrayViewFromImage(unsegmented_image).max())
+        calls.append((value, num_threads))
+        time.sleep((delays or {}).get(value, 0))
+        return unsegmented_image
+
+    monkeypatch.setattr(amsaf, 'segment', segment)
+    return calls
+
+
+def _value(image):
+    import SimpleITK as sitk
+    if not isinstance(image, sitk.Image):
+        image = sitk.ReadImage(image)
+    return int(sitk.GetArrayViewFromImage(image).max())
+
+
+def test_seg_map_keeps_filename_order(tmpdir, monkeypatch):
+    values = {'a.mha': 1, 'b.mha': 2, 'c.mha': 3, 'd.mha': 4}
+    segmented, unsegmented, labels = _subject_dirs(tmpdir, values)
+    calls = _stub_seg_map_segment(monkeypatch, delays={1: 0.1})
+    filenames = ['c.mha', 'a.mha', 'missing.mha', 'd.mha', 'b.mha']
+
+    segs = amsaf.seg_map(segmented, unsegmented, labels, filenames,
+                         io_threads=2)
+    assert [_value(seg) for seg in segs] == [3, 1, 4, 2]
+    assert [value for value, _ in calls] == [3, 1, 4, 2]
+
+    output_dir = str(tmpdir.join('out'))
+    paths = amsaf.seg_map(segmented, unsegmented, labels, filenames,
+                          io_threads=1, output_dir=output_dir)
+    assert paths == [os.path.join(output_dir, f)
+                     for f in ['c.mha', 'a.mha', 'd.mha', 'b.mha']]
+    assert [_value(path) for path in paths] == [3, 1, 4, 2]
+
+    with pytest.raises(ValueError):
+        amsaf.seg_map(segmented, unsegmented, labels, filenames, strict=True)
+
+
+def test_iter_seg_map_on_executor(tmpdir, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from amsaf import scheduler
+
+    values = {'a.mha': 1, 'b.mha': 2, 'c.mha': 3}
+    segmented, unsegmented, labels = _subject_dirs(tmpdir, values)
+    monkeypatch.setattr(scheduler.CONFIG, 'cores', 6)
+    calls = _stub_seg_map_segment(monkeypatch, delays={1: 0.4, 2: 0.2})
+    filenames = ['a.mha', 'b.mha', 'c.mha']
+
+    with ThreadPoolExecutor(3) as executor:
+        done = [(f, _value(seg)) for f, seg in amsaf.iter_seg_map(
+            segmented, unsegmented, labels, filenames, n_workers=3,
+            io_threads=2, executor=executor)]
+        ordered = [f for f, _ in amsaf.iter_seg_map(
+            segmented, unsegmented, labels, filenames, n_workers=3,
+            io_threads=2, executor=executor, ordered=True)]
+    assert done == [('c.mha', 3), ('b.mha', 2), ('a.mha', 1)]
+    assert ordered == filenames
+    assert set(threads for _, threads in calls) == set([2])
+
+
+def test_iter_seg_map_reads_inline(tmpdir, monkeypatch):
+    import threading
+
+    values = {'a.mha': 1, 'b.mha': 2}
+    segmented, unsegmented, labels = _subject_dirs(tmpdir, values)
+    _stub_seg_map_segment(monkeypatch)
+    read_image = amsaf.read_image
+    readers = []
+
+    def read_inline(path, **kwargs):
+        readers.append(threading.current_thread())
+        return read_image(path, **kwargs)
+
+    monkeypatch.setattr(amsaf, 'read_image', read_inline)
+    done = [(f, _value(seg)) for f, seg in amsaf.iter_seg_map(
+        segmented, unsegmented, labels, ['b.mha', 'a.mha'], io_threads=0)]
+    assert done == [('b.mha', 2), ('a.mha', 1)]
+    assert readers == [threading.current_thread()] * 6
+
+
+def _translation_map(image, offset):
+    # Transform parameter map translating by offset on the grid of image.
+    def values(xs):
+        return [repr(float(x)) for x in xs]
+
+    return {'Transform': ['TranslationTransform'],
+            'NumberOfParameters': ['3'],
+            'TransformParameters': values(offset),
+            'InitialTransformParameterFileName': ['NoInitialTransform'],
+            'FixedImageDimension': ['3'], 'MovingImageDimension': ['3'],
+            'Size': [str(n) for n in image.GetSize()],
+            'Index': ['0', '0', '0'],
+            'Spacing': values(image.GetSpacing()),
+            'Origin': values(image.GetOrigin()),
+            'Direction': values(image.GetDirection()),
+            'ResampleInterpolator': ['FinalBSplineInterpolator'],
+            'Resampler': ['DefaultResampler'],
+            'ResultImagePixelType': ['unsigned char']}
+
+
+def test_segment_registers_masked_roi(monkeypatch):
+    import numpy as np
+    import SimpleITK as sitk
+
+    data = np.zeros((20, 20, 20), dtype=np.uint8)
+    data[8:11, 5:7, 12:14] = 1
+    segmentation = sitk.GetImageFromArray(data)
+    segmentation.SetOrigin((-5.0, 0.0, 5.0))
+    image = sitk.Cast(segmentation, sitk.sitkFloat32) * 100
+
+    calls = []
+
+    def register(fixed_image, moving_image, parameter_maps=None,
+                 auto_init=True, verbose=False, num_threads=None, cache=None,
+                 fixed_mask=None, moving_mask=None):
+        calls.append((fixed_image, moving_image, fixed_mask, moving_mask))
+        return fixed_image, [sitk.ParameterMap(
+            _translation_map(fixed_image, (1, 0, 0)))]
+
+    monkeypatch.setattr(amsaf, 'register', register)
+    seg = amsaf.segment(image, image, segmentation, roi_margin=1.0,
+                        masks=True)
+
+    (fixed, moving, fixed_mask, moving_mask), = calls
+    assert fixed.GetSize() == moving.GetSize() == (4, 4, 5)
+    assert fixed.GetOrigin() == segmentation.TransformIndexToPhysicalPoint(
+        (11, 4, 7))
+    assert sitk.GetArrayViewFromImage(fixed_mask).sum() == data.sum()
+    assert sitk.GetArrayViewFromImage(moving_mask).sum() == data.sum()
+    # The translation found on the region is applied on the full grid.
+    assert seg.GetSize() == segmentation.GetSize()
+    assert seg.GetOrigin() == segmentation.GetOrigin()
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(seg),
+                                  np.roll(data, -1, axis=2))
+
+
+def _box_images(n=16):
+    # Images with a labelled box, and a function of the same box shrunk by
+    # some voxels.
+    import numpy as np
+    import SimpleITK as sitk
+
+    def box(shrink=0):
+        data = np.zeros((n, n, n), dtype=np.uint8)
+        data[4:12 - shrink, 4:12, 4:12] = 1
+        return sitk.GetImageFromArray(data)
+
+    image = sitk.Cast(box(), sitk.sitkFloat32) * 100
+    return (image, box(), image, box()), box
+
+
+def _stub_box_segment(monkeypatch, box):
+    # Replaces registration by the box shrunk by the candidate's grid
+    # spacing / 4 - 1 voxels, resampled onto unsegmented_image.
+    import SimpleITK as sitk
+
+    calls = []
+
+    def segment(unsegmented_image, segmented_image, segmentation,
+                parameter_maps=None, verbose=False, num_threads=None,
+                cache=None):
+        spacing = _spacing(parameter_maps)
+        calls.append((spacing, unsegmented_image.GetSize()))
+        return sitk.Resample(box(spacing // 4 - 1), unsegmented_image,
+                             sitk.Transform(), sitk.sitkNearestNeighbor)
+
+    monkeypatch.setattr(amsaf, 'segment', segment)
+    return calls
+
+
+def test_proxy_search_promotes_best_on_proxy(monkeypatch):
+    images, box = _box_images()
+    calls = _stub_box_segment(monkeypatch, box)
+    reports = []
+    results = list(amsaf.amsaf_eval(
+        *images, parameter_priors=_spacing_priors(['16', '4', '8']),
+        search='proxy', search_options={'n_promote': 2,
+                                        'report': reports.append}))
+
+    assert calls[:3] == [(16, (8, 8, 8)), (4, (8, 8, 8)), (8, (8, 8, 8))]
+    assert sorted(calls[3:]) == [(4, (16, 16, 16)), (8, (16, 16, 16))]
+    assert sorted(_spacing(r[0]) for r in results) == [4, 8]
+    assert max(float(r[2]) for r in results) == pytest.approx(1.0)
+    report, = reports
+    assert (report['n_screened'], report['n_promoted']) == (3, 2)
+    assert report['spearman'] == pytest.approx(1.0)
+
+
+def test_proxy_search_shares_colliding_proxies(monkeypatch):
+    images, box = _box_images()
+    calls = _stub_box_segment(monkeypatch, box)
+    priors = _spacing_priors(['16', '4'])
+    # Both sample counts are cut down to the same proxy sample count.
+    priors[1]['NumberOfSpatialSamples'] = ['2048', '2050']
+    reports = []
+    results = list(amsaf.amsaf_eval(
+        *images, parameter_priors=priors, search='proxy',
+        search_options={'n_promote': 4, 'report': reports.append}))
+
+    assert calls[:2] == [(16, (8, 8, 8)), (4, (8, 8, 8))]
+    assert sorted(calls[2:]) == [(4, (16, 16, 16))] * 2 + \
+        [(16, (16, 16, 16))] * 2
+    assert len(results) == 4
+    assert reports[0]['n_screened'] == 4
+
+
+def test_memoized_proxy_search_shares_colliding_proxies(monkeypatch):
+    images, box = _box_images()
+    registered = _stub_stages(monkeypatch, box)
+    monkeypatch.setattr(amsaf, 'segment', lambda *args, **kwargs: box())
+    priors = [dict((k, v[:1]) for k, v in pm.items())
+              for pm in amsaf._get_default_vector()]
+    for pm in priors:
+        pm['MaximumNumberOfIterations'] = ['10']
+    priors[1]['NumberOfSpatialSamples'] = ['2048', '2050']
+    priors[2]['MaximumNumberOfIterations'] = ['10', '20']
+    reports = []
+    results = list(amsaf.amsaf_eval(
+        *images, parameter_priors=priors, memoize=True, search='proxy',
+        search_options={'n_promote': 4, 'report': reports.append}))
+
+    assert registered == [('rigid', 10), ('affine', 10), ('bspline', 10),
+                          ('bspline', 20)]
+    assert len(results) == 4
+    assert reports[0]['n_screened'] == 4
+
+
+def _stub_stages(monkeypatch, box):
+    # Replaces stage registrations by maps recording how many voxels each
+    # stage shrinks the box by, and transformation by the box shrunk by all
+    # of them.
+    import SimpleITK as sitk
+
+    shrink = {'rigid': {10: 0, 20: 3}, 'affine': {10: 0, 20: 1},
+              'bspline': {10: 0, 20: 1}}
+    registered = []
+
+    def register_indv(fixed_image, moving_image, transform_type,
+                      parameter_map=None, auto_init=True, verbose=False,
+                      num_threads=None, initial_transform=None, cache=None,
+                      initial_key=None):
+        iterations = int(float(parameter_map['MaximumNumberOfIterations'][0]))
+        registered.append((transform_type, iterations))
+        return fixed_image, [sitk.ParameterMap({
+            'Transform': [transform_type],
+            'Shrink': [str(shrink[transform_type][iterations])]})]
+
+    def transform(image, parameter_maps, verbose=False, cache=None,
+                  num_threads=None):
+        shrunk = box(sum(int(pm['Shrink'][0]) for pm in parameter_maps))
+        return sitk.Resample(shrunk, image, sitk.Transform(),
+                             sitk.sitkNearestNeighbor)
+
+    monkeypatch.setattr(amsaf, 'register_indv', register_indv)
+    monkeypatch.setattr(amsaf, 'transform', transform)
+    return registered
+
+
+def test_prune_drops_subtrees(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    images, box = _box_images()
+    registered = _stub_stages(monkeypatch, box)
+    priors = [dict((k, v[:1]) for k, v in pm.items())
+              for pm in amsaf._get_default_vector()]
+    for pm in priors:
+        pm['MaximumNumberOfIterations'] = ['10', '20']
+
+    def iterations(result):
+        return tuple(int(float(pm['MaximumNumberOfIterations'][0]))
+                     for pm in result[0])
+
+    full = list(amsaf.amsaf_eval(*images, parameter_priors=priors,
+                                 memoize=True))
+    assert len(full) == 8
+    del registered[:]
+
+    reports = []
+    pruned = list(amsaf.amsaf_eval(
+        *images, parameter_priors=priors,
+        prune={'quantile': 0.5, 'report': reports.append}))
+    # The second rigid map and, below the first, the second affine map
+    # score worse on their prefix and are dropped with their subtrees.
+    assert sorted(iterations(r) for r in pruned) == [(10, 10, 10),
+                                                     (10, 10, 20)]
+    assert len(registered) == 6
+    report, = reports
+    assert (report['rigid_pruned'], report['affine_pruned']) == (1, 1)
+    assert report['registrations'] == 6
+    assert report['registrations_saved'] == 8
+    scores = dict((iterations(r), float(r[2])) for r in full)
+    assert [float(r[2]) for r in pruned] == [scores[iterations(r)]
+                                             for r in pruned]
+
+    with ThreadPoolExecutor(2) as executor:
+        parallel = list(amsaf.amsaf_eval(
+            *images, parameter_priors=priors, n_workers=2,
+            executor=executor, prune={'quantile': 0.5, 'report': None}))
+    assert sorted(iterations(r) for r in parallel) == \
+        sorted(iterations(r) for r in pruned)
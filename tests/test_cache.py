@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.cache`."""
+
+import numpy as np
+import SimpleITK as sitk
+
+from amsaf.cache import RegistrationCache, seeded
+
+
+def _image(value):
+    return sitk.GetImageFromArray(np.full((4, 5, 6), value, dtype=np.uint8))
+
+
+def test_key_ignores_parameter_map_order(tmpdir):
+    cache = RegistrationCache(str(tmpdir))
+    a = {'Transform': ['EulerTransform'], 'NumberOfResolutions': ['3']}
+    b = {'NumberOfResolutions': ('3',), 'Transform': ('EulerTransform',)}
+    assert cache.key(_image(1), a) == cache.key(_image(1), b)
+    assert cache.key(_image(1), a) != cache.key(_image(2), a)
+
+
+def test_roundtrip_and_eviction(tmpdir):
+    cache = RegistrationCache(str(tmpdir))
+    pm = seeded({'Transform': ['EulerTransform']})
+    key = cache.key('register', _image(1), [pm])
+    assert cache.get(key) is None
+
+    cache.put(key, _image(1), [pm])
+    image, pms = cache.get(key)
+    assert np.all(sitk.GetArrayFromImage(image) == 1)
+    assert pms[0]['RandomSeed'] == ('121212',)
+
+    cache.evict(0)
+    assert cache.get(key) is None
+
+
+def test_capped_put_measures_cache_periodically(tmpdir, monkeypatch):
+    from amsaf import cache as cache_module
+
+    walks = []
+    entries = RegistrationCache._entries
+
+    def counted(self):
+        walks.append(1)
+        return entries(self)
+
+    monkeypatch.setattr(RegistrationCache, '_entries', counted)
+    monkeypatch.setattr(cache_module, '_RESIZE_PUTS', 4)
+    cache = RegistrationCache(str(tmpdir), max_bytes=10 ** 9)
+    for i in range(8):
+        cache.put(cache.key(i), _image(i))
+    # Measured on the first, fourth and eighth store.
+    assert len(walks) == 3
+
+    # Each image entry is larger than 100 bytes, so every store evicts.
+    cache.max_bytes = 100
+    cache.put(cache.key('new'), _image(9))
+    assert cache.size() == 0
+
+
+def test_image_cache_hits_until_file_changes(tmpdir):
+    from amsaf.cache import ImageCache
+
+    path = str(tmpdir.join('img.mha'))
+    sitk.WriteImage(_image(1), path)
+    cache = ImageCache(max_bytes=10 ** 6)
+
+    cache.read(path)
+    image = cache.read(path, sitk.sitkUInt16)
+    assert image.GetPixelID() == sitk.sitkUInt16
+    cache.read(path)
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 2)
+
+    image.SetOrigin((5.0, 5.0, 5.0))
+    assert cache.read(path).GetOrigin() == (0.0, 0.0, 0.0)
+
+    cache.max_bytes = 4 * 5 * 6
+    cache.read(path, sitk.sitkUInt8)
+    assert cache.stats()['entries'] == 1
+
+
+def _ball(shift, n=16):
+    z, y, x = np.mgrid[:n, :n, :n]
+    return (x - n // 2 - shift) ** 2 + (y - n // 2) ** 2 + (z - n // 2) ** 2 < 16
+
+
+def test_memoized_rerun_with_widened_prior(tmpdir, monkeypatch):
+    from amsaf import amsaf
+
+    monkeypatch.chdir(tmpdir.mkdir('cwd'))
+    images = (sitk.GetImageFromArray(_ball(0).astype(np.float32) * 100),
+              sitk.GetImageFromArray(_ball(0).astype(np.uint8)),
+              sitk.GetImageFromArray(_ball(1).astype(np.float32) * 100),
+              sitk.GetImageFromArray(_ball(1).astype(np.uint8)))
+
+    def priors(weights):
+        result = [dict((k, v[:1]) for k, v in pm.items())
+                  for pm in amsaf._get_default_vector()]
+        for pm in result:
+            pm['MaximumNumberOfIterations'] = ['2']
+            pm['NumberOfResolutions'] = ['1']
+        result[2]['GridSpacingSchedule'] = ['1']
+        result[2]['Metric1Weight'] = weights
+        return result
+
+    cache = RegistrationCache(str(tmpdir.join('cache')))
+    first = list(amsaf.amsaf_eval(*images, parameter_priors=priors(['0']),
+                                  memoize=True, cache=cache))
+    # Cached rigid and affine stages are reused from a scratch directory
+    # that no longer exists.
+    second = list(amsaf.amsaf_eval(*images,
+                                   parameter_priors=priors(['0', '0.5']),
+                                   memoize=True, cache=cache))
+    assert len(first) == 1
+    assert len(second) == 2
+    assert float(first[0][2]) in [float(r[2]) for r in second]
+    assert tmpdir.join('cwd').listdir() == []
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.costmodel`."""
+
+import numpy as np
+import SimpleITK as sitk
+
+from amsaf.costmodel import CostModel, features
+from amsaf.database import ResultsDatabase
+from amsaf.scoring import Score
+
+
+def _vector(iterations, samples, spacing):
+    return [{'Transform': ('EulerTransform',),
+             'NumberOfResolutions': ('2',),
+             'MaximumNumberOfIterations': (str(iterations),),
+             'NumberOfSpatialSamples': (str(samples),)},
+            {'Transform': ('BSplineTransform',),
+             'NumberOfResolutions': ('1',),
+             'MaximumNumberOfIterations': (str(iterations),),
+             'NumberOfSpatialSamples': (str(samples),),
+             'FinalGridSpacingInPhysicalUnits': (str(spacing),)}]
+
+
+def test_features():
+    assert features(_vector(10, 100, 2), 800) == [
+        2.0, 10 * 2 * 100 + 10 * 100, 2 * 800 + 800, 10 * 800 / 8.0]
+
+
+def test_fit_predict_and_eta():
+    true = np.array([0.5, 1e-4, 1e-5, 1e-3])
+    model = CostModel()
+    vectors = [_vector(i, s, g) for i in (16, 64, 256)
+               for s in (256, 2048) for g in (4, 8)]
+    for pms in vectors:
+        model.add(pms, 32 ** 3, float(np.dot(true, features(pms, 32 ** 3))))
+    assert model.predict(vectors[0], 32 ** 3) is None
+
+    model.fit()
+    for pms in vectors:
+        expected = np.dot(true, features(pms, 32 ** 3))
+        assert abs(model.predict(pms, 32 ** 3) - expected) < 1e-6 * expected
+
+    costs = [model.predict(pms, 32 ** 3) for pms in vectors[:3]]
+    assert abs(model.eta(vectors[:3], 32 ** 3, 1) - sum(costs)) < 1e-9
+    assert abs(model.eta(vectors[:3], 32 ** 3, 3) - max(costs)) < 1e-9
+
+
+def test_runtimes_from_database(tmpdir):
+    db = ResultsDatabase(str(tmpdir.join('results.sqlite')))
+    image = sitk.GetImageFromArray(np.zeros((4, 5, 6), dtype=np.uint8))
+    inputs = db.inputs((image, image, image, image))
+    for i in range(5):
+        db.record(inputs, [_vector(16 * (i + 1), 256, 4), image,
+                           Score(0.5, runtime=1.0 + i)])
+    db.record(inputs, [_vector(8, 256, 4), None, 0.5])
+
+    runtimes = db.runtimes(inputs)
+    assert sorted(r for _, _, r in runtimes) == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert set(v for _, v, _ in runtimes) == set([120])
+    model = CostModel().add_database(db).fit()
+    assert len(model.samples) == 5 and model.fitted
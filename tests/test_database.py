@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.database`."""
+
+import numpy as np
+import SimpleITK as sitk
+
+from amsaf import amsaf
+from amsaf.database import ResultsDatabase
+from amsaf.journal import vector_key
+from amsaf.search import scale_budget
+from amsaf.scoring import Score
+
+
+def _image(value):
+    return sitk.GetImageFromArray(np.full((4, 5, 6), value, dtype=np.uint8))
+
+
+def test_record_load_and_best_by_stage(tmpdir):
+    db = ResultsDatabase(str(tmpdir.join('results.sqlite')))
+    inputs = db.inputs((_image(1), _image(2), _image(3), _image(4)))
+    seg_path = str(tmpdir.join('seg.mha'))
+    sitk.WriteImage(_image(1), seg_path)
+
+    rigid = {'Transform': ('EulerTransform',)}
+    bsplines = [{'Transform': ('BSplineTransform',),
+                 'FinalGridSpacingInPhysicalUnits': (str(s),)}
+                for s in (4, 8)]
+    scores = {(0, 0): 0.5, (1, 0): 0.7, (0, 1): 0.9, (1, 1): 0.6}
+    for (a, b), score in sorted(scores.items()):
+        affine = {'Transform': ('AffineTransform',),
+                  'MaximumNumberOfIterations': (str(a),)}
+        db.record(inputs, [[rigid, affine, bsplines[b]], None,
+                           Score(score, runtime=1.5)],
+                  location=seg_path if score == 0.9 else None)
+
+    assert len(db.completed(inputs)) == 4
+    best = db.best(2, inputs=inputs)
+    assert [row['score'] for row in best] == [0.9, 0.7]
+    assert best[0]['runtime'] == 1.5
+
+    by_bspline = db.best(20, stage='bspline', unsegmented_image=inputs[1],
+                         segmented_image=inputs[3])
+    assert [row['score'] for row in by_bspline] == [0.9, 0.7]
+    assert [row['parameter_maps'][0]['FinalGridSpacingInPhysicalUnits']
+            for row in by_bspline] == [['8'], ['4']]
+
+    keys = dict((row['score'], row['key']) for row in db.best(4))
+    pms, seg, score = db.load(inputs, keys[0.9])
+    assert pms[2]['FinalGridSpacingInPhysicalUnits'] == ('8',)
+    assert score == 0.9
+    assert db.load(inputs, keys[0.5]) is None
+
+
+def test_amsaf_eval_skips_recorded_candidates(tmpdir):
+    db = ResultsDatabase(str(tmpdir.join('results.sqlite')))
+    images = (_image(1), _image(1), _image(2), _image(1))
+    priors = amsaf._get_default_vector()
+    for pms in amsaf._param_vectors(priors):
+        db.record(db.inputs(images), [pms, None, 0.5])
+
+    # Every candidate is recorded without a segmentation, so nothing is
+    # evaluated or yielded.
+    assert list(amsaf.amsaf_eval(*images, parameter_priors=priors,
+                                 database=db)) == []
+    key = vector_key(next(amsaf._param_vectors(priors)))
+    assert db.load(db.inputs(images), key) is None
+    pms, seg, score = db.load(db.inputs(images), key, missing_ok=True)
+    assert (seg, score) == (None, 0.5)
+
+
+def test_halving_ranks_recorded_candidates(tmpdir, monkeypatch):
+    db = ResultsDatabase(str(tmpdir.join('results.sqlite')))
+    images = (_image(1), _image(1), _image(2), _image(1))
+    priors = [dict((k, v[:1]) for k, v in pm.items())
+              for pm in amsaf._get_default_vector()]
+    priors[2]['FinalGridSpacingInPhysicalUnits'] = ['4', '8', '16']
+    candidates = list(amsaf._param_vectors(priors))
+    # A first run recorded the low budget rung without run_dir.
+    for pms, score in zip(candidates, [0.2, 0.9, 0.5]):
+        db.record(db.inputs(images),
+                  [[scale_budget(pm, 1 / 3.0) for pm in pms], None, score])
+
+    evaluated = []
+
+    def eval_candidate(pms, images=None, verbose=False, num_threads=None,
+                       cache=None):
+        evaluated.append(pms)
+        return [pms, _image(1), 1.0, []]
+
+    monkeypatch.setattr(amsaf, '_eval_candidate', eval_candidate)
+    results = list(amsaf.amsaf_eval(*images, parameter_priors=priors,
+                                    database=db, search='halving',
+                                    search_options={'n_rungs': 2}))
+    assert [vector_key(pms) for pms in evaluated] == \
+        [vector_key(candidates[1])]
+    assert [vector_key(r[0]) for r in results] == [vector_key(candidates[1])]
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.journal`."""
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from amsaf.journal import RunJournal, vector_key
+
+
+def _image(value):
+    return sitk.GetImageFromArray(np.full((4, 5, 6), value, dtype=np.uint8))
+
+
+def test_resume_reads_back_results(tmpdir):
+    images = [_image(i) for i in range(4)]
+    pms = [{'Transform': ('EulerTransform',)}]
+    RunJournal(str(tmpdir), images).record([pms, _image(7), 0.5])
+
+    journal = RunJournal(str(tmpdir), images)
+    assert journal.completed() == frozenset([vector_key(pms)])
+    parameter_maps, seg, score = journal.load(vector_key(pms))
+    assert parameter_maps[0]['Transform'] == ('EulerTransform',)
+    assert np.all(sitk.GetArrayFromImage(seg) == 7)
+    assert score == 0.5
+
+
+def test_resume_rejects_other_inputs(tmpdir):
+    RunJournal(str(tmpdir), [_image(i) for i in range(4)])
+    with pytest.raises(ValueError):
+        RunJournal(str(tmpdir), [_image(i + 1) for i in range(4)])
+
+
+def test_resume_after_partial_header(tmpdir):
+    images = [_image(i) for i in range(4)]
+    pms = [{'Transform': ('EulerTransform',)}]
+    path = RunJournal(str(tmpdir), images).path
+    for partial in ('', '{"inputs": "'):
+        with open(path, 'w') as f:
+            f.write(partial)
+        journal = RunJournal(str(tmpdir), images)
+        assert journal.completed() == frozenset()
+        journal.record([pms, _image(7), 0.5])
+        assert RunJournal(str(tmpdir), images).completed() == frozenset(
+            [vector_key(pms)])
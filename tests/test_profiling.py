@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.profiling`."""
+
+import io
+
+import numpy as np
+import SimpleITK as sitk
+
+from amsaf import amsaf
+from amsaf import profiling
+
+
+def test_collected_events_are_replayed_to_hooks():
+    events = []
+    with profiling.hooked(events.append):
+        with profiling.collect() as collected:
+            with profiling.stage('registration', voxels=10):
+                pass
+        assert events == []
+        profiling.replay(collected, candidate='abc')
+    assert [(e['stage'], e['voxels'], e['candidate']) for e in events] == [
+        ('registration', 10, 'abc')]
+    assert events[0]['wall'] >= 0 and events[0]['peak_rss'] > 0
+
+
+def test_stage_profile_aggregates_io(tmpdir):
+    seg = sitk.GetImageFromArray(np.ones((2, 3, 4), dtype=np.uint8))
+    path = str(tmpdir.join('seg.mha'))
+    sitk.WriteImage(seg, path)
+
+    profile = profiling.StageProfile()
+    with profiling.hooked(profile):
+        amsaf.read_image(path)
+        amsaf.write_result([[], seg, 0.5], str(tmpdir.join('result')))
+    assert profile.stages['read']['count'] == 1
+    assert profile.stages['write']['voxels'] == 24
+
+    out = io.StringIO()
+    profile.report(out)
+    assert out.getvalue().splitlines()[0].split()[:2] == ['stage', 'count']
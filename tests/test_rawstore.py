@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.rawstore`."""
+
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from amsaf.rawstore import RawStore
+
+
+def test_read_matches_decoded_image(tmpdir):
+    image = sitk.GetImageFromArray(
+        np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6))
+    image.SetOrigin((1.0, 2.0, 3.0))
+    image.SetSpacing((0.5, 0.5, 2.0))
+    path = str(tmpdir.join('img.nii.gz'))
+    sitk.WriteImage(image, path, True)
+
+    store = RawStore(str(tmpdir.join('raw')))
+    first = store.read(path)
+    data, meta = store.open(path)
+    assert isinstance(data, np.memmap)
+    assert len(os.listdir(store.path)) == 2
+
+    second = store.read(path, sitk.sitkUInt16)
+    for result in (first, second):
+        assert result.GetOrigin() == image.GetOrigin()
+        assert result.GetSpacing() == image.GetSpacing()
+        assert np.array_equal(sitk.GetArrayViewFromImage(result),
+                              sitk.GetArrayViewFromImage(image))
+    assert second.GetPixelID() == sitk.sitkUInt16
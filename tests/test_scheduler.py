@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.scheduler`."""
+
+import pytest
+
+from amsaf import scheduler
+
+
+def test_plan_follows_scaling():
+    # Linear scaling: one job with every core.
+    assert scheduler.plan(cores=8, serial_fraction=0.0) == (1, 8)
+    # Poor scaling: a job per core, unless there are fewer tasks.
+    assert scheduler.plan(cores=8, serial_fraction=0.5) == (8, 1)
+    assert scheduler.plan(n_tasks=2, cores=8, serial_fraction=0.5) == (2, 4)
+    assert scheduler.plan(cores=8, serial_fraction=0.5, max_jobs=3) == (3, 2)
+
+
+def test_plan_assumes_serial_fraction_until_calibrated(monkeypatch):
+    monkeypatch.setattr(scheduler.CONFIG, 'serial_fraction', None)
+    assert scheduler.plan(cores=8) == (8, 1)
+    monkeypatch.setattr(scheduler.CONFIG, 'serial_fraction', 0.0)
+    assert scheduler.plan(cores=8) == (1, 8)
+
+
+def test_fit_serial_fraction_recovers_amdahl():
+    timings = dict((n, 10.0 / scheduler.speedup(n, 0.2)) for n in (1, 2, 4))
+    assert scheduler.fit_serial_fraction(timings) == pytest.approx(0.2)
+
+
+def test_configure_sets_filter_threads():
+    config = scheduler.CONFIG
+    saved = (config.cores, config.threads)
+    try:
+        scheduler.configure(cores=6, threads=2)
+        assert scheduler.filter_threads() == 2
+        assert scheduler.filter_threads(3) == 3
+        assert scheduler.threads_per_job(4) == 1
+        with pytest.raises(ValueError):
+            scheduler.configure(threads=0)
+    finally:
+        config.cores, config.threads = saved
+
+
+def test_transform_keeps_global_threads_off_main_thread(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    import numpy as np
+    import SimpleITK as sitk
+
+    from amsaf import amsaf
+
+    image = sitk.GetImageFromArray(np.ones((4, 5, 6), dtype=np.float32))
+    pm = {'Transform': ['TranslationTransform'], 'NumberOfParameters': ['3'],
+          'TransformParameters': ['0', '0', '0'],
+          'InitialTransformParameterFileName': ['NoInitialTransform'],
+          'FixedImageDimension': ['3'], 'MovingImageDimension': ['3'],
+          'Size': ['6', '5', '4'], 'Index': ['0', '0', '0'],
+          'Spacing': ['1', '1', '1'], 'Origin': ['0', '0', '0'],
+          'Direction': ['1', '0', '0', '0', '1', '0', '0', '0', '1'],
+          'ResampleInterpolator': ['FinalNearestNeighborInterpolator'],
+          'Resampler': ['DefaultResampler'],
+          'ResultImagePixelType': ['float']}
+    calls = []
+    monkeypatch.setattr(sitk.ProcessObject, 'SetGlobalDefaultNumberOfThreads',
+                        staticmethod(calls.append))
+
+    with ThreadPoolExecutor(1) as executor:
+        executor.submit(amsaf.transform, image, [sitk.ParameterMap(pm)],
+                        num_threads=1).result()
+    assert calls == []
+    amsaf.transform(image, [sitk.ParameterMap(pm)], num_threads=1)
+    assert calls[0] == 1
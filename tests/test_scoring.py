@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.scoring`."""
+
+import pickle
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from amsaf.scoring import OverlapScorer
+
+
+@pytest.fixture
+def label_images():
+    rs = np.random.RandomState(0)
+    gt = np.zeros((8, 20, 20), np.uint8)
+    gt[3:5, 4:15, 6:12] = rs.randint(0, 4, (2, 11, 6))
+    candidate = rs.randint(0, 4, gt.shape) * (rs.rand(*gt.shape) < 0.3)
+    return (sitk.GetImageFromArray(gt),
+            sitk.GetImageFromArray(candidate.astype(np.float32)))
+
+
+def test_matches_label_overlap_filter(label_images):
+    ground_truth, candidate = label_images
+    overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
+    overlap_filter.Execute(ground_truth,
+                           sitk.Cast(candidate, ground_truth.GetPixelID()))
+
+    score = OverlapScorer(ground_truth)(candidate)
+    assert score == pytest.approx(overlap_filter.GetDiceCoefficient())
+    for label in [1, 2, 3]:
+        measures = score.labels[label]
+        assert measures['dice'] == pytest.approx(
+            overlap_filter.GetDiceCoefficient(label))
+        assert measures['jaccard'] == pytest.approx(
+            overlap_filter.GetJaccardCoefficient(label))
+        assert measures['volume_similarity'] == pytest.approx(
+            overlap_filter.GetVolumeSimilarity(label))
+
+
+def test_float_candidates_are_truncated(label_images):
+    ground_truth, candidate = label_images
+    data = sitk.GetArrayFromImage(candidate)
+    # Fractions are truncated like a cast to the ground truth's pixel type.
+    data[data == 0] = 0.5
+    data[data == 2] = 2.7
+    fractional = sitk.GetImageFromArray(data)
+    cast = sitk.GetImageFromArray(data.astype(np.uint8))
+
+    scorer = OverlapScorer(ground_truth, surface_distances=True)
+    score, expected = scorer(fractional), scorer(cast)
+    assert score == expected
+    assert score.labels == expected.labels
+    assert score.measures == expected.measures
+
+
+def test_pickles(label_images):
+    ground_truth, candidate = label_images
+    scorer = pickle.loads(pickle.dumps(OverlapScorer(ground_truth)))
+    score = pickle.loads(pickle.dumps(scorer(candidate)))
+    assert score == OverlapScorer(ground_truth)(candidate)
+    assert set(score.labels) == set([1, 2, 3])
+
+
+def test_surface_distances_of_shifted_sphere():
+    z, y, x = np.mgrid[:16, :24, :24]
+    sphere = ((x - 12) ** 2 + (y - 12) ** 2 + (z - 8) ** 2) < 25
+    ground_truth = sitk.GetImageFromArray(sphere.astype(np.uint8))
+    ground_truth.SetSpacing((2.0, 1.0, 1.0))
+    shifted = sitk.GetImageFromArray(np.roll(sphere, 1, axis=2)
+                                     .astype(np.uint8))
+
+    scorer = OverlapScorer(ground_truth, surface_distances=True)
+    assert scorer(ground_truth).measures['hausdorff95'] == 0
+    measures = scorer(shifted).measures
+    assert 0 < measures['assd'] <= measures['hausdorff95'] <= 2.0
+
+    ranked = OverlapScorer(ground_truth, surface_distances=True,
+                           rank_by='assd')(shifted)
+    assert ranked == -measures['assd']
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.search`."""
+
+from amsaf import search
+
+
+def _candidates(n):
+    return [[{'MaximumNumberOfIterations': ('1024.000000',),
+              'Metric0Weight': (str(i),)}] for i in range(n)]
+
+
+def test_scale_budget():
+    pm = {'MaximumNumberOfIterations': ('1024.000000',),
+          'NumberOfSpatialSamples': ('2048',),
+          'Metric0Weight': ('0.5',)}
+    scaled = search.scale_budget(pm, 0.25)
+    assert scaled['MaximumNumberOfIterations'] == ('256',)
+    assert scaled['NumberOfSpatialSamples'] == ('512',)
+    assert scaled['Metric0Weight'] == ('0.5',)
+    assert search.scale_budget(pm, 1.0) == pm
+
+
+def test_successive_halving_promotes_best():
+    budgets = []
+
+    def evaluate(vectors):
+        for pms in vectors:
+            iterations = pms[0]['MaximumNumberOfIterations'][0]
+            budgets.append(float(iterations))
+            yield [pms, None, float(pms[0]['Metric0Weight'][0])]
+
+    results = list(search.successive_halving(_candidates(9), evaluate,
+                                             eta=3, n_rungs=3))
+    assert [r[0][0]['Metric0Weight'] for r in results] == [('8',)]
+    assert results[0][0][0]['MaximumNumberOfIterations'] == ('1024.000000',)
+    assert budgets == [114.0] * 9 + [341.0] * 3 + [1024.0]
+
+
+def test_successive_halving_ranks_missing_scores_last():
+    def evaluate(vectors):
+        for pms in vectors:
+            if pms[0]['Metric0Weight'] != ('0',):
+                yield [pms, None, float(pms[0]['Metric0Weight'][0])]
+
+    results = list(search.successive_halving(_candidates(3), evaluate,
+                                             eta=3, n_rungs=2))
+    assert [r[0][0]['Metric0Weight'] for r in results] == [('2',)]
+
+
+def test_tpe_respects_budget_and_batches():
+    priors = [{'a': ['1', '2', '3', '4']},
+              {'b': [['x', 'y'], ['z']]},
+              {'c': ['0.5'], 'd': ['8', '16']}]
+    batches = []
+
+    def evaluate(vectors):
+        batches.append(len(vectors))
+        for pms in vectors:
+            yield [pms, None, float(pms[0]['a'][0]) + float(pms[2]['d'][0])]
+
+    def to_vector(points):
+        return [dict((k, tuple(v) if isinstance(v, list) else (v,))
+                     for k, v in point.items()) for point in points]
+
+    results = list(search.tpe(priors, evaluate, to_vector, budget=10,
+                              batch_size=3, n_startup=3, seed=0))
+    assert len(results) == 10
+    assert batches == [3, 3, 3, 1]
+    assert len(set(search.vector_key(r[0]) for r in results)) == 10
+
+    everything = list(search.tpe(priors, evaluate, to_vector, budget=100))
+    assert len(everything) == 4 * 2 * 2
+
+
+def test_proxy_screening_promotes_best_and_reports():
+    reports = []
+
+    def evaluate_proxy(vectors):
+        for pms in vectors:
+            weight = float(pms[0]['Metric0Weight'][0])
+            yield [pms, None, weight if weight < 7 else -weight]
+
+    def evaluate(vectors):
+        for pms in vectors:
+            yield [pms, None, float(pms[0]['Metric0Weight'][0])]
+
+    results = list(search.proxy_screening(_candidates(9), evaluate_proxy,
+                                          evaluate, n_promote=3,
+                                          report=reports.append))
+    assert [r[0][0]['Metric0Weight'] for r in results] == [
+        ('4',), ('5',), ('6',)]
+    assert reports[0]['n_screened'] == 9
+    assert reports[0]['n_promoted'] == 3
+    assert reports[0]['scores'] == [4.0, 5.0, 6.0]
+    assert reports[0]['spearman'] == 1.0
+
+
+def test_rank_correlation():
+    assert search.rank_correlation([1, 2, 3], [10, 20, 30]) == 1.0
+    assert search.rank_correlation([1, 2, 3], [3, 1, 0]) == -1.0
+    assert search.rank_correlation([1], [1]) is None
+    assert search.rank_correlation([1, 1], [1, 2]) is None
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.store`."""
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from amsaf import amsaf
+from amsaf.scoring import Score
+from amsaf.store import ResultStore, recover
+
+
+def _seg(label):
+    data = np.zeros((6, 7, 8), dtype=np.int16)
+    data[2:4, 1:5, 3:6] = label
+    seg = sitk.GetImageFromArray(data)
+    seg.SetOrigin((1.0, 2.0, 3.0))
+    seg.SetSpacing((0.5, 0.5, 2.0))
+    return seg
+
+
+def test_roundtrip_and_ranking(tmpdir):
+    path = str(tmpdir.join('results.npz'))
+    pm = {'Transform': ('EulerTransform',)}
+    results = [[[pm], _seg(1), 0.2],
+               [[pm], _seg(300), Score(0.9, {300: {'dice': 0.9}})],
+               [[pm], _seg(2), 0.5]]
+    amsaf.write_top_k(0, iter(results), path, single_file=True)
+
+    with ResultStore(path) as store:
+        assert len(store) == 3
+        assert store.ranked(2) == [1, 2]
+        pms, seg, score = store.result(1)
+        assert pms[0]['Transform'] == ('EulerTransform',)
+        assert score == 0.9 and score.labels == {300: {'dice': 0.9}}
+        assert seg.GetPixelID() == sitk.sitkInt16
+        assert seg.GetOrigin() == (1.0, 2.0, 3.0)
+        assert np.array_equal(sitk.GetArrayFromImage(seg),
+                              sitk.GetArrayFromImage(_seg(300)))
+        assert store.meta(0)['box'] == [[2, 4], [1, 5], [3, 6]]
+
+    with ResultStore(path) as store:
+        assert store.add(results[0]) == 3
+    assert 'seg-3' in np.load(path).files
+
+    # The top k replace the earlier results, best first.
+    amsaf.write_top_k(2, iter(results), path, single_file=True)
+    with ResultStore(path) as store:
+        assert len(store) == 2
+        assert [float(store.score(i)) for i in range(2)] == [0.9, 0.5]
+    assert os.listdir(str(tmpdir)) == ['results.npz']
+
+
+def test_recover_unclosed_store(tmpdir):
+    path = str(tmpdir.join('results.npz'))
+    killed = str(tmpdir.join('killed.npz'))
+    pm = {'Transform': ('EulerTransform',)}
+    store = ResultStore(path)
+    for label in (1, 2, 3):
+        store.add([[pm], _seg(label), 0.1 * label])
+    store._zip.fp.flush()
+    # A copy of the file as a killed process would leave it, with the last
+    # result cut short.
+    shutil.copy(path, killed)
+    store.close()
+    with open(killed, 'rb+') as f:
+        f.truncate(f.seek(0, 2) - 10)
+
+    with pytest.raises(IOError):
+        ResultStore(killed)
+    assert recover(killed) == 2
+    with ResultStore(killed) as store:
+        assert store.scores() == [0.1, 0.2]
+        assert np.array_equal(sitk.GetArrayFromImage(store.segmentation(1)),
+                              sitk.GetArrayFromImage(_seg(2)))
+        assert store.add([[pm], _seg(4), 0.4]) == 2
+    with ResultStore(killed) as store:
+        assert len(store) == 3
+
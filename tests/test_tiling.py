@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.tiling`."""
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from amsaf.tiling import Stitcher, tile_regions, tiles
+
+
+def test_tile_regions_cover_axis():
+    assert tile_regions((19,), 8, 2) == [((0,), (8,)), ((6,), (8,)),
+                                         ((11,), (8,))]
+    assert tile_regions((5, 4), 8) == [((0, 0), (5, 4))]
+
+
+def test_stitch_roundtrip(tmpdir):
+    data = np.random.RandomState(0).rand(13, 17, 19).astype(np.float32)
+    img = sitk.GetImageFromArray(data)
+    img.SetOrigin((1.0, 2.0, 3.0))
+    img.SetSpacing((0.5, 1.0, 2.0))
+    path = str(tmpdir.join('img.mha'))
+    sitk.WriteImage(img, path)
+
+    stitcher = Stitcher(path, overlap=(2, 3, 1))
+    for tile in tiles(path, (8, 9, 5), (2, 3, 1)):
+        stitcher.add(tile)
+    result = stitcher.result()
+    assert result.GetOrigin() == img.GetOrigin()
+    assert np.allclose(sitk.GetArrayFromImage(result), data)
+
+
+def test_stitch_memory_mapped(tmpdir):
+    data = np.random.RandomState(0).rand(9, 10, 11).astype(np.float32)
+    img = sitk.GetImageFromArray(data)
+    stitcher = Stitcher(img, overlap=2, pixel_type=sitk.sitkFloat64,
+                        scratch_dir=str(tmpdir))
+    for tile in tiles(img, 6, 2):
+        stitcher.add(tile)
+    result = stitcher.result()
+    assert result.GetPixelID() == sitk.sitkFloat64
+    assert np.allclose(sitk.GetArrayFromImage(result), data)
+    # Accumulators are normalized in place, so there is only one result.
+    with pytest.raises(ValueError):
+        stitcher.result()
+    with pytest.raises(ValueError):
+        stitcher.add(img)
+
+
+def test_stitch_labels():
+    labels = sitk.GetImageFromArray(
+        np.random.RandomState(0).randint(0, 4, (9, 10, 11)).astype(np.uint8))
+    stitcher = Stitcher(labels, overlap=3, labels=True)
+    for tile in tiles(labels, 7, 3):
+        stitcher.add(tile)
+    result = stitcher.result()
+    assert result.GetPixelID() == labels.GetPixelID()
+    assert np.all(sitk.GetArrayFromImage(result) ==
+                  sitk.GetArrayFromImage(labels))
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `amsaf.writer`."""
+
+import threading
+
+import pytest
+
+from amsaf.writer import ResultWriter
+
+
+def test_submit_blocks_while_queue_is_full():
+    release = threading.Event()
+    done = []
+    writer = ResultWriter(n_threads=1, max_pending=1)
+    writer.submit(release.wait)
+
+    blocked = threading.Thread(target=writer.submit,
+                               args=(done.append, 1))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join()
+    writer.close()
+    assert done == [1]
+
+
+def test_errors_are_reraised():
+    def fail():
+        raise IOError('disk full')
+
+    writer = ResultWriter()
+    writer.submit(fail)
+    with pytest.raises(IOError):
+        writer.close()